@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Accessibility metrics (e.g., building to grocery store access) for every origin
+without routing each origin-destination pair.
+
+Origins and destinations are the output of snap_to_network (they have an "N"
+column with the nearest network node). Searches start from the destination
+nodes on the reversed network graph, so one search per destination node gives
+the impedance from every origin to that destination. The searches are bounded
+by the impedance budget and run in chunks of destination nodes, and the results
+are reduced to per-origin scores in NumPy as each chunk finishes.
+
+Metrics:
+    nearest: impedance to the closest destination (one multi-source search)
+    nearest_k: impedance to the kth closest destination (destinations on the same
+        node each count, so two stores on one node are the 1st and 2nd closest)
+    count_within: number (or sum of weight_col) of destinations within the budget
+    gravity: sum of weight * exp(-beta * impedance) over destinations within the budget
+
+The network graph is built with create_csr_graph (bikewaysim_lite).
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import dijkstra
+
+from bikewaysim_lite import create_csr_graph
+from instrument import instrumented
+
+def destination_weights(destinations:pd.DataFrame,node_ids:np.ndarray,weight_col:str=None):
+    '''
+    Combines destinations that snapped to the same node. Returns the graph index
+    of each destination node, the number (or sum of weight_col) of destinations
+    at it, and the number of destinations at it (unweighted). Destinations on nodes
+    that aren't in the graph are dropped.
+    '''
+    weights = destinations[weight_col] if weight_col is not None else pd.Series(1.0,index=destinations.index)
+    weights = weights.groupby(destinations['N'].to_numpy()).agg(['sum','size'])
+    idx = node_index(weights.index.to_numpy(),node_ids)
+    keep = idx >= 0
+    return idx[keep], weights['sum'].to_numpy(dtype=float)[keep], weights['size'].to_numpy()[keep]
+
+def node_index(nodes:np.ndarray,node_ids:np.ndarray):
+    '''
+    Converts node ids to graph indices (-1 if the node isn't in the graph)
+    '''
+    idx = np.searchsorted(node_ids,nodes)
+    idx[idx == len(node_ids)] = 0
+    return np.where(node_ids[idx] == nodes,idx,-1)
+
+def reverse_sweep(reverse_graph,dest_idx:np.ndarray,budget:float=np.inf,chunk_size:int=16):
+    '''
+    Bounded searches from the destination nodes on the reversed graph. Yields the
+    positions of the destinations in the chunk and an array (chunk x nodes) with
+    the impedance from every node to each destination (inf if over the budget).
+    '''
+    for start in range(0,len(dest_idx),chunk_size):
+        chunk = np.arange(start,min(start+chunk_size,len(dest_idx)))
+        costs = dijkstra(reverse_graph,directed=True,indices=dest_idx[chunk],limit=budget)
+        yield chunk, np.atleast_2d(costs)
+
+def nearest(reverse_graph,dest_idx:np.ndarray,budget:float=np.inf):
+    '''
+    Impedance from every node to the closest destination and the graph index of
+    that destination in one multi-source search
+    '''
+    costs, _, sources = dijkstra(reverse_graph,directed=True,indices=dest_idx,limit=budget,
+                                 min_only=True,return_predecessors=True)
+    return costs, sources
+
+@instrumented()
+def accessibility(links,origins:pd.DataFrame,destinations:pd.DataFrame,impedance_col:str,budget:float=np.inf,
+                  k:int=None,beta:float=None,weight_col:str=None,wrongway_factor:float=None,chunk_size:int=16):
+    '''
+    Adds accessibility scores to the origins (snap_to_network output). The network
+    graph uses the same rules as create_graph.
+
+    Columns added:
+        nearest_{impedance_col}: impedance to the closest destination
+        nearest_dest_N: node of the closest destination
+        nearest_{k}_{impedance_col}: impedance to the kth closest destination (if k is given)
+        count_within: number of destinations (or sum of weight_col) within the budget
+        gravity: sum of weight * exp(-beta * impedance) within the budget (if beta is given)
+
+    Impedances over the budget and origins that can't reach a destination are NaN.
+    '''
+    graph, node_ids = create_csr_graph(links,impedance_col,wrongway_factor)
+    reverse_graph = graph.T.tocsr()
+
+    dest_idx, weights, dest_count = destination_weights(destinations,node_ids,weight_col)
+    print(f'{len(dest_idx)} destination nodes')
+
+    #nearest destination
+    costs, sources = nearest(reverse_graph,dest_idx,budget)
+    scores = {f'nearest_{impedance_col}':costs,'nearest_dest_N':np.where(sources >= 0,node_ids[np.maximum(sources,0)],np.nan)}
+
+    #per destination searches for the other metrics
+    count_within = np.zeros(len(node_ids))
+    gravity = np.zeros(len(node_ids)) if beta is not None else None
+    kth = np.full((k,len(node_ids)),np.inf) if k is not None else None
+
+    for chunk, costs in reverse_sweep(reverse_graph,dest_idx,budget,chunk_size):
+        reached = np.isfinite(costs)
+        count_within += (reached * weights[chunk,None]).sum(axis=0)
+        if gravity is not None:
+            decay = np.exp(-beta * np.where(reached,costs,0))
+            gravity += (reached * decay * weights[chunk,None]).sum(axis=0)
+        if kth is not None:
+            #keep the k smallest impedances seen so far for each node (each destination
+            #node's impedance is repeated for every destination at it, up to k times)
+            costs = np.repeat(costs,np.minimum(dest_count[chunk],k),axis=0)
+            kth = np.partition(np.vstack([kth,costs]),k-1,axis=0)[:k]
+
+    scores['count_within'] = count_within
+    if gravity is not None:
+        scores['gravity'] = gravity
+    if kth is not None:
+        scores[f'nearest_{k}_{impedance_col}'] = kth.max(axis=0)
+
+    #look up the scores for each origin
+    origin_idx = node_index(origins['N'].to_numpy(),node_ids)
+    on_graph = origin_idx >= 0
+    origins = origins.copy()
+    for name, values in scores.items():
+        looked_up = np.full(len(origins),np.nan)
+        looked_up[on_graph] = values[origin_idx[on_graph]]
+        looked_up[np.isinf(looked_up)] = np.nan
+        origins[name] = looked_up
+    origins['nearest_dest_N'] = origins['nearest_dest_N'].astype('Int64')
+
+    return origins
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Goal directed point to point routing (A* and bidirectional A*).
+
+Single origin-destination queries with networkx's single_source_dijkstra search
+outward in every direction until the destination is reached. A* adds a lower
+bound on the remaining impedance to the destination (the heuristic) so the
+search heads towards it, and bidirectional A* searches from both ends.
+
+Heuristics:
+    euclidean: straight line distance between the node X/Y columns times the
+        lowest impedance per unit of link length over the directed edges (so it never
+        overestimates for any impedance column)
+    alt: landmark lower bounds (A*, Landmarks, Triangle inequality). Impedances
+        to and from a few landmark nodes are found once per network and work
+        for impedances that aren't related to distance (e.g., with turn or
+        grade costs).
+
+The search runs on the CSR arrays from create_csr_graph (bikewaysim_lite).
+"""
+
+import heapq
+import math
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import dijkstra
+
+from bikewaysim_lite import create_csr_graph, directed_edges
+from instrument import instrumented, count
+
+@instrumented()
+def prepare_queries(links,nodes,impedance_col:str,num_landmarks:int=0,wrongway_factor:float=None,seed:int=0):
+    '''
+    Builds everything needed for point to point queries. Returns a dictionary with
+    the forward and reverse CSR graphs, node_ids, node coordinates, the euclidean
+    heuristic factor, and (if num_landmarks > 0) the landmark impedances.
+    '''
+    graph, node_ids = create_csr_graph(links,impedance_col,wrongway_factor)
+
+    #nodes without coordinates would get no euclidean bound, which breaks the
+    #consistency the searches rely on, so they're left out of the graph
+    coords = nodes.set_index('N')[['X','Y']].reindex(node_ids)
+    has_coords = coords.notna().all(axis=1).to_numpy()
+    if not has_coords.all():
+        count(nodes_without_coords=int((~has_coords).sum()))
+        graph = graph[has_coords][:,has_coords].tocsr()
+        node_ids, coords = node_ids[has_coords], coords[has_coords]
+    reverse = graph.T.tocsr()
+
+    #lowest impedance per foot over the directed edges (reverse {col}_ba and wrongway
+    #impedances included) so that euclidean distance * factor is a lower bound
+    edges = directed_edges(links,impedance_col,wrongway_factor)
+    length = links.length.to_numpy()
+    length = length[edges['link_idx'].to_numpy()] if 'link_idx' in edges.columns else length
+    with np.errstate(divide='ignore',invalid='ignore'):
+        per_length = edges[impedance_col].to_numpy(dtype=float) / length
+    factor = np.nanmin(np.where(length > 0,per_length,np.nan))
+
+    query = {
+        'graph':graph,
+        'reverse':reverse,
+        'node_ids':node_ids,
+        'x':coords['X'].to_numpy(),
+        'y':coords['Y'].to_numpy(),
+        'factor':max(factor,0)
+        }
+
+    if num_landmarks > 0:
+        query['from_landmark'], query['to_landmark'], query['landmarks'] = select_landmarks(graph,reverse,num_landmarks,seed)
+
+    return query
+
+def select_landmarks(graph,reverse,num_landmarks:int,seed:int=0):
+    '''
+    Picks landmarks with the farthest first method (each new landmark is the node
+    farthest from the ones already picked) and returns the impedances from and to
+    every landmark (landmarks x nodes).
+    '''
+    rng = np.random.default_rng(seed)
+    landmarks = [rng.integers(graph.shape[0])]
+    from_landmark, to_landmark = [], []
+    closest = np.full(graph.shape[0],np.inf)
+
+    while True:
+        from_landmark.append(dijkstra(graph,directed=True,indices=landmarks[-1]))
+        to_landmark.append(dijkstra(reverse,directed=True,indices=landmarks[-1]))
+        if len(landmarks) == num_landmarks:
+            break
+        closest = np.minimum(closest,from_landmark[-1] + to_landmark[-1])
+        landmarks.append(int(np.argmax(np.where(np.isfinite(closest),closest,-1))))
+
+    return np.array(from_landmark), np.array(to_landmark), np.array(landmarks)
+
+def _potentials(query:dict,heuristic:str,source:int,target:int):
+    '''
+    Supporting function for shortest_path. Returns functions giving a lower bound
+    on the impedance from a node to the target and from the source to a node.
+    '''
+    if heuristic == 'euclidean':
+        x, y, factor = query['x'], query['y'], query['factor']
+        def euclidean(u,v):
+            return factor * math.hypot(x[u] - x[v],y[u] - y[v])
+        return (lambda v: euclidean(v,target)), (lambda v: euclidean(source,v))
+
+    if heuristic == 'alt':
+        lf, lt = query['from_landmark'], query['to_landmark']
+        def bound(diffs):
+            diffs = diffs[np.isfinite(diffs)]
+            return max(diffs.max(),0) if len(diffs) > 0 else 0
+        #triangle inequality lower bounds
+        to_target = lambda v: bound(np.concatenate([lf[:,target] - lf[:,v],lt[:,v] - lt[:,target]]))
+        from_source = lambda v: bound(np.concatenate([lf[:,v] - lf[:,source],lt[:,source] - lt[:,v]]))
+        return to_target, from_source
+
+    return (lambda v: 0), (lambda v: 0)
+
+def _path(parents:dict,node:int):
+    path = [node]
+    while parents[path[-1]] is not None:
+        path.append(parents[path[-1]])
+    return path
+
+def shortest_path(query:dict,origin,destination,bidirectional:bool=True,heuristic:str='euclidean'):
+    '''
+    Finds the shortest path between two node ids. heuristic can be 'euclidean', 'alt'
+    (needs landmarks from prepare_queries), or None (Dijkstra). Returns the impedance
+    (inf if there is no path), the node id list, and the number of nodes settled.
+    '''
+    node_ids = query['node_ids']
+    source = int(np.searchsorted(node_ids,origin))
+    target = int(np.searchsorted(node_ids,destination))
+    if (source >= len(node_ids)) or (node_ids[source] != origin) or (target >= len(node_ids)) or (node_ids[target] != destination):
+        return np.inf, [], 0
+    if source == target:
+        return 0.0, [origin], 0
+
+    to_target, from_source = _potentials(query,heuristic,source,target)
+
+    if not bidirectional:
+        impedance, path, settled = _astar(query['graph'],source,target,to_target)
+    else:
+        #average of the two potentials keeps both searches consistent
+        cache = {}
+        def potential(v):
+            if v not in cache:
+                cache[v] = (to_target(v) - from_source(v)) / 2
+            return cache[v]
+        impedance, path, settled = _bidirectional(query['graph'],query['reverse'],source,target,potential)
+
+    return impedance, node_ids[path].tolist(), settled
+
+def _astar(graph,source:int,target:int,to_target):
+    '''
+    Supporting function for shortest_path (one direction)
+    '''
+    indptr, indices, data = graph.indptr, graph.indices, graph.data
+    dist = {source:0.0}
+    parents = {source:None}
+    heap = [(to_target(source),source)]
+    settled = set()
+
+    while heap:
+        key, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        if u == target:
+            return dist[u], _path(parents,u)[::-1], len(settled)
+        for i in range(indptr[u],indptr[u+1]):
+            v = indices[i]
+            new = dist[u] + data[i]
+            if new < dist.get(v,np.inf):
+                dist[v] = new
+                parents[v] = u
+                heapq.heappush(heap,(new + to_target(v),v))
+
+    return np.inf, [], len(settled)
+
+def _bidirectional(graph,reverse,source:int,target:int,potential):
+    '''
+    Supporting function for shortest_path. Forward search keys are g + potential and
+    reverse search keys are g - potential, so the searches can stop once the two
+    smallest keys add up to the best path found so far.
+    '''
+    graphs = [graph,reverse]
+    dist = [{source:0.0},{target:0.0}]
+    parents = [{source:None},{target:None}]
+    sign = [1,-1]
+    heaps = [[(potential(source),source)],[(-potential(target),target)]]
+    settled = [set(),set()]
+    best, meet = np.inf, None
+
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+        #expand the search with the smaller heap
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        key, u = heapq.heappop(heaps[side])
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+
+        g = graphs[side]
+        for i in range(g.indptr[u],g.indptr[u+1]):
+            v = g.indices[i]
+            new = dist[side][u] + g.data[i]
+            if new < dist[side].get(v,np.inf):
+                dist[side][v] = new
+                parents[side][v] = u
+                heapq.heappush(heaps[side],(new + sign[side] * potential(v),v))
+            #best path through this edge
+            if (v in dist[1-side]) and (new + dist[1-side][v] < best):
+                best = new + dist[1-side][v]
+                meet = v
+
+    if meet is None:
+        return np.inf, [], len(settled[0]) + len(settled[1])
+
+    path = _path(parents[0],meet)[::-1] + _path(parents[1],meet)[1:]
+    return best, path, len(settled[0]) + len(settled[1])
+
+@instrumented()
+def route_ods(query:dict,ods:pd.DataFrame,impedance_col:str,bidirectional:bool=True,heuristic:str='euclidean'):
+    '''
+    Runs shortest_path for each od pair (snap_ods_to_network format). Adds the impedance,
+    the node list, and the number of nodes settled by the search.
+    '''
+    results = [shortest_path(query,o,d,bidirectional,heuristic) for o, d in zip(ods['o_node'],ods['d_node'])]
+    ods = ods.copy()
+    ods[impedance_col] = [x[0] if np.isfinite(x[0]) else np.nan for x in results]
+    ods['node_list'] = [x[1] for x in results]
+    ods['settled'] = [x[2] for x in results]
+    count(settled=int(ods['settled'].sum()))
+    return ods
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the network build and routing functions.
+
+Synthetic benchmarks run on square street grids with random ODs at the
+requested sizes (number of links, e.g. 1e3 to 1e7). Fixture benchmarks use
+the data shipped in the Data folder (reconciled_network.gpkg, osm_attr.pkl,
+and groceries.geojson) and ignore the sizes.
+
+Each benchmark runs in a fresh worker process so that the peak RSS is only
+for that benchmark. Results are appended as JSON lines (one per benchmark
+and size) with the git commit so runs can be compared across commits. They
+go to bench_results.jsonl in the temp folder by default (not the repo) so
+results don't end up in commits; use --output to keep them somewhere else.
+
+Example:
+    python benchmarks.py --sizes 1000 100000 --only create_graph ckdnearest
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+DATA_FP = Path(__file__).parent / 'Data'
+#files the synthetic benchmarks need on disk (e.g., the DEM for add_elevation)
+FIXTURE_FP = Path(tempfile.gettempdir()) / 'bikewaysim_bench'
+FIXTURE_FP.mkdir(exist_ok=True)
+
+#name: {'setup': function that returns the function to time, 'synthetic': uses the sizes}
+BENCHMARKS = {}
+
+def benchmark(name:str,synthetic:bool=True):
+    '''
+    Registers a benchmark. The decorated function is given the size (number of links)
+    and returns the function to time (all setup happens before it's returned).
+    '''
+    def register(func):
+        BENCHMARKS[name] = {'setup':func,'synthetic':synthetic}
+        return func
+    return register
+
+def synthetic_grid(num_links:int,spacing:float=500,crs:str='epsg:2226',seed:int=0):
+    '''
+    Makes a square street grid with about num_links links in the bikewaysim format (links
+    with A, B, linkid, highway, oneway, oneway_dir, dist, and mins and nodes with N, X, Y).
+    '''
+    rng = np.random.default_rng(seed)
+    n = max(int(np.sqrt(num_links / 2)),2)
+
+    #nodes (jittered so links aren't perfectly straight)
+    N = np.arange(n*n).reshape(n,n)
+    row, col = np.divmod(N.ravel(),n)
+    x = col * spacing + rng.normal(0,spacing/20,n*n)
+    y = row * spacing + rng.normal(0,spacing/20,n*n)
+    nodes = gpd.GeoDataFrame({'N':N.ravel(),'X':x,'Y':y},geometry=gpd.points_from_xy(x,y),crs=crs)
+
+    #horizontal and vertical links
+    A = np.concatenate([N[:,:-1].ravel(),N[:-1,:].ravel()])
+    B = np.concatenate([N[:,1:].ravel(),N[1:,:].ravel()])
+    coords = np.stack([np.stack([x[A],y[A]],axis=1),np.stack([x[B],y[B]],axis=1)],axis=1)
+    links = gpd.GeoDataFrame({
+        'A':A,
+        'B':B,
+        'linkid':np.arange(len(A)),
+        'highway':rng.choice(['residential','secondary','cycleway'],len(A),p=[0.7,0.2,0.1]),
+        'oneway':np.where(rng.random(len(A)) < 0.05,'yes',None)
+        },geometry=shapely.linestrings(coords),crs=crs)
+    links['oneway_dir'] = np.where(links['oneway'] == 'yes',1,0).astype(np.int8)
+    links['dist'] = links.length
+    links['mins'] = links['dist'] / 5280 / 8 * 60
+    links['A_B'] = links['A'].astype(str) + '_' + links['B'].astype(str)
+
+    return links, nodes
+
+def random_ods(nodes:gpd.GeoDataFrame,num_ods:int,num_origins:int=None,seed:int=0):
+    '''
+    Random OD pairs between network nodes in the snap_ods_to_network format
+    '''
+    rng = np.random.default_rng(seed)
+    origins = rng.choice(nodes['N'].to_numpy(),num_origins or num_ods)
+    ods = pd.DataFrame({'o_node':rng.choice(origins,num_ods),'d_node':rng.choice(nodes['N'].to_numpy(),num_ods)})
+    ods['ori_id'] = ods['o_node']
+    ods['dest_id'] = ods['d_node']
+    ods['trip_id'] = ods['ori_id'].astype(str) + '_' + ods['dest_id'].astype(str)
+    return ods
+
+def random_points(links:gpd.GeoDataFrame,num_points:int,seed:int=0):
+    '''
+    Random points inside the extent of the links
+    '''
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = links.total_bounds
+    x = rng.uniform(minx,maxx,num_points)
+    y = rng.uniform(miny,maxy,num_points)
+    return gpd.GeoDataFrame({'id':np.arange(num_points)},geometry=gpd.points_from_xy(x,y),crs=links.crs)
+
+# synthetic benchmarks
+
+@benchmark('ckdnearest')
+def bench_ckdnearest(size):
+    from helper_functions import ckdnearest
+    links, nodes = synthetic_grid(size)
+    points = random_points(links,max(size // 10,10))
+    nodes = nodes.rename_geometry('node_geo')
+    return lambda: ckdnearest(points,nodes)
+
+@benchmark('create_graph')
+def bench_create_graph(size):
+    from bikewaysim_lite import create_graph
+    links, nodes = synthetic_grid(size)
+    return lambda: create_graph(links,'mins')
+
+@benchmark('find_shortest')
+def bench_find_shortest(size):
+    from bikewaysim_lite import find_shortest
+    links, nodes = synthetic_grid(size)
+    ods = random_ods(nodes,1000,num_origins=20)
+    return lambda: find_shortest(links,nodes,ods,'mins')
+
+def _many_to_many(size,order):
+    '''
+    Supporting function for the many_to_many benchmarks. Node ids are shuffled (like ids
+    from an arbitrary source order), renumbered with dense_ids in the given order, and
+    a many to many search is run from 256 random origins (in id order).
+    '''
+    from prepare_network import dense_ids
+    from bikewaysim_lite import create_csr_graph
+    from scipy.sparse.csgraph import dijkstra
+    links, nodes = synthetic_grid(size)
+    shuffled = np.random.default_rng(1).permutation(len(nodes))
+    nodes['N'] = shuffled[nodes['N'].to_numpy()]
+    links['A'] = shuffled[links['A'].to_numpy()]
+    links['B'] = shuffled[links['B'].to_numpy()]
+    links, nodes = dense_ids(links,nodes,'source',order)
+    graph, node_ids = create_csr_graph(links,'mins')
+    #same origins for every order
+    origins = np.sort(nodes.set_index('source_N')['N'].reindex(np.random.default_rng(2).choice(len(nodes),min(256,len(nodes)),replace=False)).to_numpy())
+    return lambda: dijkstra(graph,directed=True,indices=np.searchsorted(node_ids,origins))
+
+@benchmark('many_to_many_source_order')
+def bench_many_to_many_source(size):
+    return _many_to_many(size,None)
+
+@benchmark('many_to_many_hilbert')
+def bench_many_to_many_hilbert(size):
+    return _many_to_many(size,'hilbert')
+
+@benchmark('many_to_many_rcm')
+def bench_many_to_many_rcm(size):
+    return _many_to_many(size,'rcm')
+
+@benchmark('largest_comp_and_simplify')
+def bench_largest_comp(size):
+    from prepare_network import largest_comp_and_simplify
+    links, nodes = synthetic_grid(size)
+    return lambda: largest_comp_and_simplify(links,nodes,simplify=True,attr_cols=['highway','oneway'])
+
+@benchmark('point_on_line')
+def bench_point_on_line(size):
+    from conflation_tools import point_on_line
+    links, nodes = synthetic_grid(size)
+    base_links = links[['A_B','geometry']].rename(columns={'A_B':'base_A_B','geometry':'base_line_geo'}).set_geometry('base_line_geo')
+    #points a few feet off the middle of random links
+    sample = links.sample(min(100,len(links)),random_state=0)
+    join_nodes = gpd.GeoDataFrame({'join_N':np.arange(len(sample))},
+                                  geometry=sample.interpolate(0.5,normalized=True).translate(5,5).values,crs=links.crs)
+    join_nodes = join_nodes.rename_geometry('join_point_geo')
+    return lambda: point_on_line(join_nodes.copy(),'join',base_links,'base',50)
+
+@benchmark('add_attributes')
+def bench_add_attributes(size):
+    from network_reconcile import add_attributes
+    links, nodes = synthetic_grid(size)
+    base_links = links[['A','B','linkid','geometry']].copy()
+    join_links = links[['A','B','linkid','highway','geometry']].rename(columns={'A':'join_A','B':'join_B','linkid':'join_linkid'})
+    join_links['geometry'] = join_links.translate(10,10)
+    return lambda: add_attributes(base_links.copy(),join_links,'join',30,True,False)
+
+def synthetic_dem(links:gpd.GeoDataFrame,fp,grade:float=0.05,cell_size:float=10):
+    '''
+    Writes a GeoTIFF covering the links where the elevation rises grade feet per foot
+    to the east (elevation = grade * x at each cell center)
+    '''
+    import rasterio
+    from rasterio.transform import from_origin
+    minx, miny, maxx, maxy = links.total_bounds + np.array([-1,-1,1,1]) * cell_size * 2
+    width, height = int(np.ceil((maxx - minx) / cell_size)), int(np.ceil((maxy - miny) / cell_size))
+    x = minx + (np.arange(width) + 0.5) * cell_size
+    elev = np.tile(grade * x,(height,1)).astype(np.float32)
+    with rasterio.open(fp,'w',driver='GTiff',width=width,height=height,count=1,dtype='float32',
+                       crs=links.crs,transform=from_origin(minx,maxy,cell_size,cell_size)) as dst:
+        dst.write(elev,1)
+
+@benchmark('add_elevation')
+def bench_add_elevation(size):
+    from elevation import add_elevation
+    links, nodes = synthetic_grid(size)
+    #the DEM is a file since the sampling workers open it by path
+    dem_fp = FIXTURE_FP / f'dem_{size}.tif'
+    synthetic_dem(links,dem_fp,grade=0.05)
+    return lambda: add_elevation(links,dem_fp,interval=100)
+
+# fixture benchmarks (shipped data)
+
+def read_fixture_network():
+    links = gpd.read_file(DATA_FP / 'networks/reconciled_network.gpkg',layer='links')
+    nodes = gpd.read_file(DATA_FP / 'networks/reconciled_network.gpkg',layer='nodes')
+    return links, nodes
+
+@benchmark('fixture_classify_links',synthetic=False)
+def bench_classify_links(size):
+    from network_filter import classify_links, OSM_LINK_TYPES
+    attr = pd.read_pickle(DATA_FP / 'networks/osm_attr.pkl')
+    return lambda: classify_links(attr.copy(),OSM_LINK_TYPES)
+
+@benchmark('fixture_add_osm_attr',synthetic=False)
+def bench_add_osm_attr(size):
+    from network_reconcile import add_osm_attr
+    links, nodes = read_fixture_network()
+    links = links[['osm_A','osm_B','osm_linkid','geometry']]
+    #the fixture is in Atlanta where unitless maxspeed tags are in mph
+    return lambda: add_osm_attr(links,DATA_FP / 'networks/osm_attr.pkl','mph')
+
+@benchmark('fixture_prepare_network',synthetic=False)
+def bench_prepare_network(size):
+    from prepare_network import prepare_network
+    links, nodes = read_fixture_network()
+    return lambda: prepare_network(links.copy(),nodes.copy(),spd_mph=8)
+
+@benchmark('fixture_snap_groceries',synthetic=False)
+def bench_snap_groceries(size):
+    from helper_functions import snap_to_network
+    from prepare_network import create_bws_nodes
+    links, nodes = read_fixture_network()
+    nodes = create_bws_nodes(nodes)
+    groceries = gpd.read_file(DATA_FP / 'groceries.geojson').to_crs(nodes.crs)
+    groceries.geometry = groceries.centroid
+    return lambda: snap_to_network(groceries[['@id','geometry']].copy(),nodes)
+
+@benchmark('fixture_grocery_routing',synthetic=False)
+def bench_grocery_routing(size):
+    import networkx as nx
+    from helper_functions import snap_to_network
+    from prepare_network import prepare_network
+    from bikewaysim_lite import create_graph
+    links, nodes = read_fixture_network()
+    links, nodes = prepare_network(links,nodes,spd_mph=8)
+    groceries = gpd.read_file(DATA_FP / 'groceries.geojson').to_crs(nodes.crs)
+    groceries.geometry = groceries.centroid
+    snapped = snap_to_network(groceries[['@id','geometry']].copy(),nodes)
+    G = create_graph(links,'dist')
+    def run():
+        for origin in snapped['N'].unique():
+            nx.single_source_dijkstra_path_length(G,origin,weight='dist')
+    return run
+
+def peak_rss_mb():
+    '''
+    Peak resident memory of this process in MB (None if it can't be found)
+    '''
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 1e6
+        except (ImportError,AttributeError):
+            return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #bytes on macOS and kilobytes on linux
+    return rss / 1e6 if sys.platform == 'darwin' else rss / 1e3
+
+def run_benchmark(name:str,size:int,repeat:int):
+    '''
+    Runs one benchmark (in a worker process) and returns the result record
+    '''
+    record = {'benchmark':name,'size':size if BENCHMARKS[name]['synthetic'] else None}
+    try:
+        start = time.perf_counter()
+        func = BENCHMARKS[name]['setup'](size)
+        record['setup_s'] = round(time.perf_counter() - start,4)
+        record['setup_rss_mb'] = peak_rss_mb()
+
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        record.update({'status':'ok','min_s':round(min(times),4),'median_s':round(float(np.median(times)),4),'repeat':repeat})
+    except Exception as e:
+        record.update({'status':'error','error':f'{type(e).__name__}: {e}','traceback':traceback.format_exc(limit=3)})
+    record['peak_rss_mb'] = peak_rss_mb()
+    return record
+
+def git_commit():
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],capture_output=True,text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the network build and routing functions.')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[1000,10000],help='number of links for the synthetic grids')
+    parser.add_argument('--only',nargs='+',default=None,help='benchmarks to run (default is all)')
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--output',type=Path,default=Path(tempfile.gettempdir()) / 'bench_results.jsonl',
+                        help='JSON lines file the results are appended to')
+    args = parser.parse_args(argv)
+
+    names = args.only if args.only is not None else list(BENCHMARKS)
+    info = {'commit':git_commit(),'run':datetime.now().isoformat(timespec='seconds'),
+            'python':platform.python_version(),'machine':platform.platform()}
+
+    #fresh interpreter for each benchmark so peak memory isn't shared
+    context = multiprocessing.get_context('spawn')
+    with args.output.open('a') as fh:
+        for name in names:
+            sizes = args.sizes if BENCHMARKS[name]['synthetic'] else [None]
+            for size in sizes:
+                with ProcessPoolExecutor(max_workers=1,mp_context=context) as executor:
+                    record = executor.submit(run_benchmark,name,size,args.repeat).result()
+                record.update(info)
+                fh.write(json.dumps(record) + '\n')
+                fh.flush()
+                print(f"{name} {size if size is not None else ''}: {record['status']} {record.get('median_s','')}")
+
+if __name__ == '__main__':
+    main()
@@ -9,14 +9,16 @@ import networkx as nx
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-from shapely.ops import MultiLineString
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+import shapely
 from tqdm import tqdm
 
-from itertools import chain
-import time
-
 from helper_functions import *
+from prepare_network import create_reverse_links, hilbert_index
+from instrument import instrumented, count
 
+@instrumented()
 def snap_ods_to_network(od_pairs:pd.DataFrame,df_nodes:gpd.GeoDataFrame):
     """
     This function takes in a dataframe of OD pairs and geodataframe of network
@@ -75,69 +77,192 @@ def snap_ods_to_network(od_pairs:pd.DataFrame,df_nodes:gpd.GeoDataFrame):
     
     return od_pairs
     
-def create_graph(links,impedance_col):
+@instrumented()
+def create_graph(links,impedance_col,wrongway_factor=None):
     '''
     Creates weighted directed network graph
+
+    If the links have a oneway_dir column (see prepare_network) an edge is added
+    for each direction. Edges going the wrong way on a oneway are left out unless
+    a wrongway_factor is given, in which case their impedance is multiplied by it.
+    Otherwise each link is added as a directed edge (networks that already have
+    reverse links). If there are several links between two nodes the one with the
+    lowest impedance is used (same as create_csr_graph and edge_graph).
     '''
+    edges = directed_edges(links,impedance_col,wrongway_factor)
+    edges = edges.sort_values(impedance_col).drop_duplicates(['A','B'])
     
     DGo = nx.DiGraph()  # create directed graph
-    for ind, row2 in links.iterrows():
-        DGo.add_weighted_edges_from([(int(row2['A']), int(row2['B']), float(row2[impedance_col]))],weight=impedance_col)   
+    DGo.add_weighted_edges_from(zip(edges['A'].astype(int),edges['B'].astype(int),edges[impedance_col].astype(float)),weight=impedance_col)
     
     return DGo
+
+def directed_edges(links,impedance_col,wrongway_factor=None):
+    '''
+    Supporting function for create_graph and create_csr_graph. Returns the directed
+    edges (A, B, impedance) following the oneway_dir rules in create_graph.
+    '''
+    if 'oneway_dir' not in links.columns:
+        return links[['A','B',impedance_col]]
+    edges = create_reverse_links(links,[impedance_col])
+    if wrongway_factor is None:
+        edges = edges[~edges['wrongway']]
+    else:
+        edges.loc[edges['wrongway'],impedance_col] = edges[impedance_col] * wrongway_factor
+    return edges
+
+@instrumented(outputs=('graph','node_ids'))
+def create_csr_graph(links,impedance_col,wrongway_factor=None):
+    '''
+    Creates the directed network graph as a scipy sparse (CSR) matrix for the
+    scipy.sparse.csgraph routines. Row/column i is the node node_ids[i] (node_ids
+    is sorted so node ids can be converted with np.searchsorted). If there are
+    several links between two nodes the one with the lowest impedance is used.
+
+    Returns the matrix and node_ids.
+    '''
+    edges = directed_edges(links,impedance_col,wrongway_factor)
+    edges = edges.sort_values(impedance_col).drop_duplicates(['A','B'])
+
+    node_ids, idx = np.unique(np.concatenate([edges['A'].to_numpy(),edges['B'].to_numpy()]),return_inverse=True)
+    a_idx, b_idx = idx[:len(edges)], idx[len(edges):]
+
+    #zero impedances would be dropped as missing edges, so use a tiny impedance instead
+    weights = np.maximum(edges[impedance_col].to_numpy(dtype=float),1e-9)
+
+    graph = csr_matrix((weights,(a_idx,b_idx)),shape=(len(node_ids),len(node_ids)))
+
+    return graph, node_ids
         
-def find_shortest(links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame,ods_:pd.DataFrame,impedance_col:str):
-    #record the starting time
-    #time_start = time.time()
-    
+def edge_graph(links,impedance_col:str,wrongway_factor:float=None,parallel:bool=False):
+    '''
+    Builds the CSR graph with one entry per directed edge so that the weights can
+    be replaced without rebuilding it. Edges are sorted by start and end node so
+    the edge between two nodes can be found with np.searchsorted on the edge keys.
+    If there are several links between two nodes the one with the lowest impedance
+    is used, unless parallel is True. Then the other links go through a split vertex
+    (an edge from A to the split vertex with the impedance and a connector edge from
+    it to B), so every link can be on a route. Split vertices are numbered after the
+    largest node id and connector edges are marked in connector.
+    '''
+    edges = directed_edges(links,impedance_col,wrongway_factor)
+    if 'link_idx' not in edges.columns:
+        edges = edges.assign(link_idx=np.arange(len(edges)))
+    edges = edges.sort_values(impedance_col)
+    extra = edges.duplicated(['A','B']).to_numpy()
+    if parallel and extra.any():
+        first_split = max(edges['A'].max(),edges['B'].max()) + 1
+        split = np.arange(first_split,first_split + extra.sum())
+        edges = pd.concat([
+            edges[~extra].assign(connector=False),
+            edges[extra].assign(B=split,connector=False),
+            edges[extra].assign(A=split,connector=True,**{impedance_col:0})
+            ],ignore_index=True)
+    else:
+        edges = edges[~extra].assign(connector=False)
+
+    node_ids = np.unique(np.concatenate([edges['A'].to_numpy(),edges['B'].to_numpy()]))
+    a_idx = np.searchsorted(node_ids,edges['A'].to_numpy())
+    b_idx = np.searchsorted(node_ids,edges['B'].to_numpy())
+    order = np.lexsort((b_idx,a_idx))
+    a_idx, b_idx = a_idx[order], b_idx[order]
+
+    indptr = np.r_[0,np.cumsum(np.bincount(a_idx,minlength=len(node_ids)))]
+    weights = np.maximum(edges[impedance_col].to_numpy(dtype=float)[order],1e-9)
+    link_idx = edges['link_idx'].to_numpy()[order]
+    connector = edges['connector'].to_numpy(dtype=bool)[order]
+
+    return {
+        'indices':b_idx.astype(np.int32),
+        'indptr':indptr.astype(np.int32),
+        'weights':weights,
+        'keys':a_idx.astype(np.int64) * len(node_ids) + b_idx,
+        'link_idx':link_idx,
+        'length':np.where(connector,0,links.length.to_numpy()[link_idx]),
+        'connector':connector,
+        'node_ids':node_ids
+        }
+
+def path_edges(graph:dict,predecessors:np.ndarray,source:int,target:int):
+    '''
+    Follows the csgraph predecessors back from the target to the source (graph positions)
+    and returns the node positions and the edge positions (in the edge_graph arrays) of
+    the path
+    '''
+    nodes = [target]
+    while nodes[-1] != source:
+        nodes.append(predecessors[nodes[-1]])
+    nodes = np.array(nodes[::-1],dtype=np.int64)
+    n = len(graph['node_ids'])
+    return nodes, np.searchsorted(graph['keys'],nodes[:-1] * n + nodes[1:])
+
+def node_path_links(graph:dict,node_path:list):
+    '''
+    Row positions in links of the edges along a path of node ids (e.g., from
+    networkx), using the edges of an edge_graph so that links stored once with a
+    oneway_dir column are found in either direction
+    '''
+    pos = np.searchsorted(graph['node_ids'],np.asarray(node_path))
+    n = len(graph['node_ids'])
+    return graph['link_idx'][np.searchsorted(graph['keys'],pos[:-1] * n + pos[1:])]
+
+@instrumented(outputs=('ods','links','nodes'))
+def find_shortest(links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame,ods_:pd.DataFrame,impedance_col:str,chunk_size:int=16):
+    '''
+    Finds the shortest route for each od pair (snap_ods_to_network format) and adds
+    link and node betweenness centrality to the links and nodes.
+
+    Routes are found on the array graph (edge_graph) from each unique origin (chunk_size
+    origins per dijkstra call) and stored as arrays of link row positions, so the
+    node and link ids are only used to look up the graph positions of the ods.
+    '''
     ods = ods_.copy()
 
     #create network graph
-    DGo = create_graph(links,impedance_col)    
-    
-    #initialize empty dicts
-    #all_impedances = {}
-    all_nodes = {}
-    all_paths = {}
-    
-    #listcheck
-    ods['tup'] = list(zip(ods.o_node,ods.d_node))
-    listcheck = set(ods['tup'].to_list())
-    
-    #from each origin find route to all other pairs
+    graph = edge_graph(links,impedance_col)
+    n = len(graph['node_ids'])
+    csr = csr_matrix((graph['weights'],graph['indices'],graph['indptr']),shape=(n,n))
+
+    #graph positions of the origin and destination nodes (-1 if not in the network)
+    o_idx = _node_position(graph['node_ids'],ods['o_node'].to_numpy())
+    d_idx = _node_position(graph['node_ids'],ods['d_node'].to_numpy())
+    routable = (o_idx >= 0) & (d_idx >= 0)
+
+    impedance = np.full(len(ods),np.nan)
+    node_paths = [np.zeros(0,dtype=np.int64)] * len(ods)
+    link_paths = [np.zeros(0,dtype=np.int64)] * len(ods)
+
     #NOTE: routing is from snapped network node, not origin node
-    for origin in tqdm(ods.o_node.unique()):
-        #run dijkstra's algorithm (no limit to links considered)
-        impedances, paths = nx.single_source_dijkstra(DGo,origin,weight=impedance_col)    
-
-        #iterate through dijkstra results to add them to ods dataframe
-        for key in impedances.keys():
-            #check if trip is in one of the ones we want
-            if (origin,key) in listcheck:
-                #for each trip id find impedance
-                ods.loc[ods['tup']==(origin,key),impedance_col] = impedances[key]
-                #all_impedances[(origin,key)] = impedances[key]
-              
-                #convert from node list to edge list
-                node_list = paths[key]
-                edge_list = [ node_list[i]+'_'+node_list[i+1] for i in range(len(node_list)-1)]
-
-                #store
-                #ods.at[ods['tup']==(origin,key),'node_list'] = node_list
-                #ods.at[ods['tup']==(origin,key),'edge_list'] = edge_list
-                
-                #for btw centrality and mapping
-                all_nodes[(origin,key)] = node_list
-                all_paths[(origin,key)] = edge_list
+    origins = np.unique(o_idx[routable])
+    #search the origins in spatial order so consecutive searches reuse the same parts of the graph
+    if ('X' in nodes.columns) and ('Y' in nodes.columns):
+        xy = nodes.set_index('N')[['X','Y']].reindex(graph['node_ids'][origins]).fillna(0)
+        origins = origins[np.argsort(hilbert_index(xy['X'].to_numpy(),xy['Y'].to_numpy()),kind='stable')]
+    #group the ods by origin once (od_order[starts[j]:ends[j]] are the ods from origins[j])
+    od_order = np.flatnonzero(routable)
+    od_order = od_order[np.argsort(o_idx[od_order],kind='stable')]
+    starts = np.searchsorted(o_idx[od_order],origins,side='left')
+    ends = np.searchsorted(o_idx[od_order],origins,side='right')
+    for start in tqdm(range(0,len(origins),chunk_size)):
+        chunk = origins[start:start+chunk_size]
+        dist, pred = dijkstra(csr,directed=True,indices=chunk,return_predecessors=True)
+        for row, origin in enumerate(chunk):
+            for i in od_order[starts[start+row]:ends[start+row]]:
+                if np.isinf(dist[row,d_idx[i]]):
+                    continue
+                impedance[i] = dist[row,d_idx[i]]
+                node_paths[i], edges = path_edges(graph,pred[row],origin,d_idx[i])
+                link_paths[i] = graph['link_idx'][edges]
+
+    ods[impedance_col] = impedance
 
     #calculate betweeness centrality
-    links, nodes = btw_centrality(all_nodes,all_paths,links,nodes,impedance_col)
+    routed = np.flatnonzero(~np.isnan(impedance))
+    node_paths = [graph['node_ids'][node_paths[i]] for i in routed]
+    links, nodes = btw_centrality(node_paths,[link_paths[i] for i in routed],links,nodes,impedance_col)
 
     #add geometry
-    all_geos = add_geo(all_paths,links)
-
-    #add to impedance df and make gdf
-    ods['geometry'] = ods['tup'].map(all_geos)
+    ods['geometry'] = add_geo(link_paths,links)
 
     #create gdf
     ods = gpd.GeoDataFrame(ods,geometry='geometry',crs=links.crs)
@@ -145,129 +270,177 @@ def find_shortest(links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame,ods_:pd.DataFram
     #get the length of the route in the units of the crs
     ods['length'] = ods.length
 
-    #drop tuple
-    ods.drop(columns=['tup'],inplace=True)
-
     #print number that can't be routed
     print(f"{ods[impedance_col].isna().sum()} trips couldnt be routed")
+    count(origins=ods['o_node'].nunique(),unrouted=int(ods[impedance_col].isna().sum()))
 
     #simplify
     ods = ods[['trip_id','ori_id','dest_id',impedance_col,'length','geometry']]
 
     return ods, links, nodes
 
-def btw_centrality(all_nodes:dict,all_paths:dict,links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame, impedance_col):
+def _node_position(node_ids:np.ndarray,values:np.ndarray):
     '''
-    Calculates link betweenness centrality
+    Position of each node id in the sorted node_ids (-1 if it isn't there)
     '''
+    idx = np.minimum(np.searchsorted(node_ids,values),len(node_ids) - 1)
+    return np.where(node_ids[idx] == values,idx,-1)
+
+@instrumented(outputs=('links','nodes'))
+def btw_centrality(node_paths:list,link_paths:list,links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame, impedance_col):
+    '''
+    Calculates link and node betweenness centrality (number of routes using each link
+    and node). node_paths are arrays of node ids and link_paths are arrays of link
+    row positions (both directions of a link count towards the same link).
+    '''
+    num_paths = len(link_paths)
+    all_links = np.concatenate(link_paths).astype(np.int64) if num_paths > 0 else np.zeros(0,dtype=np.int64)
+    all_nodes = np.concatenate(node_paths) if num_paths > 0 else np.zeros(0,dtype=np.int64)
 
-    #calculate betweenness centrality
-    node_btw_centrality = pd.Series(list(chain(*[all_nodes[key] for key in all_nodes.keys()]))).value_counts()
-    edge_btw_centrality = pd.Series(list(chain(*[all_paths[key] for key in all_paths.keys()]))).value_counts()
-    
     #add betweenness centrality as network attribute
-    nodes[f'{impedance_col}_btw_cntrlty'] = nodes['N'].map(node_btw_centrality)
-    links[f'{impedance_col}_btw_cntrlty'] = links['A_B'].map(edge_btw_centrality)
-    
-    #fill all empty with zeros
-    nodes[f'{impedance_col}_btw_cntrlty'].fillna(0,inplace=True)
-    links[f'{impedance_col}_btw_cntrlty'].fillna(0,inplace=True)
+    links[f'{impedance_col}_btw_cntrlty'] = np.bincount(all_links,minlength=len(links))
+    node_pos = pd.Index(nodes['N']).get_indexer(all_nodes)
+    nodes[f'{impedance_col}_btw_cntrlty'] = np.bincount(node_pos[node_pos >= 0],minlength=len(nodes))
 
     #what percent of trips used these links
-    nodes[f'{impedance_col}_pct_btw_cntrlty'] = nodes[f'{impedance_col}_btw_cntrlty'] / len(all_paths)#nodes[f'{impedance_col}_btw_cntrlty'].sum()
-    links[f'{impedance_col}_pct_btw_cntrlty'] = links[f'{impedance_col}_btw_cntrlty'] / len(all_paths)#links[f'{impedance_col}_btw_cntrlty'].sum()
+    nodes[f'{impedance_col}_pct_btw_cntrlty'] = nodes[f'{impedance_col}_btw_cntrlty'] / max(num_paths,1)
+    links[f'{impedance_col}_pct_btw_cntrlty'] = links[f'{impedance_col}_btw_cntrlty'] / max(num_paths,1)
 
     return links, nodes
 
-def add_geo(all_paths:dict,links:gpd.GeoDataFrame):
+def add_geo(link_paths:list,links:gpd.GeoDataFrame):
     '''
-    Takes an edge list and returns a multilinestring of the entire trip for GIS
+    Takes link row positions for each trip and returns a multilinestring of the entire
+    trip for GIS (None if the trip has no links)
     '''
+    geoms = links.geometry.to_numpy()
+    return [shapely.multilinestrings(geoms[path]) if len(path) > 0 else None for path in link_paths]
 
-    geos_dict = dict(zip(links['A_B'],links['geometry']))
-    
-    all_geos = {}
-    for key in all_paths.keys():
-        id_list = all_paths[key]
-        geos_list = [geos_dict.get(id,0) for id in id_list]
-        if geos_list != []:
-            all_geos[key] = MultiLineString(geos_list)
-
-    return all_geos
-
-def percent_detour(dist,imp,tazs):
+def align_trips(base:pd.DataFrame,alt:pd.DataFrame,keys:list=['ori_id','dest_id']):
     '''
-    Finds the percent detour and returns it as a column on the ods_imp gdf
+    Returns the position of each base trip in alt (-1 if it's missing) or None if the
+    two trip tables are already in the same order (e.g., both from find_shortest with
+    the same ods). Trips are matched on the integer origin and destination ids instead
+    of the trip_id string. Trips that share an origin and destination are matched in
+    the order they appear (the first with the first, and so on).
     '''
-    #drop the geometry col for ods_dist
-    imp = pd.merge(imp,dist[['trip_id','length']],on='trip_id',suffixes=('','_y'))
-
-    #calculate pct detour
-    imp['percent_detour'] = (imp['length'] - imp['length_y']) / imp['length_y'] * 100
-
-    #get origin taz from trip id   
-    imp['OBJECTID'] = imp['trip_id'].str.split('_',expand=True)[0]
-
-    #groupby for viz
-    by_taz = imp.groupby('OBJECTID')['percent_detour'].mean().reset_index()
+    if (len(base) == len(alt)) and all(np.array_equal(base[key].to_numpy(),alt[key].to_numpy()) for key in keys):
+        return None
+    #occurrence number makes repeated origin destination pairs unique
+    index = lambda df: pd.MultiIndex.from_frame(df[keys].assign(occurrence=df.groupby(keys,sort=False).cumcount()))
+    return index(alt).get_indexer(index(base))
 
-    #add taz geo
-    by_taz = pd.merge(by_taz,tazs,on='OBJECTID')
+def _take(values:np.ndarray,idx:np.ndarray):
+    '''
+    Supporting function for compare_trips. Reorders values with align_trips output.
+    '''
+    if idx is None:
+        return values
+    values = values[idx].astype(float)
+    values[idx == -1] = np.nan
+    return values
 
-    #round
-    by_taz['percent_detour'] = by_taz['percent_detour'].round(1)
+def zone_stats(zones:np.ndarray,values:dict,stats:list=['mean'],weights:np.ndarray=None):
+    '''
+    Summarizes trip values by zone in one groupby.
 
-    return by_taz
+    values is a dictionary of {name: array} and stats can have 'mean', 'median', 'sum',
+    'min', 'max', 'std', 'count', percentiles ('p10', 'p90', etc.), and 'weighted_mean'
+    (needs weights, e.g. number of trips). Columns are named {name}_{stat} except for
+    the mean which keeps the name. Trips with missing values are ignored.
+    '''
+    df = pd.DataFrame(values)
+    df['zone'] = zones
+    grouped = df.groupby('zone',sort=True)
+
+    by_zone = {}
+    for stat in stats:
+        if stat.startswith('p') and stat[1:].isdigit():
+            result = grouped.quantile(int(stat[1:]) / 100)
+        elif stat == 'weighted_mean':
+            if weights is None:
+                raise ValueError('weighted_mean needs weights')
+            result = {}
+            for name, value in values.items():
+                w = np.where(np.isnan(value),0,weights)
+                result[name] = pd.Series(np.nan_to_num(value) * w).groupby(zones).sum() / pd.Series(w).groupby(zones).sum()
+        else:
+            result = grouped.agg(stat)
+        for name in values:
+            by_zone[name if stat == 'mean' else f'{name}_{stat}'] = result[name]
+
+    return pd.DataFrame(by_zone)
+
+def compare_trips(base:pd.DataFrame,alt:pd.DataFrame,col:str,zone_col:str='ori_id',how:str='difference'):
+    '''
+    Compares a column between two trip tables (from find_shortest) and returns the
+    zone ids and the difference (alt - base) or percent change ((alt - base) / base * 100)
+    for every trip in base.
+    '''
+    idx = align_trips(base,alt)
+    base_values = base[col].to_numpy(dtype=float)
+    alt_values = _take(alt[col].to_numpy(dtype=float),idx)
+    if how == 'percent':
+        with np.errstate(divide='ignore',invalid='ignore'):
+            change = (alt_values - base_values) / base_values * 100
+    else:
+        change = alt_values - base_values
+    return base[zone_col].to_numpy(), change
+
+def _add_zone_geo(by_zone:pd.DataFrame,tazs:gpd.GeoDataFrame,taz_id:str):
+    '''
+    Supporting function for percent_detour and impedance_change
+    '''
+    if tazs is None:
+        return by_zone.rename_axis(taz_id).reset_index()
+    return tazs.merge(by_zone,left_on=taz_id,right_index=True)
 
-def impedance_change(imp,improved,tazs,impedance_col):
+def percent_detour(dist,imp,tazs,zone_col:str='ori_id',taz_id:str='OBJECTID',stats:list=['mean'],weights:np.ndarray=None):
     '''
-    Finds the percent detour and returns it as a column on the ods_imp gdf
+    Finds the percent detour of each trip (route length with the impedance vs the
+    shortest distance route) and summarizes it by origin zone (zone_col of the trips,
+    which matches taz_id in tazs). Returns the tazs with the stats (see zone_stats)
+    or a DataFrame of stats if tazs is None.
     '''
-    #drop the geometry cols
-    imp = pd.merge(imp[['trip_id',impedance_col]],improved[['trip_id',impedance_col]],on='trip_id',suffixes=('','_y'))
+    zones, detour = compare_trips(dist,imp,'length',zone_col,how='percent')
 
-    #calculate impedance change
-    imp['imp_change'] = (imp[impedance_col] - imp[impedance_col+'_y'])
+    by_zone = zone_stats(zones,{'percent_detour':detour},stats,weights).round(1)
 
-    #get origin taz from trip id   
-    imp['OBJECTID'] = imp['trip_id'].str.split('_',expand=True)[0]
+    return _add_zone_geo(by_zone,tazs,taz_id)
 
-    #groupby for viz
-    by_taz = imp.groupby('OBJECTID')['imp_change'].mean().reset_index()
+def impedance_change(imp,improved,tazs,impedance_col,zone_col:str='ori_id',taz_id:str='OBJECTID',stats:list=['mean'],weights:np.ndarray=None):
+    '''
+    Finds the change in impedance of each trip after improvements (imp - improved)
+    and summarizes it by origin zone like percent_detour
+    '''
+    zones, change = compare_trips(improved,imp,impedance_col,zone_col)
 
-    #add taz geo
-    by_taz = pd.merge(by_taz,tazs,on='OBJECTID')
+    by_zone = zone_stats(zones,{'imp_change':change},stats,weights)
 
-    return by_taz
+    return _add_zone_geo(by_zone,tazs,taz_id)
 
 
+@instrumented(outputs=('links','nodes'))
 def make_bikeshed(links_c,nodes,origin,radius,buffer_size,impedance_col):
     '''
-    Get the bikeshed for an origin
+    Get the bikeshed for an origin (links between nodes reachable within radius)
     '''
 
     links = links_c.copy()
 
-    #turn links into directed graph
-    DGo = create_graph(links,impedance_col)
-    
-    #create bikeshed
-    #https://networkx.org/documentation/stable/reference/generated/networkx.generators.ego.ego_graph.html
-    #https://geonetworkx.readthedocs.io/en/latest/5_Isochrones.html
-    bikeshed = nx.ego_graph(DGo, radius=radius, n=origin, distance=impedance_col)
-            
-    #make column for cleaner merging
-    links['A_B_tup'] = list(zip(links['A'],links['B']))
-
-    #get all the links that contained in the egograph
-    bikeshed = links.loc[links['A_B_tup'].isin(list(bikeshed.edges)),:]
+    #search outward from the origin until the radius is reached
+    graph, node_ids = create_csr_graph(links,impedance_col)
+    source = _node_position(node_ids,np.array([origin]))[0]
+    reached = np.isfinite(dijkstra(graph,directed=True,indices=source,limit=radius)) if source >= 0 else np.zeros(len(node_ids),dtype=bool)
+
+    #get all the links with both ends in the bikeshed
+    a_idx = _node_position(node_ids,links['A'].to_numpy())
+    b_idx = _node_position(node_ids,links['B'].to_numpy())
+    inside = (a_idx >= 0) & (b_idx >= 0) & reached[a_idx] & reached[b_idx]
+    bikeshed = links.loc[inside,:]
     bikeshed_node = nodes.loc[nodes['N']==origin,:]
     
-    #drop tuple column
-    bikeshed.drop(columns=['A_B_tup'],inplace=True)
-    
     #drop dual links to get accurate size
-    #TODO fix this
     df_dup = drop_duplicate_links(bikeshed)
     
     print(f'---{origin}---')
@@ -279,5 +452,5 @@ def make_bikeshed(links_c,nodes,origin,radius,buffer_size,impedance_col):
 def drop_duplicate_links(links):
     #drops the additional two way link needed for network routing
     df_dup = pd.DataFrame(np.sort(links[["A","B"]], axis=1), columns=["A","B"], index = links.index).duplicated()
-    links = links[df_dup]
+    links = links[~df_dup]
     return links
\ No newline at end of file
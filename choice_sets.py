@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Route choice set generation for route choice modelling.
+
+Alternatives for each trip are made by repeated shortest path searches on an
+array (CSR) graph whose weights are changed between searches:
+    link_penalty: the impedance of links on the routes found so far is
+        multiplied by (1 + penalty) before the next search
+    link_elimination: each link of the shortest route is removed in turn
+    simulation: the impedances are multiplied by random lognormal factors
+
+The graph keeps parallel links (e.g., a sidepath next to the road between the
+same two nodes) through split vertices (see edge_graph), so they can be
+alternatives and a removed link falls back to its parallel link.
+
+Routes are stored as arrays of link positions (row positions in links) and
+each route gets a path size factor (how much it overlaps with the other
+routes in its choice set) for path size logit models:
+    PS_i = sum over links a in route i of (length_a / length_i) / (routes using a)
+
+Trips are split into chunks and run in parallel worker processes.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from concurrent.futures import ProcessPoolExecutor
+
+from bikewaysim_lite import edge_graph, path_edges
+from instrument import instrumented
+
+#removed links get this impedance (csgraph treats missing entries as no edge but the graph structure is reused)
+REMOVED = 1e12
+
+def _search(graph:dict,weights:np.ndarray,source:int,target:int):
+    '''
+    Supporting function for trip_choice_set. Returns the edge positions of the
+    shortest path (None if there isn't one).
+    '''
+    n = len(graph['node_ids'])
+    csr = csr_matrix((weights,graph['indices'],graph['indptr']),shape=(n,n))
+    dist, pred = dijkstra(csr,directed=True,indices=source,return_predecessors=True)
+    if not np.isfinite(dist[target]) or dist[target] >= REMOVED:
+        return None
+    return path_edges(graph,pred,source,target)[1]
+
+def path_size(routes:list,length:np.ndarray):
+    '''
+    Path size factors for the routes of one choice set (routes are arrays of link
+    positions and length is the length of each link position)
+    '''
+    route_id = np.repeat(np.arange(len(routes)),[len(x) for x in routes])
+    route_links = np.concatenate(routes)
+    #number of routes that use each link
+    _, inverse, counts = np.unique(route_links,return_inverse=True,return_counts=True)
+    link_length = length[route_links]
+    route_length = np.bincount(route_id,weights=link_length,minlength=len(routes))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ps = np.bincount(route_id,weights=link_length / counts[inverse.ravel()],minlength=len(routes)) / route_length
+    return np.nan_to_num(ps,nan=1.0)
+
+def trip_choice_set(graph:dict,origin,destination,method:str='link_penalty',num_routes:int=10,max_iter:int=None,
+                    penalty:float=0.5,max_detour:float=None,seed:int=0,sigma:float=0.3):
+    '''
+    Generates the choice set for one trip. Returns a list of unique routes (arrays of
+    edge positions, including split vertex connectors) with the shortest route first.
+    max_detour drops routes whose impedance is more than max_detour times the shortest
+    route.
+    '''
+    node_ids = graph['node_ids']
+    source, target = np.searchsorted(node_ids,[origin,destination])
+    if (source >= len(node_ids)) or (target >= len(node_ids)) or (node_ids[source] != origin) or (node_ids[target] != destination) or (source == target):
+        return []
+
+    base = graph['weights']
+    shortest = _search(graph,base,source,target)
+    if shortest is None:
+        return []
+    routes = [shortest]
+    seen = {shortest.tobytes()}
+    limit = base[shortest].sum() * max_detour if max_detour is not None else np.inf
+    max_iter = max_iter or num_routes * 3
+
+    rng = np.random.default_rng(seed)
+    weights = base.copy()
+    #both directions of a link are penalized/removed together
+    same_link = graph['link_idx']
+    shortest_links = same_link[shortest[~graph['connector'][shortest]]]
+
+    for i in range(max_iter):
+        if len(routes) >= num_routes:
+            break
+        if method == 'link_penalty':
+            used = np.isin(same_link,same_link[routes[-1]])
+            weights[used] *= (1 + penalty)
+            trial = weights
+        elif method == 'link_elimination':
+            if i >= len(shortest_links):
+                break
+            trial = base.copy()
+            trial[same_link == shortest_links[i]] = REMOVED
+        elif method == 'simulation':
+            trial = base * rng.lognormal(0,sigma,len(base))
+        else:
+            raise ValueError(f'Unknown choice set method {method}')
+
+        route = _search(graph,trial,source,target)
+        if (route is None) or (route.tobytes() in seen) or (base[route].sum() > limit):
+            continue
+        seen.add(route.tobytes())
+        routes.append(route)
+
+    return routes
+
+_GRAPH = None
+
+def _init_worker(graph:dict):
+    global _GRAPH
+    _GRAPH = graph
+
+def _choice_set_chunk(trips:list,kwargs:dict):
+    '''
+    Supporting function for choice_sets (runs in a worker process)
+    '''
+    graph = _GRAPH
+    rows = []
+    for trip_id, origin, destination in trips:
+        routes = trip_choice_set(graph,origin,destination,**kwargs)
+        if len(routes) == 0:
+            continue
+        ps = path_size(routes,graph['length'])
+        for alt, (route, factor) in enumerate(zip(routes,ps)):
+            route = route[~graph['connector'][route]]
+            rows.append((trip_id,alt,graph['weights'][route].sum(),graph['length'][route].sum(),
+                         graph['link_idx'][route].astype(np.int32),factor))
+    return rows
+
+@instrumented()
+def choice_sets(links,ods:pd.DataFrame,impedance_col:str,method:str='link_penalty',num_routes:int=10,
+                workers:int=None,chunk_size:int=50,wrongway_factor:float=None,linkid_col:str='linkid',**kwargs):
+    '''
+    Generates choice sets for the ods (snap_ods_to_network format) in parallel.
+    kwargs go to trip_choice_set (max_iter, penalty, max_detour, seed, sigma).
+
+    Returns one row per route with trip_id, alt (0 is the shortest route), the
+    impedance and length of the route, linkid (array of the link ids in linkid_col
+    in route order), link_idx (the same links as row positions in links), and path_size.
+    '''
+    graph = edge_graph(links,impedance_col,wrongway_factor,parallel=True)
+    kwargs.update({'method':method,'num_routes':num_routes})
+
+    trips = list(zip(ods['trip_id'],ods['o_node'],ods['d_node']))
+    chunks = [trips[i:i+chunk_size] for i in range(0,len(trips),chunk_size)]
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,initargs=(graph,)) as executor:
+        for result in executor.map(_choice_set_chunk,chunks,[kwargs]*len(chunks)):
+            rows += result
+
+    routes = pd.DataFrame(rows,columns=['trip_id','alt',impedance_col,'length','link_idx','path_size'])
+    link_ids = links[linkid_col].to_numpy()
+    routes.insert(4,'linkid',[link_ids[x] for x in routes['link_idx']])
+    print(f"{routes['trip_id'].nunique()} of {len(ods)} trips have routes ({round(routes.groupby('trip_id').size().mean(),1)} routes per trip)")
+
+    return routes
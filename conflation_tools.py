@@ -21,6 +21,7 @@ import networkx as nx
 from tqdm import tqdm
 
 from helper_functions import ckdnearest
+from network_io import write_layers
 
 def rename_geo(gdf:gpd.GeoDataFrame,name:str,type:str):
     '''
@@ -153,8 +154,7 @@ def match_nodes(base_nodes:gpd.GeoDataFrame, base_name:str, join_nodes:gpd.GeoDa
                                         f"{join_name}_N":matched_nodes[f"{join_name}_N"],
                                         "geometry":error_lines_geo}, geometry = "geometry")
         #export it to file
-        error_lines.to_file(
-            rf'processed_shapefiles/conflation/node_matching/{base_name}_to_{join_name}_{tolerance_ft}ft.gpkg', layer='errorlines', driver = 'GPKG')
+        write_layers({'errorlines':error_lines},rf'processed_shapefiles/conflation/node_matching/{base_name}_to_{join_name}_{tolerance_ft}ft.gpkg')
     
     #filter matched nodes
     matched_nodes = matched_nodes[[f'{base_name}_N',f'{join_name}_N_new']]
@@ -177,8 +177,8 @@ def match_nodes(base_nodes:gpd.GeoDataFrame, base_name:str, join_nodes:gpd.GeoDa
     
     if export_unmatched == True:
         #export
-        unmatched_base_nodes.to_file(rf'processed_shapefiles/conflation/node_matching/{base_name}_to_{join_name}_{tolerance_ft}ft.gpkg', layer='unmatched_base_nodes', driver = 'GPKG')
-        unmatched_join_nodes.to_file(rf'processed_shapefiles/conflation/node_matching/{base_name}_to_{join_name}_{tolerance_ft}ft.gpkg', layer='unmatched_join_nodes', driver = 'GPKG')
+        write_layers({'unmatched_base_nodes':unmatched_base_nodes,'unmatched_join_nodes':unmatched_join_nodes},
+                     rf'processed_shapefiles/conflation/node_matching/{base_name}_to_{join_name}_{tolerance_ft}ft.gpkg')
 
     #get number of matched nodes
     num_matches = (-(base_nodes[f'{join_name}_N'].isnull())).sum()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Adds elevation and grade attributes to network links from a local DEM (GeoTIFF).
+
+Points are placed along every link at a fixed interval and the DEM is sampled at
+those points one tile at a time, reading only the raster window that covers the
+tile (the full DEM is never loaded). Tiles are sampled in parallel.
+
+Grades are calculated for both directions of each link. Columns for travel from
+A to B have no suffix and columns for travel from B to A end in "_ba", which
+create_reverse_links uses for the reverse edges, so impedances can depend on
+the direction of travel:
+    elev_A, elev_B: elevation at the start and end of the link
+    ascent_ft, ascent_ft_ba: total climb
+    up_grade, up_grade_ba: total climb / link length (percent)
+    max_grade, max_grade_ba: steepest uphill grade between sample points (percent)
+"""
+
+import math
+import numpy as np
+import pandas as pd
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+
+from instrument import instrumented
+
+def sample_points(links,interval:float):
+    '''
+    Places points along each link every interval (in CRS units) including both ends.
+    Returns the position of the link each point belongs to, the distance of the point
+    along the link, and the x and y coordinates of the points. Points are ordered by
+    link and then by distance.
+    '''
+    geoms = links.geometry.to_numpy()
+    lengths = shapely.length(geoms)
+    num_points = np.maximum(np.ceil(lengths / interval).astype(int),1) + 1
+
+    link_pos = np.repeat(np.arange(len(links)),num_points)
+    #position of each point within its link (0,1,2,...)
+    starts = np.cumsum(num_points) - num_points
+    step = np.arange(len(link_pos)) - np.repeat(starts,num_points)
+    #last point is always the end of the link
+    distance = np.minimum(step * interval,np.repeat(lengths,num_points))
+
+    points = shapely.line_interpolate_point(geoms[link_pos],distance)
+    coords = shapely.get_coordinates(points)
+
+    return link_pos, distance, coords[:,0], coords[:,1]
+
+def _sample_tile(dem_fp,x:np.ndarray,y:np.ndarray,band:int=1):
+    '''
+    Supporting function for sample_dem (runs in a worker process). Reads the raster
+    window that covers the points and returns the elevation of the cell each point
+    falls in (NaN for nodata or points outside the raster).
+    '''
+    import rasterio
+    from rasterio.windows import from_bounds, Window
+
+    with rasterio.open(dem_fp) as src:
+        window = from_bounds(x.min(),y.min(),x.max(),y.max(),src.transform)
+        #whole cells padded by one so points on the edge are inside
+        col_off, row_off = math.floor(window.col_off) - 1, math.floor(window.row_off) - 1
+        width = math.ceil(window.col_off + window.width) + 1 - col_off
+        height = math.ceil(window.row_off + window.height) + 1 - row_off
+        window = Window(col_off,row_off,width,height)
+        data = src.read(band,window=window,boundless=True,masked=True).astype(float).filled(np.nan)
+        inverse = ~src.window_transform(window)
+
+    col = np.floor(inverse.a * x + inverse.b * y + inverse.c).astype(int)
+    row = np.floor(inverse.d * x + inverse.e * y + inverse.f).astype(int)
+    inside = (row >= 0) & (row < data.shape[0]) & (col >= 0) & (col < data.shape[1])
+
+    elev = np.full(len(x),np.nan)
+    elev[inside] = data[row[inside],col[inside]]
+    return elev
+
+@instrumented()
+def sample_dem(dem_fp,x:np.ndarray,y:np.ndarray,crs=None,tile_size:float=10000,workers:int=None):
+    '''
+    Samples the DEM at the given coordinates. Points are grouped into square tiles
+    (tile_size in the units of the points' crs) and each tile is sampled in a worker
+    process. If crs is given and doesn't match the DEM, the points are reprojected.
+    '''
+    import rasterio
+    with rasterio.open(dem_fp) as src:
+        dem_crs = src.crs
+
+    #tiles are made in the original crs so that tile_size is in those units
+    tile_x = np.floor(x / tile_size).astype(np.int64)
+    tile_y = np.floor(y / tile_size).astype(np.int64)
+    _, tile = np.unique(np.stack([tile_x,tile_y],axis=1),axis=0,return_inverse=True)
+    tile = tile.ravel()
+
+    if (crs is not None) and (dem_crs is not None) and (dem_crs != crs):
+        from pyproj import Transformer
+        x, y = Transformer.from_crs(crs,dem_crs,always_xy=True).transform(x,y)
+
+    order = np.argsort(tile,kind='stable')
+    splits = np.flatnonzero(np.diff(tile[order])) + 1
+    groups = np.split(order,splits)
+
+    elev = np.full(len(x),np.nan)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_sample_tile,dem_fp,x[idx],y[idx]) for idx in groups]
+        for idx, future in zip(groups,futures):
+            elev[idx] = future.result()
+
+    return elev
+
+def grade_stats(link_pos:np.ndarray,distance:np.ndarray,elev:np.ndarray,num_links:int,min_length:float=0):
+    '''
+    Calculates the elevation and grade columns (see module docstring) from the
+    sampled elevations. Segments with a missing elevation at either end are left out
+    of the length, ascent, descent, and grades (so links that partly leave the DEM
+    get the grades of the part on it). Segments shorter than min_length (e.g., the
+    leftover bit at the end of a link) aren't used for the max grades unless they're
+    the only segment on the link, since DEM cell steps make their grades unrealistic.
+    '''
+    #segments between consecutive points on the same link
+    same_link = link_pos[1:] == link_pos[:-1]
+    seg_link = link_pos[1:][same_link]
+    dz = np.diff(elev)[same_link]
+    dd = np.diff(distance)[same_link]
+    valid = ~np.isnan(dz)
+    seg_link, dz, dd = seg_link[valid], dz[valid], dd[valid]
+
+    length = np.bincount(seg_link,weights=dd,minlength=num_links)
+    ascent = np.bincount(seg_link,weights=np.maximum(dz,0),minlength=num_links)
+    descent = np.bincount(seg_link,weights=np.maximum(-dz,0),minlength=num_links)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        seg_grade = np.where(dd > 0,dz / dd * 100,0)
+        up_grade = np.where(length > 0,ascent / length * 100,0)
+        down_grade = np.where(length > 0,descent / length * 100,0)
+
+    only_segment = np.bincount(seg_link,minlength=num_links)[seg_link] == 1
+    seg_grade = np.where((dd >= min_length) | only_segment,seg_grade,0)
+
+    max_grade = pd.Series(seg_grade).groupby(seg_link).max().reindex(range(num_links),fill_value=0).to_numpy()
+    max_grade_ba = pd.Series(-seg_grade).groupby(seg_link).max().reindex(range(num_links),fill_value=0).to_numpy()
+
+    #first and last points of each link
+    starts = np.flatnonzero(np.r_[True,~same_link])
+    ends = np.r_[starts[1:] - 1,len(link_pos) - 1]
+
+    return pd.DataFrame({
+        'elev_A':elev[starts],
+        'elev_B':elev[ends],
+        'ascent_ft':ascent,
+        'ascent_ft_ba':descent,
+        'up_grade':up_grade.round(2),
+        'up_grade_ba':down_grade.round(2),
+        'max_grade':np.maximum(max_grade,0).round(2),
+        'max_grade_ba':np.maximum(max_grade_ba,0).round(2)
+        })
+
+@instrumented()
+def add_elevation(links,dem_fp,interval:float=100,z_factor:float=1,tile_size:float=10000,workers:int=None):
+    '''
+    Adds the elevation and grade columns to the links using a DEM. interval is the
+    sampling distance in CRS units (feet for the bikewaysim networks) and z_factor
+    converts the DEM elevations to the same units (e.g. 3.28084 for a DEM in meters
+    when the CRS is in feet).
+    '''
+    link_pos, distance, x, y = sample_points(links,interval)
+    elev = sample_dem(dem_fp,x,y,links.crs,tile_size,workers) * z_factor
+
+    stats = grade_stats(link_pos,distance,elev,len(links),interval / 2)
+    stats.index = links.index
+
+    links = links.drop(columns=[x for x in stats.columns if x in links.columns])
+    links = links.join(stats)
+
+    print(f"{np.isnan(elev).sum()} of {len(elev)} sample points had no elevation")
+
+    return links
+
+def add_grade_mins(links,spd_mph:float,climb_ft_per_min:float=50):
+    '''
+    Replaces mins with a travel time that includes climbing. Each foot of ascent
+    adds 1 / climb_ft_per_min minutes on top of the flat travel time. Adds mins_ba
+    for travel from B to A (used for the reverse edges in create_graph).
+    Assumes the CRS units are feet.
+    '''
+    flat = links.length / 5280 / spd_mph * 60
+    links['mins'] = (flat + links['ascent_ft'] / climb_ft_per_min).round(2)
+    links['mins_ba'] = (flat + links['ascent_ft_ba'] / climb_ft_per_min).round(2)
+    return links
@@ -1,7 +1,7 @@
 from scipy.spatial import cKDTree
 import numpy as np
 import pandas as pd
-import time
+from instrument import instrumented
 
 #take in two geometry columns and find nearest gdB point from each
 #point in gdA. Returns the matching distance too.
@@ -28,10 +28,8 @@ def ckdnearest(gdA, gdB, return_dist=True):
     return gdf
 
 
+@instrumented()
 def snap_to_network(to_snap,network_nodes_raw):
-    #record the starting time
-    time_start = time.time()
-    
     #create copy of network nodes
     network_nodes = network_nodes_raw.copy()
     
@@ -50,5 +48,4 @@ def snap_to_network(to_snap,network_nodes_raw):
     #drop geo column
     snapped_nodes.drop(columns=['original'],inplace=True)
     
-    print(f'snapping took {round(((time.time() - time_start)/60), 2)} minutes')
     return snapped_nodes
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and memory instrumentation for the network build and routing functions.
+
+Functions decorated with instrumented (or code wrapped in a stage block)
+record an event with the wall time, CPU time, peak memory (when memory
+tracking is on), and row/edge counts of what they returned. Events are sent
+to every sink in SINKS:
+    PrintSink: prints the stage and how long it took
+    JSONLinesSink: appends each event as a line of JSON to a file
+    MemorySink: keeps the events in a list
+
+There are no sinks by default (instrumented functions include per-trip helpers
+that would print on every call), so nothing is measured and instrumented
+functions only pay for one list check until sinks are added with configure.
+Memory tracking uses tracemalloc, which slows Python code down noticeably, so
+it's off unless turned on with configure.
+
+Examples:
+    import instrument
+    #print how long each stage took
+    instrument.configure(sinks=[instrument.PrintSink()])
+    #or log the events with peak memory
+    instrument.configure(sinks=[instrument.JSONLinesSink('events.jsonl')],memory=True)
+"""
+
+import json
+import time
+import tracemalloc
+from functools import wraps
+from datetime import datetime
+
+class PrintSink:
+    '''
+    Prints a line for each event
+    '''
+    def __call__(self,event):
+        counts = ', '.join(f'{key}: {value}' for key, value in event['counts'].items())
+        memory = f", {event['peak_mb']} MB peak" if event.get('peak_mb') is not None else ''
+        print(f"{event['stage']} took {event['wall_s']} seconds ({event['cpu_s']} cpu{memory})" + (f' [{counts}]' if counts else ''))
+
+class JSONLinesSink:
+    '''
+    Appends each event to a JSON lines file (works across worker processes)
+    '''
+    def __init__(self,fp):
+        self.fp = fp
+    def __call__(self,event):
+        with open(self.fp,'a') as fh:
+            fh.write(json.dumps(event,default=str) + '\n')
+
+class MemorySink:
+    '''
+    Keeps the events in a list
+    '''
+    def __init__(self):
+        self.events = []
+    def __call__(self,event):
+        self.events.append(event)
+
+SINKS = []
+TRACK_MEMORY = False
+
+#stages that are currently running (innermost last)
+_STACK = []
+
+def configure(sinks:list=None,memory:bool=None):
+    '''
+    Sets the sinks (an empty list turns instrumentation off) and whether peak memory is tracked
+    '''
+    global TRACK_MEMORY
+    if sinks is not None:
+        SINKS[:] = sinks
+    if memory is not None:
+        TRACK_MEMORY = memory
+
+def enabled():
+    return len(SINKS) > 0
+
+def _count(obj):
+    '''
+    Number of rows in a table or edges in a graph (None for anything else)
+    '''
+    if hasattr(obj,'number_of_edges'):
+        return obj.number_of_edges()
+    if hasattr(obj,'shape') and hasattr(obj,'columns'):
+        return obj.shape[0]
+    return None
+
+class stage:
+    '''
+    Context manager that measures a block of code and emits an event when it's done.
+    Counts can be added with .count(name=value) or the module level count function.
+
+    Set measure to True to measure even when there are no sinks (the event is still
+    available as .event afterwards) and memory to True/False to override TRACK_MEMORY.
+    '''
+    def __init__(self,name:str,memory:bool=None,measure:bool=False):
+        self.name = name
+        self.active = measure or enabled()
+        self.memory = TRACK_MEMORY if memory is None else memory
+        self.counts = {}
+        self.event = None
+
+    def count(self,**counts):
+        self.counts.update(counts)
+
+    def __enter__(self):
+        if not self.active:
+            return self
+        self.parent = _STACK[-1].name if len(_STACK) > 0 else None
+        _STACK.append(self)
+
+        if self.memory:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            #keep the peak of the enclosing stage before resetting it for this one
+            current, peak = tracemalloc.get_traced_memory()
+            for outer in _STACK[:-1]:
+                outer.peak_seen = max(getattr(outer,'peak_seen',0),peak)
+            tracemalloc.reset_peak()
+            self.start_mem = current
+            self.peak_seen = 0
+
+        self.start_cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        if not self.active:
+            return False
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.start_cpu
+        _STACK.remove(self)
+
+        self.event = {'stage':self.name,'parent':self.parent,'wall_s':round(wall,4),'cpu_s':round(cpu,4),
+                      'peak_mb':None,'counts':self.counts,'status':'ok' if exc_type is None else exc_type.__name__,
+                      'finished':datetime.now().isoformat(timespec='seconds')}
+
+        if self.memory and tracemalloc.is_tracing():
+            peak = max(self.peak_seen,tracemalloc.get_traced_memory()[1])
+            self.event['peak_mb'] = round((peak - self.start_mem) / 1e6,2)
+            for outer in _STACK:
+                outer.peak_seen = max(getattr(outer,'peak_seen',0),peak)
+            if self.started_tracing:
+                tracemalloc.stop()
+
+        for sink in SINKS:
+            sink(self.event)
+        return False
+
+def count(**counts):
+    '''
+    Adds counts to the innermost running stage (does nothing when instrumentation is off)
+    '''
+    if len(_STACK) > 0:
+        _STACK[-1].count(**counts)
+
+def instrumented(name:str=None,outputs:tuple=None):
+    '''
+    Decorator that runs the function in a stage. The number of rows/edges of what the
+    function returns is added to the counts. outputs names the items of a returned tuple
+    (e.g. ('links','nodes')) otherwise the count is called 'rows' (or 'edges' for graphs).
+    '''
+    def decorate(func):
+        stage_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args,**kwargs):
+            if not enabled():
+                return func(*args,**kwargs)
+            with stage(stage_name) as s:
+                result = func(*args,**kwargs)
+                if isinstance(result,tuple):
+                    names = outputs or [f'rows_{i}' for i in range(len(result))]
+                    s.count(**{key:_count(x) for key, x in zip(names,result) if _count(x) is not None})
+                elif _count(result) is not None:
+                    s.count(**{'edges' if hasattr(result,'number_of_edges') else 'rows':_count(result)})
+            return result
+        return wrapper
+    return decorate
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for routing_service.py.
+
+Opens a number of keep alive connections to the service and sends random
+requests for a fixed amount of time, then prints requests per second and
+latency percentiles. Node ids come from the service's /info endpoint.
+
+    python load_test.py --port 8765 --concurrency 32 --duration 10 --endpoint route
+    python load_test.py --endpoint matrix --matrix-size 10 --repeat 0.5
+
+repeat is the share of requests that reuse an earlier query (hot queries
+answered from the service cache).
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+async def request(reader,writer,path:str,body:dict=None):
+    payload = json.dumps(body or {}).encode()
+    writer.write((f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                  f'Content-Length: {len(payload)}\r\n\r\n').encode() + payload)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n',b'\n',b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+def make_body(endpoint:str,rng,nodes:list,matrix_size:int,budget:float):
+    if endpoint == 'route':
+        o, d = rng.choice(nodes,2,replace=False)
+        return {'origin':int(o),'destination':int(d)}
+    if endpoint == 'matrix':
+        return {'origins':rng.choice(nodes,matrix_size).tolist(),'destinations':rng.choice(nodes,matrix_size).tolist()}
+    if endpoint == 'bikeshed':
+        return {'origin':int(rng.choice(nodes)),'budget':budget}
+    raise ValueError(f'Unknown endpoint {endpoint}')
+
+async def client(host:str,port:int,endpoint:str,stop:float,nodes:list,seed:int,repeat:float,matrix_size:int,budget:float):
+    '''
+    Sends requests one after another on one connection until stop. Returns the
+    latencies (seconds) and the number of errors.
+    '''
+    rng = np.random.default_rng(seed)
+    reader, writer = await asyncio.open_connection(host,port)
+    latencies, errors, sent = [], 0, []
+    while time.perf_counter() < stop:
+        if sent and rng.random() < repeat:
+            body = sent[rng.integers(len(sent))]
+        else:
+            body = make_body(endpoint,rng,nodes,matrix_size,budget)
+            sent.append(body)
+        start = time.perf_counter()
+        status, _ = await request(reader,writer,f'/{endpoint}',body)
+        latencies.append(time.perf_counter() - start)
+        errors += status != 200
+    writer.close()
+    return latencies, errors
+
+async def run(host:str,port:int,endpoint:str,concurrency:int,duration:float,repeat:float,matrix_size:int,budget:float):
+    reader, writer = await asyncio.open_connection(host,port)
+    _, info = await request(reader,writer,'/info')
+    writer.close()
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[client(host,port,endpoint,start + duration,info['sample_nodes'],seed,repeat,matrix_size,budget)
+                                     for seed in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies = np.concatenate([x[0] for x in results]) * 1000
+    errors = sum(x[1] for x in results)
+    print(f'{endpoint}: {len(latencies)} requests in {round(elapsed,1)} seconds with {concurrency} connections ({errors} errors)')
+    print(f'{round(len(latencies) / elapsed,1)} requests per second')
+    print('latency ms: ' + ', '.join(f'p{p} {round(np.percentile(latencies,p),2)}' for p in [50,95,99]))
+
+    reader, writer = await asyncio.open_connection(host,port)
+    _, info = await request(reader,writer,'/info')
+    writer.close()
+    print(info['stats'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for routing_service.py')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8765)
+    parser.add_argument('--endpoint',default='route',choices=['route','matrix','bikeshed'])
+    parser.add_argument('--concurrency',type=int,default=32)
+    parser.add_argument('--duration',type=float,default=10)
+    parser.add_argument('--repeat',type=float,default=0,help='share of requests that repeat an earlier query')
+    parser.add_argument('--matrix-size',type=int,default=10)
+    parser.add_argument('--budget',type=float,default=5280)
+    args = parser.parse_args()
+    asyncio.run(run(args.host,args.port,args.endpoint,args.concurrency,args.duration,args.repeat,args.matrix_size,args.budget))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Level of traffic stress (LTS) for the reconciled/final network links.
+
+Each link gets an LTS from 1 (comfortable for most people) to 4 (only for
+confident riders) using a criteria table (LTS_CRITERIA) based on the bike
+facility, speed limit, and number of lanes. The first criteria row a link
+matches sets its LTS, like the link type rules in network_filter.classify_links.
+
+Missing speed limits and lane counts are imputed from the HERE functional class
+(if the links have FUNC_CLASS) and then from the osm highway tag. Imputed links
+are marked in lts_imputed.
+
+The lts1-lts4 indicator columns can be used as link_costs attributes, e.g.
+    costs = {'lts3':0.5,'lts4':2,'mu':-0.2}
+"""
+
+import numpy as np
+import pandas as pd
+
+from prepare_network import node_components
+from network_reconcile import here_func_class
+from instrument import instrumented
+
+#columns used for the criteria ({name in the criteria: link column})
+LTS_COLUMNS = {
+    'bl':'osm_bl',
+    'pbl':'osm_pbl',
+    'mu':'osm_mu',
+    'speed':'osm_speed_mph',
+    'lanes':'osm_lanes',
+    'highway':'highway',
+    'func_class':'FUNC_CLASS'
+    }
+
+#link types that are separated from traffic
+OFF_STREET = ['cycleway','path','footway','pedestrian','track','bridleway','living_street']
+
+#the first row a link matches sets its lts. a condition can be a value, a list of values,
+#or a (min,max) range where either end can be None. speeds are in mph and lanes are total lanes.
+LTS_CRITERIA = [
+    {'lts':1,'rule':'protected bike lane','pbl':1},
+    {'lts':1,'rule':'multi-use path','mu':1},
+    {'lts':1,'rule':'off street','highway':OFF_STREET},
+    {'lts':1,'rule':'bike lane low speed','bl':1,'speed':(None,30),'lanes':(None,2)},
+    {'lts':2,'rule':'bike lane','bl':1,'speed':(None,35),'lanes':(None,4)},
+    {'lts':3,'rule':'bike lane high speed','bl':1,'speed':(None,40)},
+    {'lts':4,'rule':'bike lane very high speed','bl':1},
+    {'lts':1,'rule':'mixed traffic residential','speed':(None,25),'lanes':(None,3)},
+    {'lts':2,'rule':'mixed traffic low speed','speed':(None,30),'lanes':(None,3)},
+    {'lts':3,'rule':'mixed traffic multilane low speed','speed':(None,25),'lanes':(None,5)},
+    {'lts':3,'rule':'mixed traffic','speed':(None,35),'lanes':(None,3)},
+    {'lts':4,'rule':'mixed traffic high stress'}
+    ]
+
+#typical speed limit (mph) and total lanes used when they are missing
+FUNC_CLASS_DEFAULTS = {
+    '1':(55,6),
+    '2':(45,4),
+    '3':(35,4),
+    '4':(30,2),
+    '5':(25,2)
+    }
+#FUNC_CLASS is labeled when it comes from add_here_attr
+FUNC_CLASS_DEFAULTS.update({here_func_class[key]:value for key, value in FUNC_CLASS_DEFAULTS.items()})
+
+HIGHWAY_DEFAULTS = {
+    'motorway':(65,6),
+    'trunk':(50,4),
+    'primary':(40,4),
+    'secondary':(35,4),
+    'tertiary':(30,2),
+    'unclassified':(25,2),
+    'residential':(25,2),
+    'living_street':(15,2),
+    'service':(15,2),
+    'busway':(25,2)
+    }
+
+def _link_table(links:pd.DataFrame,columns:dict):
+    '''
+    Supporting function for lts. Pulls out the criteria columns (missing ones are NaN)
+    '''
+    table = pd.DataFrame(index=links.index)
+    for name, col in columns.items():
+        table[name] = links[col] if col in links.columns else np.nan
+    for name in ['bl','pbl','mu']:
+        table[name] = table[name].fillna(0)
+    return table
+
+def impute_speed_lanes(table:pd.DataFrame):
+    '''
+    Fills in missing speed and lanes from the functional class and then the highway
+    tag. Returns the table and a mask of the links that had something imputed.
+    '''
+    imputed = np.zeros(len(table),dtype=bool)
+    for key, defaults in [('func_class',FUNC_CLASS_DEFAULTS),('highway',HIGHWAY_DEFAULTS)]:
+        keys = table[key].astype('string').str.replace(r'_link$','',regex=True)
+        for i, col in enumerate(['speed','lanes']):
+            default = keys.map({k:v[i] for k, v in defaults.items()}).astype(float).to_numpy()
+            fill = table[col].isna().to_numpy() & ~np.isnan(default)
+            table.loc[fill,col] = default[fill]
+            imputed |= fill
+    return table, imputed
+
+def _condition(values:pd.Series,condition):
+    '''
+    Supporting function for lts. Evaluates one criteria condition on a column.
+    '''
+    if isinstance(condition,tuple):
+        low, high = condition
+        mask = values.notna()
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return mask.to_numpy()
+    if isinstance(condition,list):
+        return values.isin(condition).to_numpy()
+    return (values == condition).to_numpy()
+
+@instrumented()
+def lts(links:pd.DataFrame,criteria:list=LTS_CRITERIA,columns:dict=LTS_COLUMNS):
+    '''
+    Adds the lts (1-4), lts_rule, lts_imputed, and lts1-lts4 indicator columns to the links.
+    Links that don't match any criteria row get an lts of 0 (the default criteria
+    always match).
+    '''
+    table, imputed = impute_speed_lanes(_link_table(links,columns))
+
+    conditions = []
+    for row in criteria:
+        mask = np.ones(len(table),dtype=bool)
+        for key, condition in row.items():
+            if key not in ['lts','rule']:
+                mask &= _condition(table[key],condition)
+        conditions.append(mask)
+
+    links['lts'] = np.select(conditions,[row['lts'] for row in criteria],0).astype(np.int8)
+    links['lts_rule'] = np.select(conditions,[row.get('rule',str(i)) for i, row in enumerate(criteria)],None)
+    links['lts_imputed'] = imputed
+
+    for level in range(1,5):
+        links[f'lts{level}'] = (links['lts'] == level).astype(np.int8)
+
+    print(links['lts'].value_counts().sort_index())
+
+    return links
+
+@instrumented()
+def lts_islands(links:pd.DataFrame,thresholds:list=[1,2,3,4],A:str='A',B:str='B'):
+    '''
+    Labels the low stress islands (connected components using only links with an lts at
+    or below the threshold) for each threshold. Adds an island_lts{threshold} column where
+    islands are numbered by size (0 is the largest island) and links above the threshold
+    are -1. Returns the links and a table with the number of links in each island.
+    '''
+    sizes = []
+    for threshold in thresholds:
+        keep = (links['lts'] <= threshold).to_numpy() & (links['lts'] > 0).to_numpy()
+        #links without node ids can't be part of an island
+        keep &= links[A].notna().to_numpy() & links[B].notna().to_numpy()
+        island = np.full(len(links),-1,dtype=np.int32)
+
+        if keep.any():
+            node_ids, labels, a_idx, b_idx = node_components(links.loc[keep,A],links.loc[keep,B])
+            link_labels = labels[a_idx]
+
+            #renumber from largest to smallest
+            counts = np.bincount(link_labels)
+            rank = np.empty(len(counts),dtype=np.int32)
+            rank[np.argsort(-counts,kind='stable')] = np.arange(len(counts))
+            island[keep] = rank[link_labels]
+
+            sizes.append(pd.DataFrame({'threshold':threshold,'island':np.arange(len(counts)),'num_links':np.sort(counts)[::-1]}))
+
+        links[f'island_lts{threshold}'] = island
+
+    sizes = pd.concat(sizes,ignore_index=True) if len(sizes) > 0 else pd.DataFrame(columns=['threshold','island','num_links'])
+
+    return links, sizes
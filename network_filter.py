@@ -12,16 +12,21 @@ pd.options.mode.chained_assignment = None  # default='warn' #get rid of copy war
 import numpy as np
 #np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning)  
 import time
+import json
+from concurrent.futures import ProcessPoolExecutor
 from shapely.geometry import Point, box
 from pathlib import Path
 import contextily as cx
 import fiona
 import warnings
+import shapely
 
 # Suppress the shapely warning (not working)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 from helper_functions import *
+from network_io import write_table, write_table_chunks, write_layers, list_layers, layer_info, layer_last_change, read_chunks
+from instrument import instrumented, count
 
 def import_study_area(settings):
     if settings['studyarea_layer'] is None:
@@ -48,6 +53,7 @@ def import_study_area(settings):
     return studyarea
 
 #master function used to run all the filter functions
+@instrumented(outputs=('links','nodes'))
 def filter_networks(settings:dict,network_dict:dict):
     '''
     This function runs all the other functions in this file. It takes in two settings dictionaries.
@@ -68,20 +74,19 @@ def filter_networks(settings:dict,network_dict:dict):
     "A": "A", #column with the starting node id; replace with None if there isn't a column
     "B": "B", #column with the ending node id; replace with None if there isn't a column
     "bbox": True, #use the bounding box of the study area as the mask for bringing in features instead of the polygon boundaries
+    "columns": None, #optional list of attribute columns to read (only used when settings has a tile_size)
+    "planarize": False, #split links where they cross and make new nodes (for sources without shared endpoints, see planarize)
     
+    For large files add "tile_size" (in CRS units) and optionally "workers" to settings
+    and use filter_networks_tiled instead, which reads the links in parallel tiles (see
+    read_links_tiled) and streams them into filtered.gpkg.
 
     '''
-    #record the starting time
-    tot_time_start = time.time()
-    
     network_name = network_dict['network_name']
     print(f'Filtering the {network_name} network.')
 
     #import the network
     links, nodes = filter_to_general(settings,network_dict)  
-    
-    #print the total time it took to run the code
-    print(f'{network_name} imported... took {round(((time.time() - tot_time_start)/60), 2)} minutes')
 
     return links, nodes
 
@@ -100,6 +105,9 @@ def filter_to_general(settings:dict,network_dict:dict):
     if network_dict['links_layer'] is None:
         network_dict['links_layer'] = 0
     
+    # large files are streamed tile by tile instead (see filter_networks_tiled)
+    if settings.get('tile_size') is not None:
+        raise ValueError('tile_size is set, use filter_networks_tiled to stream the tiles into filtered.gpkg')
     # use bounding box to mask instead of polygon boundaries
     if settings['use_bbox']:
         links = gpd.read_file(links_fp,bbox=tuple(studyarea.total_bounds),layer=network_dict['links_layer'])
@@ -115,7 +123,27 @@ def filter_to_general(settings:dict,network_dict:dict):
         links.to_crs(settings['crs'],inplace=True)
 
     #create linkids to distinguish links when they have the same start/end node
-    #prefer pre-established linkid but if linkid is not unique create new linkids
+    links = add_link_ids(links,network_dict)
+
+    #bring in or create nodes and add reference ids to links
+    links, nodes = creating_nodes(links,settings,network_dict)
+
+    #export the attributes
+    write_table(links.drop(columns=['geometry']),settings['output_fp']/f'{network_name}_attr.parquet')
+
+    #initialize a link type column
+    links['link_type'] = np.nan
+
+    return links, nodes
+
+def add_link_ids(links:gpd.GeoDataFrame,network_dict:dict,start:int=0):
+    '''
+    Renames the provided linkid column to {network_name}_linkid. The pre-established
+    linkid is preferred, but if it's missing or not unique new linkids are generated
+    (numbered from start, so tiles can continue where the last tile stopped).
+    '''
+    network_name = network_dict['network_name']
+
     if links.columns.isin(['linkid']).any():
         print('Column named linkid detected but not set as linkid column in settings.')
         links.rename(columns={'linkid':'undefined_linkid'},inplace=True)
@@ -125,7 +153,7 @@ def filter_to_general(settings:dict,network_dict:dict):
             print('Provided linkid is not in the columns.')
             network_dict['linkid'] = None
         
-        if links[network_dict['linkid']].duplicated().any():
+        elif links[network_dict['linkid']].duplicated().any():
             print('Provided linkid is not unique.')
             network_dict['linkid'] = None
             
@@ -133,19 +161,216 @@ def filter_to_general(settings:dict,network_dict:dict):
         links.rename(columns={network_dict['linkid']:f'{network_name}_linkid'},inplace=True)
     else:
         print('Generating unique link ids.')
-        links.reset_index(inplace=True)
-        links.rename(columns={'index':f'{network_name}_linkid'},inplace=True)
+        links.reset_index(drop=True,inplace=True)
+        links.insert(0,f'{network_name}_linkid',np.arange(start,start+len(links)))
 
-    #bring in or create nodes and add reference ids to links
-    links, nodes = creating_nodes(links,settings,network_dict)
+    return links
 
-    #export the attributes
-    links.drop(columns=['geometry']).to_pickle(settings['output_fp']/f'{network_name}_attr.pkl')
+def make_tiles(studyarea:gpd.GeoDataFrame,tile_size:float):
+    '''
+    Splits the bounding box of the study area into square tiles (in CRS units)
+    and returns the tiles that intersect the study area as a GeoDataFrame.
+    '''
+    minx, miny, maxx, maxy = studyarea.total_bounds
+    xs = np.arange(minx,maxx,tile_size)
+    ys = np.arange(miny,maxy,tile_size)
+    tiles = [box(x,y,min(x+tile_size,maxx),min(y+tile_size,maxy)) for x in xs for y in ys]
+    tiles = gpd.GeoDataFrame({'geometry':tiles},geometry='geometry',crs=studyarea.crs)
+    
+    #only keep tiles that touch the study area
+    tiles = tiles[tiles.intersects(studyarea.union_all())].reset_index(drop=True)
+    return tiles
 
-    #initialize a link type column
-    links['link_type'] = np.nan
+def _read_tile(links_fp,layer,tile,crs,columns,use_bbox):
+    '''
+    Worker function for read_links_tiled. Reads the links that intersect one tile
+    and projects them to the desired CRS. Needs to be top level so it can be pickled.
+    '''
+    kwargs = {'layer':layer}
+    if columns is not None:
+        kwargs['columns'] = columns
+    
+    #bbox and mask geodataframes get reprojected to the layer crs by geopandas
+    if use_bbox:
+        links = gpd.read_file(links_fp,bbox=tile,**kwargs)
+    else:
+        links = gpd.read_file(links_fp,mask=tile,**kwargs)
 
-    return links, nodes
+    if links.crs != crs:
+        links.to_crs(crs,inplace=True)
+    return links
+
+def read_links_tiled(settings:dict,network_dict:dict):
+    '''
+    Reads the links layer in square tiles (settings['tile_size'] in CRS units) using
+    a pool of worker processes so that a statewide file never has to be masked in
+    one read. Only the attribute columns listed in network_dict['columns'] are read
+    if provided (the id and reference id columns are always added).
+
+    Links that straddle tile edges are returned by more than one tile, so they are
+    dropped by the provided linkid column (or by their geometry if there is no linkid)
+    as each tile comes in. Tiles are yielded in a fixed order so generated link ids
+    stay the same between runs.
+
+    Optional settings:
+    "tile_size": 50000, #tile width/height in CRS units
+    "workers": None, #number of worker processes, None uses all the cores
+
+    Optional network_dict:
+    "columns": ['highway','name'], #attribute columns to read
+    '''
+    studyarea = settings['studyarea']
+    layer = network_dict['links_layer'] if network_dict['links_layer'] is not None else 0
+    
+    #attribute projection
+    columns = network_dict.get('columns')
+    if columns is not None:
+        keep = [network_dict['linkid'],network_dict['A'],network_dict['B']]
+        columns = list(dict.fromkeys(list(columns) + [x for x in keep if x is not None]))
+
+    tiles = make_tiles(studyarea,settings['tile_size'])
+    print(f'Reading {network_dict["network_name"]} links in {len(tiles)} tiles.')
+
+    #bbox mode reads each tile box, mask mode reads the part of the study area in each tile
+    if settings['use_bbox']:
+        masks = [tiles.iloc[[i]] for i in range(len(tiles))]
+    else:
+        masks = [gpd.overlay(tiles.iloc[[i]],studyarea[['geometry']],how='intersection') for i in range(len(tiles))]
+
+    #dedupe key
+    key = network_dict['linkid']
+    seen = set()
+
+    n = len(masks)
+    with ProcessPoolExecutor(max_workers=settings.get('workers')) as executor:
+        results = executor.map(_read_tile,[network_dict['links_fp']]*n,[layer]*n,masks,
+                               [settings['crs']]*n,[columns]*n,[settings['use_bbox']]*n)
+        for tile_links in results:
+            if (key is not None) and (key in tile_links.columns):
+                tile_key = tile_links[key]
+            else:
+                tile_key = tile_links.geometry.to_wkb()
+            
+            #drop links already returned by a previous tile
+            dup = tile_key.isin(seen)
+            seen.update(tile_key)
+            
+            yield tile_links[~dup]
+
+def tiled_linkid(network_dict:dict):
+    '''
+    Supporting function for filter_networks_tiled. Checks the provided linkid over the
+    whole links layer (reading only that column), since a duplicate that only shows up
+    in a later tile would switch the rest of the tiles to generated ids. Returns the
+    linkid column, or None if link ids have to be generated for every tile.
+    '''
+    linkid = network_dict['linkid']
+    if linkid is None:
+        return None
+    layer = network_dict['links_layer'] if network_dict['links_layer'] is not None else 0
+    ids = gpd.read_file(network_dict['links_fp'],layer=layer,columns=[linkid],ignore_geometry=True)
+    if linkid not in ids.columns:
+        print('Provided linkid is not in the columns.')
+        return None
+    if ids[linkid].duplicated().any():
+        print('Provided linkid is not unique.')
+        return None
+    return linkid
+
+@instrumented()
+def filter_networks_tiled(settings:dict,network_dict:dict,rules:list=None,node_buffer:float=100):
+    '''
+    filter_networks and export for files that don't fit in memory. The links are read
+    in tiles (settings['tile_size'], see read_links_tiled) and each tile goes through
+    the link ids, reference ids, and classify_links (if rules are given) and is then
+    appended to the {network_name}_links/_nodes layers of filtered.gpkg and to
+    {network_name}_attr.parquet, so peak memory is bounded by the tile size. The
+    summary stats sidecar is built from the tiles as well.
+
+    Node ids have to agree between tiles, so they come from the link reference ids,
+    from the nodes layer (read within node_buffer CRS units of each tile's links), or
+    when there are neither from the link ends (numbered by their rounded coordinates
+    across tiles). planarize needs the whole layer and isn't supported here. The
+    provided linkid is checked once for the whole layer, and if it's missing or not
+    unique every tile gets generated ids (network_dict isn't changed).
+
+    Returns the link_stats of the filtered links.
+    '''
+    network_name = network_dict['network_name']
+    print(f'Filtering the {network_name} network in tiles.')
+    if network_dict.get('planarize',False):
+        raise ValueError('planarize needs the whole links layer, use filter_networks without tile_size')
+    #copy so the caller's dict (and the pipeline fingerprint) stays the same
+    network_dict = {**network_dict,'linkid':tiled_linkid(network_dict)}
+    if network_dict['links_layer'] is None:
+        network_dict['links_layer'] = 0
+
+    export_fp = settings['output_fp'] / 'filtered.gpkg'
+    layers = {'links':f'{network_name}_links','nodes':f'{network_name}_nodes'}
+    A, B = network_dict['A'], network_dict['B']
+    a_and_b = (A is not None) & (B is not None)
+    written = {'links':0,'nodes':0}
+    #node ids already written and node ids for link ends when they're made from the links
+    written_nodes = set()
+    end_ids = {}
+    parts = None
+
+    def tiles():
+        '''
+        Filters and writes one tile at a time and yields its attributes for the attribute table
+        '''
+        nonlocal parts
+        for links in read_links_tiled(settings,network_dict):
+            if len(links) == 0:
+                continue
+            links = add_link_ids(links.reset_index(drop=True),network_dict,written['links'])
+
+            #nodes for this tile and reference ids
+            if a_and_b:
+                links.rename(columns={A:f'{network_name}_A',B:f'{network_name}_B'},inplace=True)
+            if network_dict['nodes_fp'] is not None:
+                nodes = read_nodes(settings,network_dict,tuple(links.total_bounds + np.array([-1,-1,1,1]) * node_buffer))
+                if not a_and_b:
+                    links = add_ref_ids(links,nodes,network_name)
+            elif a_and_b:
+                nodes = make_nodes_refid(links,network_name)
+            else:
+                nodes = make_nodes(links,network_name)
+                ends = zip(nodes.geometry.x.to_numpy(),nodes.geometry.y.to_numpy())
+                nodes[f'{network_name}_N'] = [end_ids.setdefault(end,len(end_ids)) for end in ends]
+                links = add_ref_ids(links,nodes,network_name)
+
+            yield links.drop(columns=['geometry'])
+
+            if rules is not None:
+                links = classify_links(links,rules)
+            else:
+                links['link_type'] = np.nan
+
+            #only write the nodes used by these links that earlier tiles didn't write
+            nodes = filter_nodes(links,nodes,network_name)
+            nodes = nodes[~nodes[f'{network_name}_N'].isin(written_nodes)].drop_duplicates(f'{network_name}_N')
+            written_nodes.update(nodes[f'{network_name}_N'])
+
+            links, nodes = export_columns(links,nodes,network_name)
+            write_layers({layers[name]:gdf for name, gdf in [('links',links),('nodes',nodes)] if (len(gdf) > 0) and (written[name] == 0)},export_fp)
+            write_layers({layers[name]:gdf for name, gdf in [('links',links),('nodes',nodes)] if (len(gdf) > 0) and (written[name] > 0)},export_fp,append=True)
+            written['links'] += len(links)
+            written['nodes'] += len(nodes)
+
+            part = partial_link_stats(links.assign(length=links.length),network_name)
+            parts = part if parts is None else combine_link_stats([parts,part])
+
+    write_table_chunks(tiles(),settings['output_fp']/f'{network_name}_attr.parquet')
+
+    if parts is None:
+        print('No links found in the study area.')
+        return None
+    stats = final_link_stats(parts)
+    write_stats_sidecar(export_fp,layers['links'],stats)
+    count(**written)
+    print(f"Wrote {written['links']} links and {written['nodes']} nodes to {export_fp}")
+    return stats
 
 def creating_nodes(links:gpd.GeoDataFrame,settings:dict,network_dict:dict):
     '''
@@ -155,35 +380,23 @@ def creating_nodes(links:gpd.GeoDataFrame,settings:dict,network_dict:dict):
     It will also assign reference ids to links if they aren't provided.
     '''
     
+    #split links at intersections (ignores any nodes layer and reference ids)
+    if network_dict.get('planarize',False):
+        print('Planarizing links.')
+        return planarize(links,network_dict['network_name'])
+
     #TODO have cleaner way of extracting variables from dict
     nodes_fp = network_dict['nodes_fp']
     A = network_dict['A']
     B = network_dict['B']
-    nodes_layer = network_dict['nodes_layer']
-    nodes_id = network_dict['nodes_id']
     network_name = network_dict['network_name']
 
     #conditions to check
     a_and_b = (A is not None) & (B is not None)
-    nodeid_check = nodes_id is not None
 
     if nodes_fp is not None:
         print('There is a nodes layer...')
-        
-        if nodes_layer is None:
-            nodes = gpd.read_file(nodes_fp)
-        else:
-            nodes = gpd.read_file(nodes_fp,layer=nodes_layer)
-
-        if nodes.crs != settings['crs']:
-            nodes.to_crs(settings['crs'],inplace=True)
-
-        #check if there is a node id column
-        if nodeid_check is None:
-            print('Setting index as the node IDs.')
-            nodes[f'{network_name}_N'] = nodes.index
-        else:
-            nodes.rename(columns={nodes_id:f'{network_name}_N'},inplace=True)
+        nodes = read_nodes(settings,network_dict)
 
         if a_and_b:
             print("and links and nodes have reference ids.")
@@ -208,6 +421,31 @@ def creating_nodes(links:gpd.GeoDataFrame,settings:dict,network_dict:dict):
     return links, nodes
     
 
+def read_nodes(settings:dict,network_dict:dict,bbox:tuple=None):
+    '''
+    Reads the nodes layer (only the nodes in bbox if given, in the settings crs),
+    projects it, and renames the node id column to {network_name}_N.
+    '''
+    nodes_id = network_dict['nodes_id']
+    network_name = network_dict['network_name']
+    kwargs = {} if network_dict['nodes_layer'] is None else {'layer':network_dict['nodes_layer']}
+    if bbox is not None:
+        kwargs['bbox'] = gpd.GeoDataFrame(geometry=[box(*bbox)],crs=settings['crs'])
+
+    nodes = gpd.read_file(network_dict['nodes_fp'],**kwargs)
+
+    if nodes.crs != settings['crs']:
+        nodes.to_crs(settings['crs'],inplace=True)
+
+    #check if there is a node id column
+    if nodes_id is None:
+        print('Setting index as the node IDs.')
+        nodes[f'{network_name}_N'] = nodes.index
+    else:
+        nodes.rename(columns={nodes_id:f'{network_name}_N'},inplace=True)
+
+    return nodes
+
 def remove_directed_links(links, network_name):
     #remove directed links
     df_dup = pd.DataFrame(
@@ -259,8 +497,9 @@ def add_ref_ids(links,nodes,network_name):
     links[f'{network_name}_B'] = ckdnearest(for_matching,nodes,return_dist=False)[f'{network_name}_N']
 
     #check for missing reference ids
-    if links[f'{network_name}_A'].isnull().any() | links[f'{network_name}_B'].isnull().any():
-        print("There are missing reference ids")
+    missing = links[f'{network_name}_A'].isnull() | links[f'{network_name}_B'].isnull()
+    if missing.any():
+        print(f"There are {missing.sum()} links with missing reference ids (see network_qa.check_network)")
     else:
         print("Reference IDs successfully added to links.")
     return links
@@ -288,6 +527,114 @@ def make_nodes_refid(links, network_name):
 
     return nodes
 
+def link_levels(links,layer_col:str='layer',bridge_col:str='bridge',tunnel_col:str='tunnel'):
+    '''
+    Vertical level of each link for planarize. Uses the layer tag if there is one,
+    otherwise bridges are 1, tunnels are -1, and everything else is 0.
+    '''
+    level = pd.Series(0.0,index=links.index)
+    for col, value in [(bridge_col,1),(tunnel_col,-1)]:
+        if col in links.columns:
+            tag = links[col].astype('string').str.lower()
+            level[tag.notna().to_numpy() & ~tag.isin(['no','0','false']).to_numpy()] = value
+    if layer_col in links.columns:
+        layer = pd.to_numeric(links[layer_col],errors='coerce')
+        level = layer.where(layer.notna(),level)
+    return level.to_numpy()
+
+@instrumented(outputs=('links','nodes'))
+def planarize(links,network_name:str,tolerance:float=0.5,precision:float=0.01,
+              layer_col:str='layer',bridge_col:str='bridge',tunnel_col:str='tunnel'):
+    '''
+    Splits links wherever they cross or touch another link on the same level (see
+    link_levels, so bridges and tunnels aren't split by the roads they pass over or
+    under) and creates the nodes and A/B ids. For sources where links don't end at
+    the intersections (e.g., bike facility inventories).
+
+    Candidate pairs come from one bulk STRtree query and the intersections are found
+    for all pairs at once. Intersections within tolerance (CRS units) of a link end
+    don't split it. Link ends within precision of each other get the same node.
+
+    Each piece keeps the attributes of its link, the old id is moved to
+    {network_name}_source_linkid, and the pieces get new {network_name}_linkids.
+    MultiLineStrings are exploded into their parts first (each part is a link).
+    '''
+    #distances along multipart lines skip the gaps between parts, so split them up
+    links = links.explode(index_parts=False).reset_index(drop=True)
+    geoms = links.geometry.to_numpy()
+    length = shapely.length(geoms)
+    level = link_levels(links,layer_col,bridge_col,tunnel_col)
+
+    #pairs of links on the same level that intersect
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms,predicate='intersects')
+    keep = (left < right) & (level[left] == level[right])
+    left, right = left[keep], right[keep]
+
+    #intersection points split both links (overlapping parts split at their vertices)
+    points, pair = shapely.get_coordinates(shapely.intersection(geoms[left],geoms[right]),return_index=True)
+    split_link = np.concatenate([left[pair],right[pair]])
+    split_xy = np.concatenate([points,points])
+    split_dist = shapely.line_locate_point(geoms[split_link],shapely.points(split_xy))
+    inside = (split_dist > tolerance) & (split_dist < length[split_link] - tolerance)
+    split_link, split_xy, split_dist = split_link[inside], split_xy[inside], split_dist[inside]
+    #one split per location on a link
+    _, first = np.unique(split_link.astype(np.int64) * (int(length.max() / tolerance) + 2) + np.round(split_dist / tolerance).astype(np.int64),return_index=True)
+    split_link, split_xy, split_dist = split_link[first], split_xy[first], split_dist[first]
+
+    #distance of every vertex along its link
+    coords, vertex_link = shapely.get_coordinates(geoms,return_index=True)
+    step = np.r_[0,np.hypot(*np.diff(coords,axis=0).T)]
+    starts = np.r_[True,vertex_link[1:] != vertex_link[:-1]]
+    step[starts] = 0
+    cum = np.cumsum(step)
+    vertex_dist = cum - np.maximum.accumulate(np.where(starts,cum,0))
+
+    #vertices and split points in order along each link (kind 1 = split point)
+    link_pos = np.concatenate([vertex_link,split_link])
+    dist = np.concatenate([vertex_dist,split_dist])
+    xy = np.concatenate([coords,split_xy])
+    kind = np.concatenate([np.zeros(len(coords),dtype=np.int8),np.ones(len(split_link),dtype=np.int8)])
+    order = np.lexsort((kind,dist,link_pos))
+    link_pos, dist, xy, kind = link_pos[order], dist[order], xy[order], kind[order]
+
+    #piece number within the link (split points end one piece and start the next)
+    num_splits = np.bincount(split_link,minlength=len(links))
+    link_start = np.cumsum(num_splits + 1) - (num_splits + 1)
+    before = np.cumsum(kind) - (np.cumsum(num_splits) - num_splits)[link_pos]
+    piece = link_start[link_pos] + before - kind
+    is_split = kind == 1
+    piece = np.concatenate([piece,piece[is_split] + 1])
+    dist = np.concatenate([dist,dist[is_split]])
+    xy = np.concatenate([xy,xy[is_split]])
+    order = np.lexsort((dist,piece))
+    piece, xy = piece[order], xy[order]
+
+    piece_link = np.repeat(np.arange(len(links)),num_splits + 1)
+    new_geoms = shapely.linestrings(xy,indices=piece)
+
+    links = links.iloc[piece_link].reset_index(drop=True)
+    links = links.rename(columns={f'{network_name}_linkid':f'{network_name}_source_linkid'})
+    links[f'{network_name}_linkid'] = np.arange(len(links))
+    links = links.set_geometry(gpd.GeoSeries(new_geoms,crs=links.crs))
+
+    #nodes from the rounded link ends
+    piece_start = np.flatnonzero(np.r_[True,piece[1:] != piece[:-1]])
+    piece_end = np.r_[piece_start[1:] - 1,len(piece) - 1]
+    ends = np.concatenate([xy[piece_start],xy[piece_end]])
+    grid = np.round(ends / precision).astype(np.int64)
+    grid -= grid.min(axis=0)
+    _, first, node_idx = np.unique(grid[:,0] * (grid[:,1].max() + 1) + grid[:,1],return_index=True,return_inverse=True)
+    node_idx = node_idx.ravel()
+    links[f'{network_name}_A'] = node_idx[:len(links)]
+    links[f'{network_name}_B'] = node_idx[len(links):]
+    nodes = gpd.GeoDataFrame({f'{network_name}_N':np.arange(len(first))},geometry=shapely.points(ends[first]),crs=links.crs)
+
+    count(splits=len(split_link))
+    print(f'{len(split_link)} splits turned {len(num_splits)} links into {len(links)} links with {len(nodes)} nodes')
+
+    return links, nodes
+
 def make_nodes(links, network_name):
     links_copy = links.copy()
 
@@ -314,65 +661,266 @@ def make_nodes(links, network_name):
     
     return nodes
 
+#default rules for classifying osm links (used in the Step 1 notebook)
+#rules are checked in order and the first rule that matches sets the link type
+#tag conditions: list = tag is one of, ('not',list) = tag is not one of (includes missing), 'notnull'/'isnull'
+OSM_LINK_TYPES = [
+    #remove restricted access roads
+    {'rule':'restricted_access','link_type':'remove','highway':['motorway','motorway_link']},
+    #remove sidewalks unless bikes explicitly allowed
+    {'rule':'sidewalk','link_type':'remove','footway':['sidewalk','crossing'],'bicycle':('not',['yes'])},
+    #unclassified added 8/14/23 because there are several roads in Atlanta region marked this despite being public roads
+    {'rule':'road','link_type':'road','highway':['primary','primary_link','residential','secondary','secondary_link',
+                                                 'tertiary','tertiary_link','trunk','trunk_link','unclassified','living_street']},
+    #keep service roads that have a street name
+    {'rule':'named_service','link_type':'road','highway':['service'],'name':'notnull'},
+    {'rule':'bike','link_type':'bike','highway':['cycleway','footway','path','pedestrian','steps']},
+    {'rule':'service','link_type':'service','highway':['service'],'name':'isnull'},
+]
+
+def _tag_table(categories:pd.Index,condition):
+    '''
+    Supporting function for classify_links. Evaluates one tag condition on the
+    categories of a tag column. The last entry is for missing values so that the
+    -1 categorical code for NaN indexes it.
+    '''
+    if isinstance(condition,str):
+        table = np.append(np.ones(len(categories),dtype=bool),False)
+        if condition == 'isnull':
+            table = ~table
+        elif condition != 'notnull':
+            raise ValueError(f'Unknown tag condition {condition}')
+    elif isinstance(condition,tuple) and (condition[0] == 'not'):
+        table = np.append(~categories.isin(condition[1]),True)
+    else:
+        table = np.append(categories.isin(condition),False)
+    return table
+
+@instrumented()
+def classify_links(links:gpd.GeoDataFrame,rules:list=OSM_LINK_TYPES,column:str='link_type'):
+    '''
+    Sets the link type of each link from an ordered list of rules (see OSM_LINK_TYPES).
+    Each rule is a dict with a 'link_type', an optional 'rule' name, and tag conditions.
+    The first rule that a link matches sets its link type and the rule name is stored
+    in '{column}_rule' so it's possible to see why a link was classified the way it was.
+    Links that don't match any rule are left as NaN.
+
+    Each tag column is turned into categorical codes and every rule is evaluated on the
+    categories (not the links) and packed into a bitmask, so each tag column is only
+    looked up once no matter how many rules there are. Tags missing from the links are
+    treated as missing values. Up to 64 rules are supported.
+    '''
+    if len(rules) > 64:
+        raise ValueError('classify_links supports up to 64 rules')
+
+    #tag columns used by the rules
+    tags = []
+    for rule in rules:
+        tags += [key for key in rule.keys() if key not in ['rule','link_type']]
+    tags = list(dict.fromkeys(tags))
+
+    #every link starts out matching every rule
+    matched = np.full(len(links),(1 << len(rules)) - 1,dtype=np.uint64)
+
+    for tag in tags:
+        if tag in links.columns:
+            tag_col = pd.Categorical(links[tag])
+            codes, categories = tag_col.codes, tag_col.categories
+        else:
+            codes, categories = np.full(len(links),-1), pd.Index([])
+        
+        #bitmask of the rules each category satisfies (rules without this tag are always satisfied)
+        bits = np.full(len(categories)+1,(1 << len(rules)) - 1,dtype=np.uint64)
+        for i, rule in enumerate(rules):
+            if tag in rule:
+                table = _tag_table(categories,rule[tag])
+                bits[~table] &= ~np.uint64(1 << i)
+        
+        matched &= bits[codes]
+
+    #first rule that fired is the lowest set bit
+    lowest = matched & (~matched + np.uint64(1))
+    fired = np.where(matched > 0,np.log2(np.maximum(lowest,1).astype(float)),-1).astype(int)
+
+    link_types = np.array([rule['link_type'] for rule in rules] + [np.nan],dtype=object)
+    rule_names = np.array([rule.get('rule',i) for i, rule in enumerate(rules)] + [np.nan],dtype=object)
+    links[column] = link_types[fired]
+    links[f'{column}_rule'] = rule_names[fired]
+
+    print(links[column].value_counts(dropna=False))
+
+    return links
+
 def filter_nodes(links,nodes,network_name):
     #remove nodes that aren't in the filtered links
     nodes_in = set(pd.concat([links[f'{network_name}_A'],links[f'{network_name}_B']],ignore_index=True))
     nodes_filt = nodes[nodes[f'{network_name}_N'].isin(nodes_in)]
     return nodes_filt
 
-def export(links,nodes,network_name,settings):
-    start = time.time()
+def export_columns(links,nodes,network_name):
+    '''
+    Keeps the columns that go in filtered.gpkg
+    '''
     #remove excess columns for now
-    links = links[[f'{network_name}_A',f'{network_name}_B',f'{network_name}_linkid','link_type','geometry']]
+    cols = [f'{network_name}_A',f'{network_name}_B',f'{network_name}_linkid','link_type','link_type_rule','geometry']
+    links = links[[x for x in cols if x in links.columns]]
     nodes = nodes[[f'{network_name}_N','geometry']]
+    return links, nodes
+
+@instrumented()
+def export(links,nodes,network_name,settings):
+    links, nodes = export_columns(links,nodes,network_name)
     #export
     export_fp = settings['output_fp'] / 'filtered.gpkg'
-    links.to_file(export_fp,layer=f'{network_name}_links')
-    nodes.to_file(export_fp,layer=f'{network_name}_nodes')
-    end = time.time()
-    print('Export took',np.round((end-start)/60,2),'minutes')
+    write_layers({f'{network_name}_links':links,f'{network_name}_nodes':nodes},export_fp)
+    #stats for summary
+    write_stats_sidecar(export_fp,f'{network_name}_links',link_stats(links.assign(length=links.length),network_name))
+    count(links=len(links),nodes=len(nodes))
     return
 
-def summary(settings):
+#columns used for the summary breakdowns (if the layer has them)
+SUMMARY_BY = ['link_type','highway']
+
+def partial_link_stats(links:pd.DataFrame,network_name:str,by:list=SUMMARY_BY):
     '''
-    Look at and summurize features in a filter.gpkg file.
+    The parts of link_stats that can be added up over chunks of a layer: the number
+    of links and total length of each group and the unique (group, node) pairs.
+    Combine chunks with combine_link_stats and finish with final_link_stats.
+    links needs the network's A and B columns and a length column (feet).
+    '''
+    a, b = f'{network_name}_A', f'{network_name}_B'
+    by = ['all'] + [x for x in by if x in links.columns]
+    links = links.assign(all='all')
+
+    sums, nodes = [], []
+    for col in by:
+        key = links[col].astype(object).where(links[col].notna(),'none').astype(str)
+        grouped = links['length'].groupby(key).agg(['size','sum'])
+        sums.append(pd.DataFrame({'column':col,'value':grouped.index,'num_links':grouped['size'].to_numpy(),'length':grouped['sum'].to_numpy()}))
+        nodes.append(pd.DataFrame({'column':col,'value':np.concatenate([key,key]),'N':np.concatenate([links[a],links[b]])}).drop_duplicates())
+    return pd.concat(sums,ignore_index=True), pd.concat(nodes,ignore_index=True)
+
+def combine_link_stats(parts:list):
+    '''
+    Adds up a list of partial_link_stats results (keeps one row per group and one row
+    per unique group and node, so the result stays small as chunks are added)
     '''
+    sums = pd.concat([x[0] for x in parts],ignore_index=True)
+    sums = sums.groupby(['column','value'],sort=False,as_index=False)[['num_links','length']].sum()
+    nodes = pd.concat([x[1] for x in parts],ignore_index=True).drop_duplicates()
+    return sums, nodes
 
-    #summary table
-    #can add other metrics of interest in the future
-    summary_table = pd.DataFrame(columns=['num_links','num_nodes','tot_link_length','avg_link_length'])
-    
-    #expected link types
-    layers = fiona.listlayers(settings['output_fp']/ 'filtered.gpkg')
+def final_link_stats(parts):
+    '''
+    Turns combined partial_link_stats into the link_stats table
+    '''
+    sums, nodes = parts
+    num_nodes = nodes.groupby(['column','value'],sort=False).size()
+    #'all' first, then the by columns, with the values sorted
+    order = pd.Categorical(sums['column'],categories=sums['column'].unique())
+    sums = sums.assign(order=order).sort_values(['order','value']).reset_index(drop=True)
+    return pd.DataFrame({
+        'column':sums['column'],
+        'value':sums['value'],
+        'num_links':sums['num_links'],
+        'num_nodes':num_nodes.reindex(pd.MultiIndex.from_frame(sums[['column','value']])).to_numpy(),
+        'tot_link_length':(sums['length'] / 5280).round(0),
+        'avg_link_length':(sums['length'] / sums['num_links']).round(1)
+        })
+
+def link_stats(links:pd.DataFrame,network_name:str,by:list=SUMMARY_BY):
+    '''
+    Number of links, number of unique nodes, total length (miles), and average link
+    length (feet) for all links (column 'all') and for each value of the by columns.
+    links needs the network's A and B columns and a length column (feet).
+    '''
+    return final_link_stats(partial_link_stats(links,network_name,by))
 
-    #remove node layers
-    layers = [x for x in layers if 'node' not in x]
+def _sidecar_fp(fp):
+    return Path(fp).with_suffix('.stats.json')
 
-    #go through each network
-    for network in layers:
-        links = gpd.read_file(settings['output_fp']/'filtered.gpkg',layer=network)
-    
-        #get network name
-        network_name = network.split('_')[0]
-    
-        #how many links
-        num_links = len(links)
-    
-        #how many nodes
-        nodes = pd.concat([links[f'{network_name}_A'],links[f'{network_name}_B']],ignore_index=True)
-        num_nodes = len(nodes.unique())
+def write_stats_sidecar(fp,layer:str,stats:pd.DataFrame):
+    '''
+    Stores the link_stats of a layer next to the GeoPackage (filtered.stats.json) along
+    with the layer's feature count, extent, and last change time so that stale stats
+    can be detected. Call it after every rewrite of the layer.
+    '''
+    sidecar_fp = _sidecar_fp(fp)
+    sidecar = json.loads(sidecar_fp.read_text()) if sidecar_fp.exists() else {}
+    sidecar[layer] = {**layer_info(fp,layer),'last_change':layer_last_change(fp,layer),'stats':stats.to_dict(orient='records')}
+    sidecar_fp.write_text(json.dumps(sidecar))
+
+def read_stats_sidecar(fp,layer:str):
+    '''
+    Returns the stored link_stats for a layer or None if there aren't any or the layer
+    changed since they were written (a tag only change keeps the feature count and
+    extent, so the layer's last change time is checked too)
+    '''
+    sidecar_fp = _sidecar_fp(fp)
+    if not sidecar_fp.exists():
+        return None
+    stored = json.loads(sidecar_fp.read_text()).get(layer)
+    if stored is None:
+        return None
+    info = layer_info(fp,layer)
+    if (stored['features'] != info['features']) or not np.allclose(stored['total_bounds'],info['total_bounds']):
+        return None
+    if (stored.get('last_change') is None) or (stored['last_change'] != layer_last_change(fp,layer)):
+        return None
+    return pd.DataFrame(stored['stats'])
+
+def layer_summary(fp,layer:str,by:list=SUMMARY_BY,chunk_size:int=500000,use_sidecar:bool=True):
+    '''
+    link_stats for one layer. Uses the stats sidecar if it's current, otherwise reads
+    only the A, B, and by columns (and the geometry for the lengths) in chunks and adds
+    up the partial stats of each chunk.
+    '''
+    if use_sidecar:
+        stats = read_stats_sidecar(fp,layer)
+        if stats is not None:
+            return stats
+
+    network_name = layer.split('_')[0]
+    fields = layer_info(fp,layer)['fields']
+    columns = [x for x in [f'{network_name}_A',f'{network_name}_B'] + by if x in fields]
+
+    parts = None
+    for chunk in read_chunks(fp,layer,columns,chunk_size):
+        chunk = pd.DataFrame(chunk[columns]).assign(length=chunk.geometry.length.to_numpy())
+        part = partial_link_stats(chunk,network_name,by)
+        parts = part if parts is None else combine_link_stats([parts,part])
+    if parts is None:
+        parts = partial_link_stats(pd.DataFrame(columns=columns + ['length']),network_name,by)
+    return final_link_stats(parts)
+
+def summary(settings,by:list=SUMMARY_BY,chunk_size:int=500000,use_sidecar:bool=True,workers:int=None):
+    '''
+    Look at and summurize features in a filter.gpkg file.
+
+    Each links layer is summarized in a separate process (see layer_summary). Writes the
+    totals to network_summary.csv and the breakdowns by the by columns to
+    network_summary_by_type.csv, and returns both.
+    '''
+    fp = settings['output_fp'] / 'filtered.gpkg'
 
-        #total length
-        length_mi = links.geometry.length / 5280 # create a new distance column and calculate mileage of each link
-        tot_link_length = round(length_mi.sum(),0)
+    #remove node layers
+    layers = [x for x in list_layers(fp) if 'node' not in x]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(layer_summary,[fp]*len(layers),layers,[by]*len(layers),
+                                    [chunk_size]*len(layers),[use_sidecar]*len(layers)))
 
-        #average link length
-        avg_link_length = round(links.geometry.length.mean(),1)
+    breakdown = pd.concat([stats.assign(network=layer) for layer, stats in zip(layers,results)],ignore_index=True)
+    breakdown = breakdown[['network'] + [x for x in breakdown.columns if x != 'network']]
 
-        #create data frame
-        summary_table.loc[network,:] = [num_links,num_nodes,tot_link_length,avg_link_length]
+    summary_table = breakdown[breakdown['column'] == 'all'].set_index('network')
+    summary_table = summary_table[['num_links','num_nodes','tot_link_length','avg_link_length']]
+    breakdown = breakdown[breakdown['column'] != 'all'].reset_index(drop=True)
 
     #export summary table
     summary_table.to_csv(settings['output_fp']/ "network_summary.csv")
-   
+    breakdown.to_csv(settings['output_fp']/ "network_summary_by_type.csv",index=False)
+
     print(summary_table)
+
+    return summary_table, breakdown
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing the intermediate tables of the network pipeline.
+
+Tables are written as Parquet (GeoParquet for GeoDataFrames) so that each
+stage can read only the columns and rows it needs. Pickles are still read
+so older project folders (e.g., Data/networks/osm_attr.pkl) keep working.
+
+GeoPackage layers (filtered.gpkg, final_network.gpkg, etc.) are written with
+write_layers, which writes each layer in bulk through pyogrio and Arrow
+instead of one feature at a time through fiona.
+"""
+
+from pathlib import Path
+import geopandas as gpd
+import pandas as pd
+
+def _arrow_safe(df:pd.DataFrame):
+    '''
+    Arrow needs one type per column. OSM tag columns sometimes have a mix of
+    strings and numbers, so mixed object columns are converted to strings
+    (missing values are left as is).
+    '''
+    for col in df.columns:
+        if (df[col].dtype == object) and (col != getattr(df,'_geometry_column_name',None)):
+            types = df[col].dropna().map(type).unique()
+            if len(types) > 1:
+                df[col] = df[col].where(df[col].isna(),df[col].astype(str))
+    return df
+
+def write_table(df:pd.DataFrame,fp):
+    '''
+    Writes a DataFrame or GeoDataFrame to Parquet (or a pickle if fp ends in .pkl)
+    '''
+    fp = Path(fp)
+    if fp.suffix == '.pkl':
+        df.to_pickle(fp)
+    else:
+        _arrow_safe(df.copy()).to_parquet(fp,index=False)
+
+def write_table_chunks(chunks,fp):
+    '''
+    Writes an iterable of DataFrames to one Parquet file, one row group per chunk,
+    so the whole table never has to be in memory. The first chunk sets the columns
+    and types (columns without any values are written as strings); later chunks are
+    converted to them and missing columns are left empty. Returns the number of rows.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer, schema, num_rows = None, None, 0
+    try:
+        for chunk in chunks:
+            chunk = _arrow_safe(pd.DataFrame(chunk).copy())
+            if schema is None:
+                schema = pa.Schema.from_pandas(chunk,preserve_index=False)
+                schema = pa.schema([pa.field(x.name,pa.string()) if pa.types.is_null(x.type) else x for x in schema])
+                schema = schema.remove_metadata()
+                writer = pq.ParquetWriter(fp,schema)
+            chunk = chunk.reindex(columns=schema.names)
+            for field in schema:
+                if pa.types.is_string(field.type):
+                    chunk[field.name] = chunk[field.name].where(chunk[field.name].isna(),chunk[field.name].astype(str))
+            writer.write_table(pa.Table.from_pandas(chunk,schema=schema,preserve_index=False))
+            num_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_rows
+
+def read_table(fp,columns=None,filters:list=None):
+    '''
+    Reads a table written by write_table.
+
+    columns is a list of columns to read or a function that is given the
+    column names in the file and returns the ones to read.
+
+    filters are pyarrow row filters like [('osm_linkid','in',ids)] that are
+    applied while reading Parquet files (and after reading for pickles).
+    GeoParquet files are returned as GeoDataFrames.
+    '''
+    fp = Path(fp)
+
+    if fp.suffix == '.pkl':
+        df = pd.read_pickle(fp)
+        if callable(columns):
+            columns = columns(df.columns.tolist())
+        if filters is not None:
+            for col, op, value in filters:
+                df = df[_filter_mask(df[col],op,value)]
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    import pyarrow.parquet as pq
+    schema = pq.read_schema(fp)
+    if callable(columns):
+        columns = columns(schema.names)
+
+    #geoparquet has the geometry column info in its metadata
+    geo = (schema.metadata is not None) and (b'geo' in schema.metadata)
+    if geo:
+        return gpd.read_parquet(fp,columns=columns,filters=filters)
+    return pd.read_parquet(fp,columns=columns,filters=filters)
+
+def _filter_mask(series:pd.Series,op:str,value):
+    '''
+    Supporting function for read_table to apply pyarrow style filters to pickles
+    '''
+    if op == 'in':
+        return series.isin(value)
+    if op == 'not in':
+        return ~series.isin(value)
+    if op in ['=','==']:
+        return series == value
+    if op == '!=':
+        return series != value
+    if op == '<':
+        return series < value
+    if op == '<=':
+        return series <= value
+    if op == '>':
+        return series > value
+    if op == '>=':
+        return series >= value
+    raise ValueError(f'Unknown filter operation {op}')
+
+def _write_layer(gdf,fp,layer:str,append:bool=False):
+    '''
+    Supporting function for write_layers. Writes one layer in bulk through pyogrio's
+    Arrow interface (falls back to to_file if pyogrio isn't installed).
+    '''
+    fp = Path(fp)
+    if fp.suffix == '.parquet':
+        if append:
+            raise ValueError('Appending is only supported for GeoPackage layers')
+        write_table(gdf,fp)
+        return
+    try:
+        import pyogrio
+    except ImportError:
+        gdf.to_file(fp,layer=layer,driver='GPKG',mode='a' if append else 'w')
+        return
+    #the spatial index is filled once after the rows are inserted in one transaction
+    pyogrio.write_dataframe(_arrow_safe(gdf.copy()),fp,layer=layer,driver='GPKG',append=append,
+                            use_arrow=True,promote_to_multi=False,layer_options={'SPATIAL_INDEX':'YES'})
+
+def write_layers(layers:dict,fp=None,append:bool=False,workers:int=None):
+    '''
+    Writes GeoDataFrames to GeoPackage layers in bulk (or GeoParquet when the file ends
+    in .parquet). layers is {layer name: gdf} when fp is given, or {(fp, layer name): gdf}
+    to write to several files. With append=True rows are added to existing layers
+    (for writing a layer in chunks).
+
+    Files are written concurrently (one thread per file). Layers in the same file are
+    written one after another since a GeoPackage only allows one writer at a time.
+    '''
+    if fp is not None:
+        layers = {(fp,layer):gdf for layer, gdf in layers.items()}
+
+    files = {}
+    for (layer_fp, layer), gdf in layers.items():
+        files.setdefault(Path(layer_fp),[]).append((layer,gdf))
+
+    def write_file(layer_fp,file_layers):
+        for layer, gdf in file_layers:
+            _write_layer(gdf,layer_fp,layer,append)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers or len(files) or 1) as executor:
+        #result() raises any errors from the writes
+        for future in [executor.submit(write_file,layer_fp,file_layers) for layer_fp, file_layers in files.items()]:
+            future.result()
+
+def list_layers(fp):
+    '''
+    Layer names in a GeoPackage
+    '''
+    try:
+        import pyogrio
+        return pyogrio.list_layers(fp)[:,0].tolist()
+    except ImportError:
+        import fiona
+        return fiona.listlayers(fp)
+
+def layer_info(fp,layer:str):
+    '''
+    Number of features, field names, and extent of a GeoPackage layer (read from the
+    layer metadata without reading any features)
+    '''
+    try:
+        import pyogrio
+        info = pyogrio.read_info(fp,layer=layer)
+        return {'features':int(info['features']),'fields':list(info['fields']),'total_bounds':[float(x) for x in info['total_bounds']]}
+    except ImportError:
+        import fiona
+        with fiona.open(fp,layer=layer) as src:
+            return {'features':len(src),'fields':list(src.schema['properties']),'total_bounds':[float(x) for x in src.bounds]}
+
+def layer_last_change(fp,layer:str):
+    '''
+    Time a GeoPackage layer was last changed (gpkg_contents.last_change, which GDAL
+    updates whenever features are written or the layer is replaced)
+    '''
+    import sqlite3
+    with sqlite3.connect(f'file:{Path(fp).as_posix()}?mode=ro',uri=True) as con:
+        row = con.execute('SELECT last_change FROM gpkg_contents WHERE table_name = ?',(layer,)).fetchone()
+    return row[0] if row is not None else None
+
+def read_chunks(fp,layer:str,columns:list=None,chunk_size:int=500000):
+    '''
+    Reads a GeoPackage layer chunk_size features at a time (only the listed columns
+    and the geometry) so that large layers never have to fit in memory at once.
+    '''
+    try:
+        import pyogrio
+    except ImportError:
+        pyogrio = None
+
+    num_features = layer_info(fp,layer)['features']
+    for start in range(0,num_features,chunk_size):
+        if pyogrio is not None:
+            yield pyogrio.read_dataframe(fp,layer=layer,columns=columns,skip_features=start,max_features=chunk_size,use_arrow=True)
+        else:
+            chunk = gpd.read_file(fp,layer=layer,rows=slice(start,start+chunk_size))
+            yield chunk[columns + [chunk.geometry.name]] if columns is not None else chunk
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Topology checks for filtered or prepared networks.
+
+check_network runs every check on the whole link and node tables at once
+(no loops over links) and returns one row per problem:
+    self_loop: link starts and ends at the same node
+    zero_length: link geometry is shorter than min_length
+    duplicate_link: another link connects the same two nodes (either direction)
+        with the same attributes
+    parallel_link: another link connects the same two nodes with different attributes
+    missing_node: the A or B id is missing or isn't in the nodes
+    endpoint_mismatch: the first/last point of the link is more than tolerance from
+        its A/B node
+    dangling_node: node only connected to one link (dead end)
+    unused_node: node that isn't the A or B of any link
+    island: link that isn't in the largest connected component
+
+Issue table columns: issue, linkid (None for node issues), N (node id if the issue
+is about a node), and value (distance, length, or island size in links).
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from prepare_network import node_components
+from network_io import write_table
+from instrument import instrumented, count
+
+#columns left out of the default duplicate/parallel comparison since they differ between
+#true duplicates (lengths, travel times, and columns derived from the geometry), along with
+#columns ending in ID_SUFFIXES (source ids like osm_linkid and osm_A, and _ba columns)
+DERIVED_COLS = ['dist','mins','length','length_ft','bearing','A_B','ascent_ft','up_grade','max_grade','oneway_dir']
+ID_SUFFIXES = ('linkid','_N','_A','_B','_ba')
+
+def _issues(issue:str,linkid=None,N=None,value=None):
+    '''
+    Supporting function for check_network. Makes the issue rows for one check.
+    '''
+    size = len(linkid) if linkid is not None else len(N)
+    return pd.DataFrame({
+        'issue':issue,
+        'linkid':np.asarray(linkid,dtype=object) if linkid is not None else np.full(size,None,dtype=object),
+        'N':np.asarray(N,dtype=object) if N is not None else np.full(size,None,dtype=object),
+        'value':np.asarray(value,dtype=float) if value is not None else np.full(size,np.nan)
+        })
+
+@instrumented(outputs=('issues',))
+def check_network(links,nodes,network_name:str=None,attr_cols:list=None,tolerance:float=1,min_length:float=0.01,output_fp=None):
+    '''
+    Runs the topology checks (see module docstring). network_name is the column prefix
+    for the A, B, N, and linkid columns (e.g. 'osm'); without it the columns are A, B, N,
+    and linkid (the link index is used if there is no linkid column). attr_cols are the
+    columns compared for duplicate/parallel links. The default is every column except the
+    ids, geometry, source ids (ending in ID_SUFFIXES), and DERIVED_COLS, so pass attr_cols
+    if the links have other computed columns (e.g., impedances from link_costs).
+    tolerance and min_length are in CRS units.
+
+    Returns the issue table and writes it to output_fp (with network_io.write_table) if given.
+    '''
+    prefix = f'{network_name}_' if network_name is not None else ''
+    A, B, N, linkid = f'{prefix}A', f'{prefix}B', f'{prefix}N', f'{prefix}linkid'
+
+    ids = links[linkid].to_numpy() if linkid in links.columns else links.index.to_numpy()
+    a = links[A].to_numpy()
+    b = links[B].to_numpy()
+    geoms = links.geometry.to_numpy()
+    issues = []
+
+    #self loops and zero length links
+    loop = (a == b) & pd.notna(a)
+    issues.append(_issues('self_loop',ids[loop],a[loop]))
+    length = shapely.length(geoms)
+    short = length < min_length
+    issues.append(_issues('zero_length',ids[short],value=length[short]))
+
+    #duplicate and parallel links (same pair of nodes in either direction)
+    if attr_cols is None:
+        attr_cols = [x for x in links.columns if (x not in [A,B,linkid,links.geometry.name] + DERIVED_COLS)
+                     and not str(x).endswith(ID_SUFFIXES)]
+    pairs = pd.DataFrame({'lo':np.where(a < b,a,b),'hi':np.where(a < b,b,a)})
+    for col in attr_cols:
+        pairs[col] = links[col].astype(str).to_numpy()
+    multi = pairs.duplicated(['lo','hi'],keep=False).to_numpy() & ~loop
+    same = pairs.duplicated(['lo','hi'] + attr_cols,keep=False).to_numpy() & multi
+    issues.append(_issues('duplicate_link',ids[same]))
+    issues.append(_issues('parallel_link',ids[multi & ~same]))
+
+    #ids missing from the nodes
+    node_ids = nodes[N].to_numpy()
+    missing_a = ~pd.Series(a).isin(node_ids).to_numpy()
+    missing_b = ~pd.Series(b).isin(node_ids).to_numpy()
+    issues.append(_issues('missing_node',np.concatenate([ids[missing_a],ids[missing_b]]),np.concatenate([a[missing_a],b[missing_b]])))
+
+    #link ends that don't line up with their nodes
+    node_geo = pd.Series(nodes.geometry.to_numpy(),index=node_ids)
+    node_geo = node_geo[~node_geo.index.duplicated()]
+    for end, col, missing in [(0,a,missing_a),(-1,b,missing_b)]:
+        dist = np.full(len(links),np.nan)
+        dist[~missing] = shapely.distance(shapely.get_point(geoms[~missing],end),node_geo.reindex(col[~missing]).to_numpy())
+        far = dist > tolerance
+        issues.append(_issues('endpoint_mismatch',ids[far],col[far],dist[far]))
+
+    #dead ends and nodes without links
+    degree = pd.Series(np.concatenate([a,b])).value_counts()
+    dangling = degree.index[degree.to_numpy() == 1]
+    issues.append(_issues('dangling_node',N=dangling.to_numpy()))
+    unused = ~pd.Series(node_ids).isin(degree.index).to_numpy()
+    issues.append(_issues('unused_node',N=node_ids[unused]))
+
+    #links outside the largest component
+    known = pd.notna(a) & pd.notna(b)
+    if known.any():
+        _, labels, a_idx, b_idx = node_components(a[known],b[known])
+        link_labels = labels[a_idx]
+        sizes = np.bincount(link_labels)
+        island = link_labels != np.argmax(sizes)
+        issues.append(_issues('island',ids[known][island],value=sizes[link_labels[island]]))
+
+    issues = pd.concat(issues,ignore_index=True)
+    counts = issues['issue'].value_counts()
+    count(**counts.to_dict())
+    print(counts if len(counts) > 0 else 'No issues found')
+
+    if output_fp is not None:
+        write_table(issues,output_fp)
+
+    return issues
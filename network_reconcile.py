@@ -1,3 +1,4 @@
+import re
 import geopandas as gpd
 import pandas as pd
 #import osmnx as ox
@@ -11,6 +12,9 @@ from shapely.ops import LineString, Point, MultiPoint
 from pathlib import Path
 import geopandas as gpd
 
+from network_io import read_table
+from instrument import instrumented
+
 def add_attributes(base_links:gpd.GeoDataFrame, join_links:gpd.GeoDataFrame, join_name:str, buffer_ft:float, bearing_diff:bool, dissolve:bool):
     '''
     This function is used for adding attribute data from the join network to the base network. To do this,
@@ -172,72 +176,91 @@ def calculate_bearing(lat1, lon1, lat2, lon2):
     return initial_bearing % 360
 
 
-def add_osm_attr(links,attr_fp):
+#osm tags used by add_osm_attr (the bike/foot tag columns are found from the column names)
+OSM_TAGS = ['name','highway','highway_1','oneway','oneway:bicycle','foot','maxspeed','lanes','bearing']
+
+#osm highway values that are multi-use paths
+MUPS = ['path','footway','pedestrian','steps']
+
+def osm_bike_columns(columns:list):
+    '''
+    Returns the bike specific tag columns (cycle, bike, or foot in the tag but not motorcycle)
+    '''
+    return [x for x in columns if (('cycle' in x) | ('bike' in x) | ('foot' in x)) & ('motorcycle' not in x)]
+
+def parse_speed(maxspeed:pd.Series,default_unit:str='km/h'):
+    '''
+    Converts osm maxspeed tags (e.g., '35 mph', '50 km/h', '30;40') to mph. Only the first
+    number is used. Numbers without a unit are assumed to be in default_unit ('mph' or 'km/h').
+    OSM defines unitless maxspeed as km/h, but US mappers often leave off the unit, so
+    pass 'mph' for US networks. Tags without a number (e.g., 'none', 'signals') become NaN.
+    '''
+    parts = maxspeed.astype('string').str.extract(r'(\d+(?:\.\d+)?)\s*(mph|km/h|kmh|kph|knots)?',flags=re.IGNORECASE)
+    speed = pd.to_numeric(parts[0]).astype(float)
+    unit = parts[1].str.lower().fillna(default_unit)
+    speed = speed.where(~unit.isin(['km/h','kmh','kph']),speed * 0.621371)
+    speed = speed.where(unit != 'knots',speed * 1.15078)
+    return speed.round(0).to_numpy()
+
+def parse_lanes(lanes:pd.Series):
+    '''
+    Converts osm lanes tags to numbers (the first number is used for tags like '2;3')
+    '''
+    lanes = lanes.astype('string').str.extract(r'(\d+(?:\.\d+)?)')[0]
+    return pd.to_numeric(lanes).astype(float).to_numpy()
+
+@instrumented()
+def add_osm_attr(links,attr_fp,default_speed_unit:str='km/h'):
+    '''
+    Adds the osm attributes to the filtered osm links and derives the bike facility
+    (osm_bl, osm_pbl, osm_mu), speed limit (osm_speed_mph), and number of lanes (osm_lanes)
+    columns. Only the tag columns that are needed are read from the attribute table.
+    default_speed_unit is the unit of maxspeed tags without one (see parse_speed).
+    '''
     network = 'osm'
     
-    #bring in attribute data
-    attr = pd.read_pickle(attr_fp)
-    attr.drop(columns=['osm_A','osm_B'],inplace=True)
+    #bring in only the needed attribute data (columns and links)
+    select = lambda columns: ['osm_linkid'] + [x for x in dict.fromkeys(OSM_TAGS + osm_bike_columns(columns)) if x in columns]
+    attr = read_table(attr_fp,select,filters=[('osm_linkid','in',links['osm_linkid'].unique().tolist())])
+    bike_columns = osm_bike_columns(attr.columns.tolist())
 
     #attach attribute data to filtered links
     links = pd.merge(links,attr,on=['osm_linkid'],how='left')
 
-    #init columns
-    columns_to_add = ['bl','pbl','mu','speed_mph','lanes']
-
-    for col in columns_to_add:
-        links[network + '_' + col] = 0
+    #missing tags
+    for col in ['highway','foot','maxspeed','lanes']:
+        if col not in links.columns:
+            links[col] = None
 
     # bike facils
-    #find bike lanes
-    #get all bike specific columns (find features with cycle, foot, or bike in tags but not motorcycle)
-    bike_columns = [x for x in links.columns.to_list() if (('cycle' in x) | ('bike' in x)) & ('motorcycle' not in x)]
-    foot_columns = [x for x in links.columns.to_list() if ('foot' in x)]
-    bike_columns = bike_columns + foot_columns
-    bl_cond = ((links[bike_columns] == 'lane').any(axis=1)) & (links['highway'] != 'cycleway')
-    #bl.to_file(Path.home() / 'Downloads/testing.gpkg', layer = 'bls')
-
-    #anything that contains lane is a bike lane
-    links.loc[bl_cond,network+'_bl'] = 1
+    highway = links['highway'].to_numpy()
+    cycleway = highway == 'cycleway'
+    
+    #find bike lanes (anything that contains lane is a bike lane)
+    bl = np.zeros(len(links),dtype=bool)
+    for col in bike_columns:
+        bl |= (links[col] == 'lane').to_numpy()
+    links[network+'_bl'] = (bl & ~cycleway).astype(np.int8)
 
     #find protected bike lanes
-    if (links.columns == 'highway_1').any():
-        pbl_cond = (links['highway'] == 'cycleway') | links['highway_1']=='cycleway'#& (links['foot'] == 'no')
-    else:
-        pbl_cond = (links['highway'] == 'cycleway')
-    links.loc[pbl_cond, network+'_pbl'] = 1
+    pbl = cycleway.copy()
+    if 'highway_1' in links.columns:
+        pbl |= (links['highway_1'] == 'cycleway').to_numpy()
+    links[network+'_pbl'] = pbl.astype(np.int8)
 
     #find mups
-    mups = ['path','footway','pedestrian','steps']
-    mup_cond = (links['highway'].isin(mups)) | ((links['highway'] == 'cycleway') & (links['foot'] != 'no'))
-    links.loc[mup_cond, network+'_mu'] = 1
+    mu = links['highway'].isin(MUPS).to_numpy() | (cycleway & (links['foot'] != 'no').to_numpy())
+    links[network+'_mu'] = mu.astype(np.int8)
 
     #resolve conflicts
     if (links[[network+'_mu',network+'_pbl',network+'_bl']].sum(axis=1) > 1).any():
         print('more than one bike facility detected')
 
-    #speed limit (come back to this)
-    #change nones to NaN
-    links['maxspeed'] = pd.to_numeric(links['maxspeed'],errors='coerce').fillna(links['maxspeed'])
-    
-    #covert strings to numbers (gets rid of units, but won't work if no numbers present)
-    func = lambda x: float(str.split(x,' ')[0]) if isinstance(x,str) else x
-    links['speed_mph'] = links['maxspeed'].apply(func)
-
-    # links.loc[(links['maxspeed'] < 25), network+'_<25mph'] = 1
-    # links.loc[(links['maxspeed'] >= 25) & (links['maxspeed'] <= 30), network+'_25-30mph'] = 1
-    # links.loc[(links['maxspeed'] > 30), network+'_>30mph'] = 1
+    #speed limit
+    links[network+'_speed_mph'] = parse_speed(links['maxspeed'],default_speed_unit)
 
     #number of lanes
-    #convert none to nan
-    links['lanes'] = links['lanes'].apply(lambda x: np.nan if x == None else x)
-
-    #make sure numeric
-    links['lanes'] = pd.to_numeric(links['lanes'])
-
-    # links.loc[links['lanes'] < 3, network+'_1lpd'] = 1
-    # links.loc[(links['lanes'] >= 3) & (links['lanes'] < 6), network+'_2-3lpd'] = 1
-    # links.loc[links['lanes'] >= 8, network+'_>4lpd'] = 1
+    links[network+'_lanes'] = parse_lanes(links['lanes'])
 
     #OTHER ATTRIBUTES
     # =============================================================================
@@ -260,127 +283,224 @@ def add_osm_attr(links,attr_fp):
     # links.drop(columns=['sidewalk'],inplace=True)
     # =============================================================================
 
+    columns_to_add = ['bl','pbl','mu','speed_mph','lanes']
     final_cols = ['A','B','linkid'] + columns_to_add
     final_cols = [ network + '_' + x for x in final_cols]
-    final_cols = ['name','highway','oneway','bearing'] + final_cols+['geometry']
+    final_cols = ['name','highway','oneway','oneway:bicycle','cycleway','cycleway:left','cycleway:right','cycleway:both','bearing'] + final_cols+['geometry']
 
-    links = links[set(links.columns) & set(final_cols)]
+    links = links[[x for x in final_cols if x in links.columns]]
 
     return links
 
-def add_here_attr(links,attr_fp):
+#source adapters describe how to turn the attributes of another network into link attributes
+#key: columns used to match the attribute table to the links (None if the attributes are on the links)
+#codes: {column: {code: value}} lookup tables (codes not in the table become NaN)
+#bins: {column: (edges, labels)} numeric bins where edges are the lower bound of each label after the first
+#indicators: {new column: (column, values)} 0/1 columns for when column is one of values (after codes/bins)
+#keep: other columns to carry over as is
+SOURCE_ADAPTERS = {}
 
-    network = 'here'
+def register_source(name:str,key:list=None,codes:dict=None,bins:dict=None,indicators:dict=None,keep:list=None):
+    '''
+    Adds a source adapter to SOURCE_ADAPTERS so that its attributes can be added with
+    build_link_attributes (see above for what each argument means).
+    '''
+    SOURCE_ADAPTERS[name] = {'key':key,'codes':dict(codes or {}),'bins':dict(bins or {}),
+                             'indicators':dict(indicators or {}),'keep':list(keep or [])}
 
-    #bring in attribute data
-    attr = pd.read_pickle(attr_fp)
+def source_columns(name:str):
+    '''
+    Returns the columns of the attribute table that a source adapter uses.
+    '''
+    adapter = SOURCE_ADAPTERS[name]
+    columns = (adapter['key'] or []) + list(adapter['codes']) + list(adapter['bins']) + adapter['keep']
+    columns += [col for col, values in adapter['indicators'].values()]
+    return list(dict.fromkeys(columns))
 
-    #attach attribute data to filtered links
-    links = pd.merge(links,attr,on='linkid')
+def apply_source(attr:pd.DataFrame,name:str):
+    '''
+    Derives the link attributes of a source from its attribute table. Lookups are done on
+    the categorical codes of each column (np.take) instead of per value.
+    '''
+    adapter = SOURCE_ADAPTERS[name]
+    derived = {}
+
+    for col, table in adapter['codes'].items():
+        values = attr[col]
+        #float codes (e.g., 1.0 in a column with missing values) need to match the '1' keys
+        if pd.api.types.is_float_dtype(values) and (np.mod(values.dropna(),1) == 0).all():
+            values = values.astype('Int64')
+        raw = pd.Categorical(values.astype(str))
+        categories = list(dict.fromkeys(table.values()))
+        lookup = np.array([categories.index(table[x]) if x in table else -1 for x in raw.categories] + [-1])
+        derived[col] = pd.Categorical.from_codes(np.take(lookup,raw.codes),categories)
+
+    for col, (edges, labels) in adapter['bins'].items():
+        values = pd.to_numeric(attr[col],errors='coerce').to_numpy(dtype=float)
+        idx = np.where(np.isnan(values),-1,np.digitize(values,edges))
+        derived[col] = pd.Categorical.from_codes(idx,labels)
+
+    for col in adapter['keep']:
+        derived[col] = attr[col].to_numpy()
+
+    derived = pd.DataFrame(derived,index=attr.index)
+
+    for new_col, (col, values) in adapter['indicators'].items():
+        source = derived[col] if col in derived.columns else attr[col]
+        derived[new_col] = source.isin(values).to_numpy().astype(np.int8)
+
+    return derived
+
+@instrumented()
+def build_link_attributes(links:pd.DataFrame,sources:dict):
+    '''
+    Builds one link attribute table from any number of sources. sources is a dictionary
+    of {adapter name: attribute table}. Each attribute table is matched to the links
+    once with an index lookup on the adapter's key columns and the derived columns are
+    taken by position, so adding another source doesn't mean another merge. The output
+    has the same index as links. Links without a match get NaN (0 for indicators).
+    '''
+    link_attr = pd.DataFrame(index=links.index)
+
+    for name, attr in sources.items():
+        adapter = SOURCE_ADAPTERS[name]
+        derived = apply_source(attr,name)
+
+        #position of each link in the attribute table
+        if adapter['key'] is None:
+            pos = np.arange(len(links))
+        else:
+            key = adapter['key']
+            if attr.duplicated(subset=key).any():
+                print(f'{name} attributes have duplicate keys, using the first')
+                keep = ~attr.duplicated(subset=key).to_numpy()
+                attr, derived = attr[keep], derived[keep]
+            pos = pd.MultiIndex.from_frame(attr[key]).get_indexer(pd.MultiIndex.from_frame(links[key]))
         
-    #init columns
-    columns_to_add = ['<25mph','25-30mph','>30mph','1lpd','2-3lpd','>4lpd']
-
-    for col in columns_to_add:
-        links[network + '_' + col] = 0
-
-    # speed categories
-    here_speed_bins = {
-        '1': '> 30', # '> 80 MPH',
-        '2': '> 30', # '65-80 MPH',
-        '3': '> 30', # '55-64 MPH',
-        '4': '> 30', # '41-54 MPH',
-        '5': '> 30', # '31-40 MPH',
-        '6': '25-30', # '21-30 MPH',
-        '7': '< 25', # '6-20 MPH',
-        '8': '< 25' # '< 6 MPH'
-        }
-    links['SPEED_CAT'] = links['SPEED_CAT'].map(here_speed_bins)
-    links.loc[links['SPEED_CAT']=='< 25', network+'_<25mph'] = 1
-    links.loc[links['SPEED_CAT']=='25-30', network+'_25-30mph'] = 1
-    links.loc[links['SPEED_CAT']=='> 30', network+'_>30mph'] = 1
-
-    # number of lanes
-    here_lane_bins = {
-        '1': '1', # 'one lane',
-        '2': '2-3', # 'two or three lanes',
-        '3': '> 4' # 'four or more'
-        }
-    links['LANE_CAT'] = links['LANE_CAT'].map(here_lane_bins)
-    links.loc[links['LANE_CAT']=='1', network+'_1lpd'] = 1
-    links.loc[links['LANE_CAT']=='2-3', network+'_2-3lpd'] = 1
-    links.loc[links['LANE_CAT']=='> 4', network+'_>4lpd'] = 1
-
-    # road directionality
-    here_oneway_bins = {
-        'B':'both', # Both Directions
-        'F':'oneway', # From Reference Node
-        'T':'wrongway', # To Reference Node
-        'N': 'NA' # Closed in both directions
-        }
-    links['DIR_TRAVEL'] = links['DIR_TRAVEL'].map(here_oneway_bins)
-
-    # here functional class (does not correspond to FHWA or HFCS)
-    func_class = {
-        '1':'highways',
-        '2':'major arterials',
-        '3':'collectors/minor arterials',
-        '4':'collectors/minor atrerials',
-        '5':'local'
+        matched = pos >= 0
+        if (~matched).any():
+            print(f'{(~matched).sum()} links did not match to {name} attributes')
+        
+        taken = derived.take(np.where(matched,pos,0))
+        taken.index = links.index
+        for col in derived.columns:
+            if col in adapter['indicators']:
+                link_attr[col] = np.where(matched,taken[col],0).astype(np.int8)
+            else:
+                link_attr[col] = taken[col].where(matched)
+
+    return link_attr
+
+# here speed categories
+here_speed_bins = {
+    '1': '> 30', # '> 80 MPH',
+    '2': '> 30', # '65-80 MPH',
+    '3': '> 30', # '55-64 MPH',
+    '4': '> 30', # '41-54 MPH',
+    '5': '> 30', # '31-40 MPH',
+    '6': '25-30', # '21-30 MPH',
+    '7': '< 25', # '6-20 MPH',
+    '8': '< 25' # '< 6 MPH'
+    }
+
+# here number of lanes
+here_lane_bins = {
+    '1': '1', # 'one lane',
+    '2': '2-3', # 'two or three lanes',
+    '3': '> 4' # 'four or more'
+    }
+
+# here road directionality
+here_oneway_bins = {
+    'B':'both', # Both Directions
+    'F':'oneway', # From Reference Node
+    'T':'wrongway', # To Reference Node
+    'N': 'NA' # Closed in both directions
+    }
+
+# here functional class (does not correspond to FHWA or HFCS)
+here_func_class = {
+    '1':'highways',
+    '2':'major arterials',
+    '3':'collectors/minor arterials',
+    '4':'collectors/minor atrerials',
+    '5':'local'
+    }
+
+register_source('here',
+    key = ['here_linkid'],
+    codes = {'SPEED_CAT':here_speed_bins,'LANE_CAT':here_lane_bins,'DIR_TRAVEL':here_oneway_bins,'FUNC_CLASS':here_func_class},
+    indicators = {
+        'here_<25mph':('SPEED_CAT',['< 25']),
+        'here_25-30mph':('SPEED_CAT',['25-30']),
+        'here_>30mph':('SPEED_CAT',['> 30']),
+        'here_1lpd':('LANE_CAT',['1']),
+        'here_2-3lpd':('LANE_CAT',['2-3']),
+        'here_>4lpd':('LANE_CAT',['> 4'])
+        },
+    keep = ['ST_NAME']
+    )
+
+#abm speed limits are binned like the here speed categories (speed limits are whole numbers)
+register_source('abm',
+    key = ['here_A','here_B','here_linkid'],
+    bins = {'SPEEDLIMIT':([6,21,31,41,55,65,81],['< 6 MPH','6-20 MPH','21-30 MPH','31-40 MPH','41-54 MPH','55-64 MPH','65-80 MPH','> 80 MPH'])},
+    keep = ['NAME']
+    )
+
+#arc bike inventory (attributes are already on the links)
+register_source('arc',
+    indicators = {
+        'arc_bl':('facil',['Bike Lane']),
+        'arc_pbl':('facil',['Protected Bike Lane']),
+        'arc_mu':('facil',['Multi-Use Path'])
         }
-    links['FUNC_CLASS'] = links['FUNC_CLASS'].map(func_class)
+    )
 
-    final_cols = ['A','B','linkid'] + columns_to_add
-    final_cols = [ network + '_' + x for x in final_cols]
+def add_here_attr(links,attr_fp):
+    '''
+    Adds the here attributes (speed and lane categories, direction of travel, functional
+    class, and street name) to the filtered here links using the 'here' source adapter.
+    '''
+    network = 'here'
+    attr = read_table(attr_fp,lambda columns: [x for x in source_columns(network) if x in columns],
+                      filters=[('here_linkid','in',links['here_linkid'].unique().tolist())])
+    link_attr = build_link_attributes(links,{network:attr})
 
-    links = links[final_cols+['ST_NAME','FUNC_CLASS','DIR_TRAVEL','geometry']]
+    #only keep links with attributes (like the inner merge this replaced)
+    links = links.join(link_attr)[links['here_linkid'].isin(attr['here_linkid'])]
+    
+    indicator_cols = list(SOURCE_ADAPTERS[network]['indicators'])
+    links = links[['here_A','here_B','here_linkid']+indicator_cols+['ST_NAME','FUNC_CLASS','DIR_TRAVEL','geometry']]
 
     return links
 
 def add_abm_attr(links,attr_fp):
+    '''
+    Adds the abm street name and speed limit category to links with here ids using the
+    'abm' source adapter.
+    '''
+    network = 'abm'
+    attr = read_table(attr_fp,lambda columns: [x for x in source_columns(network) if x in columns],
+                      filters=[('here_linkid','in',links['here_linkid'].unique().tolist())])
+    link_attr = build_link_attributes(links,{network:attr})
 
-    #bring in attribute data
-    attr = pd.read_pickle(attr_fp)
-
-    #attach attribute data to filtered links
-    links = pd.merge(links,attr,on=['here_A','here_B','here_linkid'])
-    
-    #speed
-    links['SPEEDLIMIT']
-
-    conditions = [
-        (links['SPEEDLIMIT'] > 80),
-        (links['SPEEDLIMIT'] >= 65) & (links['SPEEDLIMIT'] < 80),
-        (links['SPEEDLIMIT'] >= 55) & (links['SPEEDLIMIT'] < 64),
-        (links['SPEEDLIMIT'] >= 41) & (links['SPEEDLIMIT'] < 54),
-        (links['SPEEDLIMIT'] >= 31) & (links['SPEEDLIMIT'] < 40),
-        (links['SPEEDLIMIT'] >= 21) & (links['SPEEDLIMIT'] < 30),
-        (links['SPEEDLIMIT'] >= 6) & (links['SPEEDLIMIT'] < 20),
-        (links['SPEEDLIMIT'] < 6)
-    ]
-    values = ['> 80 MPH', '65-80 MPH', '55-64 MPH', '41-54 MPH', '31-40 MPH', '21-30 MPH', '6-20 MPH', '< 6 MPH']
-
-    links['SPEEDLIMIT'] = np.select(conditions, values)
-
-    #oneway
-    #links['oneway'] = links['two_way'] == False
-    links = links[['NAME','SPEEDLIMIT']]
+    #only keep links with attributes (like the inner merge this replaced)
+    matched = pd.MultiIndex.from_frame(links[SOURCE_ADAPTERS[network]['key']]).isin(pd.MultiIndex.from_frame(attr[SOURCE_ADAPTERS[network]['key']]))
+    links = links.join(link_attr)[matched]
+    links = links[['here_A','here_B','here_linkid','NAME','SPEEDLIMIT','geometry']]
 
     return links
 
 def add_arc_bike(links):
-
+    '''
+    Adds the bike facility columns (arc_bl, arc_pbl, arc_mu) to the arc bike inventory
+    using the 'arc' source adapter.
+    '''
     network = 'arc'
+    link_attr = build_link_attributes(links,{network:links})
 
-    columns_to_add = ['bl','pbl','mu']
-
-    for col in columns_to_add:
-        links[network + '_' + col] = 0
-
-    links.loc[links['facil']=='Protected Bike Lane', network+'_pbl'] = 1
-    links.loc[links['facil']=='Bike Lane', network+'_bl'] = 1
-    links.loc[(links['facil']=='Multi-Use Path'), network+'_mu'] = 1
-
+    links = links[['geometry']].join(link_attr)
     links = links[[network+'_bl',network+'_pbl',network+'_mu','geometry']]
 
     return links
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for updating an already built network from an OSM change diff
+instead of re-running the filtering, reconciliation, and finalizing steps
+from scratch. Everything is keyed on the osm_linkid column.
+
+The diff is a dictionary:
+    "added": GeoDataFrame of new ways with the same attribute columns as osm.pkl
+    "modified": GeoDataFrame of changed ways (same format as added)
+    "deleted": list of osm_linkids (osm way ids) that were removed
+
+Only the per-link work (classification, node ids, osm attributes, and travel
+direction) is limited to the changed links. Each step still reads and rewrites
+whole layers and the connected components are recomputed over the full network,
+so the savings come from skipping the per-link steps, not the I/O. Final networks
+that were simplified (contract_degree2) or had elevation added can't be updated
+this way since the update doesn't redo the contraction or the DEM sampling;
+rebuild those with the pipeline instead.
+"""
+
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+
+from helper_functions import ckdnearest
+from network_io import read_table, write_table, write_layers
+from network_filter import classify_links, make_nodes, add_ref_ids, filter_nodes, link_stats, write_stats_sidecar, OSM_LINK_TYPES
+from network_reconcile import add_osm_attr
+from instrument import instrumented
+from prepare_network import create_bws_links, create_bws_nodes, oneway_direction, largest_comp_and_simplify, add_dist_mins, dense_ids, write_crosswalks
+
+#columns added to the final network by elevation.add_elevation/add_grade_mins
+ELEVATION_COLS = ['elev_A','elev_B','ascent_ft','up_grade','max_grade','mins_ba']
+
+def check_updatable(settings:dict):
+    '''
+    Raises a ValueError if final_network.gpkg was simplified or has elevation columns,
+    since update_final would replace it with an unsimplified network without them.
+    A network is simplified if link_map.parquet has merged links (seq > 0) whose
+    original links aren't in the final network.
+    '''
+    output_fp = settings['output_fp']
+    final_links = gpd.read_file(output_fp / 'final_network.gpkg',layer='links',ignore_geometry=True)
+
+    enriched = [x for x in ELEVATION_COLS if x in final_links.columns]
+    if len(enriched) > 0:
+        raise ValueError(f'final_network.gpkg has elevation columns ({", ".join(enriched)}) that an incremental update would drop, rebuild it instead')
+
+    link_map_fp = output_fp / 'link_map.parquet'
+    if link_map_fp.exists() and ('osm_linkid' in final_links.columns):
+        link_map = read_table(link_map_fp)
+        merged = link_map.loc[link_map['seq'] > 0,'orig_osm_linkid']
+        if (~merged.isin(final_links['osm_linkid'])).any():
+            raise ValueError('final_network.gpkg was simplified (see link_map.parquet) and an incremental update would undo it, rebuild it instead')
+
+@instrumented()
+def incremental_update(settings:dict,diff:dict,spd_mph:float,rules:list=OSM_LINK_TYPES,link_types:list=['road','bike'],tolerance_ft:float=3,
+                       default_speed_unit:str='km/h'):
+    '''
+    Updates filtered.gpkg, osm_attr.parquet, reconciled_network.gpkg, and final_network.gpkg
+    in settings['output_fp'] using an OSM change diff. Only the changed links are
+    classified, get node ids, have their attributes added, and get a travel direction.
+    The layers are still rewritten in full and the largest connected component is
+    recomputed over the whole network (from the link ids only).
+
+    Simplified or elevation enriched final networks are rejected before anything is
+    written (see check_updatable). Link costs (link_costs) need to be re-applied to
+    the final network afterwards.
+    '''
+    check_updatable(settings)
+    changed_links, removed = update_filtered(settings,diff,rules,tolerance_ft)
+    update_reconciled(settings,changed_links,removed,link_types,default_speed_unit)
+    update_final(settings,removed,spd_mph)
+
+def diff_ids(diff:dict):
+    '''
+    Returns the osm_linkids of the links that need to be added and the osm_linkids of
+    the links that need to be removed (deleted or modified) from the existing network.
+    '''
+    new_links = pd.concat([diff.get('added'),diff.get('modified')],ignore_index=True)
+    new_links = new_links.rename(columns={'osmid':'osm_linkid'})
+
+    removed = set(diff.get('deleted',[]))
+    if diff.get('modified') is not None:
+        removed |= set(new_links['osm_linkid'])
+
+    return gpd.GeoDataFrame(new_links,geometry='geometry',crs=new_links.crs), removed
+
+@instrumented(outputs=('links',))
+def update_filtered(settings:dict,diff:dict,rules:list=OSM_LINK_TYPES,tolerance_ft:float=3):
+    '''
+    Applies the diff to the osm layers of filtered.gpkg and to osm_attr.parquet.
+
+    Endpoints of the new links that are within tolerance_ft of an existing node
+    are given that node's id. The remaining endpoints become new nodes numbered
+    after the largest existing node id.
+    '''
+    filtered_fp = settings['output_fp'] / 'filtered.gpkg'
+    attr_fp = settings['output_fp'] / 'osm_attr.parquet'
+
+    new_links, removed = diff_ids(diff)
+    if new_links.crs != settings['crs']:
+        new_links.to_crs(settings['crs'],inplace=True)
+
+    links = gpd.read_file(filtered_fp,layer='osm_links')
+    nodes = gpd.read_file(filtered_fp,layer='osm_nodes')
+    links = links[~links['osm_linkid'].isin(removed)]
+    print(f'{len(removed)} links removed or modified and {len(new_links)} links added or modified')
+
+    #make candidate nodes at the endpoints of the new links
+    cand = make_nodes(new_links,'osm').rename(columns={'osm_N':'cand_N'})
+    cand = ckdnearest(cand,nodes[['osm_N','geometry']].rename(columns={'geometry':'node_geo'}).set_geometry('node_geo'))
+
+    #reuse existing nodes within the tolerance otherwise make a new node
+    snapped = cand['dist'] <= tolerance_ft
+    new_ids = np.arange(cand.shape[0] - snapped.sum()) + nodes['osm_N'].max() + 1
+    cand.loc[~snapped,'osm_N'] = new_ids
+    cand['osm_N'] = cand['osm_N'].astype(nodes['osm_N'].dtype)
+
+    new_nodes = gpd.GeoDataFrame(cand.loc[~snapped,['osm_N','geometry']],geometry='geometry',crs=nodes.crs)
+    nodes = pd.concat([nodes,new_nodes],ignore_index=True)
+
+    #add reference ids (every endpoint now has a node)
+    endpoint_nodes = gpd.GeoDataFrame(cand[['osm_N','geometry']],geometry='geometry',crs=nodes.crs)
+    new_links = add_ref_ids(new_links,endpoint_nodes,'osm')
+
+    #update the attribute table
+    attr = read_table(attr_fp,filters=[('osm_linkid','not in',list(removed))] if len(removed) > 0 else None)
+    attr = pd.concat([attr,new_links.drop(columns=['geometry'])],ignore_index=True)
+    write_table(attr,attr_fp)
+
+    #classify just the new links
+    new_links = classify_links(new_links,rules)
+
+    links = pd.concat([links,new_links[links.columns.intersection(new_links.columns)]],ignore_index=True)
+    nodes = filter_nodes(links,nodes,'osm')
+
+    write_layers({'osm_links':links,'osm_nodes':nodes},filtered_fp)
+    #keep the summary stats current
+    write_stats_sidecar(filtered_fp,'osm_links',link_stats(links.assign(length=links.length),'osm'))
+
+    changed_links = links[links['osm_linkid'].isin(new_links['osm_linkid'])]
+
+    return changed_links, removed
+
+@instrumented()
+def update_reconciled(settings:dict,changed_links:gpd.GeoDataFrame,removed:set,link_types:list=['road','bike'],
+                      default_speed_unit:str='km/h'):
+    '''
+    Replaces the removed/modified links in reconciled_network.gpkg and adds the
+    osm attributes to only the changed links (default_speed_unit goes to add_osm_attr,
+    use the one the network was built with).
+    '''
+    reconciled_fp = settings['output_fp'] / 'reconciled_network.gpkg'
+    filtered_fp = settings['output_fp'] / 'filtered.gpkg'
+
+    links = gpd.read_file(reconciled_fp,layer='links')
+    links = links[~links['osm_linkid'].isin(removed)]
+
+    changed_links = changed_links[changed_links['link_type'].isin(link_types)]
+    changed_links = add_osm_attr(changed_links,settings['output_fp'] / 'osm_attr.parquet',default_speed_unit)
+    links = pd.concat([links,changed_links[links.columns.intersection(changed_links.columns)]],ignore_index=True)
+
+    #nodes come from the updated filtered network
+    nodes = gpd.read_file(filtered_fp,layer='osm_nodes')
+    nodes = filter_nodes(links,nodes,'osm')
+
+    write_layers({'links':links,'nodes':nodes},reconciled_fp)
+
+@instrumented()
+def update_final(settings:dict,removed:set,spd_mph:float):
+    '''
+    Updates final_network.gpkg from the updated reconciled network. The largest
+    component is found from the link ids, then links that are no longer in it are
+    dropped and only links that aren't in the final network yet (changed links and
+    links that became connected) are prepared. Both layers are rewritten. Simplified
+    and elevation enriched final networks raise a ValueError (see check_updatable).
+    '''
+    check_updatable(settings)
+    reconciled_fp = settings['output_fp'] / 'reconciled_network.gpkg'
+    final_fp = settings['output_fp'] / 'final_network.gpkg'
+
+    rec_links = gpd.read_file(reconciled_fp,layer='links')
+    rec_nodes = gpd.read_file(reconciled_fp,layer='nodes')
+    links = gpd.read_file(final_fp,layer='links')
+    nodes = gpd.read_file(final_fp,layer='nodes')
+
+    #back to the osm ids (see dense_ids) so the prepared links and nodes can be added
+    if 'osm_N' in nodes.columns:
+        links = links.assign(A=links['osm_A'],B=links['osm_B']).drop(columns=['osm_A','osm_B','linkid'])
+        nodes = nodes.assign(N=nodes['osm_N']).drop(columns=['osm_N'])
+
+    #largest component of the updated network
+    comp_links, comp_nodes = largest_comp_and_simplify(rec_links,rec_nodes,'osm')
+
+    #drop removed/modified links and links no longer connected
+    links = links[~links['osm_linkid'].isin(removed) & links['osm_linkid'].isin(comp_links['osm_linkid'])]
+    nodes = nodes[nodes['N'].isin(comp_nodes['osm_N'])]
+
+    #prepare the links and nodes that need to be added
+    add_links = comp_links[~comp_links['osm_linkid'].isin(links['osm_linkid'])]
+    add_nodes = comp_nodes[~comp_nodes['osm_N'].isin(nodes['N'])]
+    print(f'Preparing {len(add_links)} links and {len(add_nodes)} nodes')
+
+    add_links = create_bws_links(add_links)
+    add_links['oneway_dir'] = oneway_direction(add_links)
+    add_links = add_dist_mins(add_links,spd_mph)
+    add_nodes = create_bws_nodes(add_nodes)
+
+    links = pd.concat([links,add_links[links.columns.intersection(add_links.columns)]],ignore_index=True)
+    nodes = pd.concat([nodes,add_nodes],ignore_index=True)
+
+    #renumber the dense ids
+    links, nodes = dense_ids(links,nodes,'osm')
+
+    write_layers({'nodes':nodes,'links':links},final_fp)
+    write_crosswalks(links,nodes,settings['output_fp'])
@@ -9,7 +9,8 @@ import requests
 import geopandas as gpd
 import pandas as pd
 import osmnx as ox
-import pickle
+
+from network_io import write_table
 
 def download_osm(studyarea_fp,crs,export_fp,desired_osm_attributes:list=None):
     
@@ -46,9 +47,8 @@ def download_osm(studyarea_fp,crs,export_fp,desired_osm_attributes:list=None):
             osm_links.drop(columns=col,inplace=True)
             print(f"{col} column removed for containing a list")
 
-    #pickle all attributes as is
-    with (export_fp/'osm.pkl').open('wb') as fh:
-        pickle.dump(osm_links,fh)
+    #export all attributes as is
+    write_table(osm_links,export_fp/'osm.parquet')
 
     return osmnx_nodes, osm_links
 
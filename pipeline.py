@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the network build (Steps 1-3 notebooks) as a pipeline.
+
+Each stage gets a fingerprint made from its parameters, the input files
+it reads (path, size, and modified time), and the fingerprints of the stages
+before it. Stages whose fingerprint hasn't changed since the last run and
+whose outputs still exist are skipped. The fingerprints and the wall time and
+peak memory of each stage (measured with instrument.stage) are stored in pipeline_cache.json in the output
+folder and the run stats are written to pipeline_stats.csv.
+
+Stages:
+    filter_{network}: filter_networks + classify_links (one per network, run in parallel,
+        or filter_networks_tiled when settings has a tile_size) -> filtered.gpkg
+    reconcile: add_osm_attr on the osm road and bike links -> reconciled_network.gpkg
+    prepare: prepare_network -> final_network.gpkg, node_crosswalk.parquet, link_crosswalk.parquet
+    costs: link_costs for each cost dictionary -> link_costs.parquet (linkid and the
+        impedance columns, so final_network.gpkg stays the prepare output)
+"""
+
+import json
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import geopandas as gpd
+import pandas as pd
+
+from network_filter import import_study_area, filter_networks, filter_networks_tiled, classify_links, filter_nodes, export, OSM_LINK_TYPES
+from network_reconcile import add_osm_attr
+from prepare_network import prepare_network, link_costs, write_crosswalks
+from network_io import write_table, write_layers
+from instrument import stage
+
+CACHE_FILE = 'pipeline_cache.json'
+
+def _digest(obj,h):
+    '''
+    Supporting function for fingerprint. Adds an object to the hash.
+    '''
+    if isinstance(obj,dict):
+        for key in sorted(obj,key=str):
+            h.update(str(key).encode())
+            _digest(obj[key],h)
+    elif isinstance(obj,(list,tuple,set)):
+        for x in (sorted(obj,key=str) if isinstance(obj,set) else obj):
+            _digest(x,h)
+    elif isinstance(obj,gpd.GeoDataFrame):
+        h.update(obj.to_json().encode())
+    elif isinstance(obj,pd.DataFrame):
+        h.update(pd.util.hash_pandas_object(obj).to_numpy().tobytes())
+    elif isinstance(obj,Path):
+        h.update(str(obj).encode())
+        #files are identified by their size and when they were last modified
+        if obj.is_file():
+            stat = obj.stat()
+            h.update(f'{stat.st_size}_{stat.st_mtime_ns}'.encode())
+    elif callable(obj):
+        h.update(getattr(obj,'__qualname__',repr(obj)).encode())
+    else:
+        h.update(repr(obj).encode())
+
+def fingerprint(*objs):
+    '''
+    Returns a hash of the given parameters and input files
+    '''
+    h = hashlib.sha256()
+    for obj in objs:
+        _digest(obj,h)
+    return h.hexdigest()
+
+def load_cache(output_fp:Path):
+    cache_fp = Path(output_fp) / CACHE_FILE
+    if cache_fp.exists():
+        with cache_fp.open() as fh:
+            return json.load(fh)
+    return {}
+
+def save_cache(cache:dict,output_fp:Path):
+    with (Path(output_fp) / CACHE_FILE).open('w') as fh:
+        json.dump(cache,fh,indent=2)
+
+def is_current(cache:dict,stage:str,stage_fp:str,outputs:list):
+    '''
+    A stage is current if its fingerprint matches the last run and its outputs exist
+    '''
+    return (cache.get(stage,{}).get('fingerprint') == stage_fp) and all(Path(x).exists() for x in outputs)
+
+def measure(func,*args):
+    '''
+    Runs a function and returns its result, the wall time (seconds), and the
+    peak memory allocated while it ran (MB).
+    '''
+    with stage(func.__name__.strip('_'),memory=True,measure=True) as s:
+        result = func(*args)
+    return result, s.event['wall_s'], s.event['peak_mb']
+
+def _filter_network(settings:dict,network_dict:dict,rules:list):
+    '''
+    Step 1 for one network (run in a worker process)
+    '''
+    links, nodes = filter_networks(settings,network_dict)
+    if rules is not None:
+        links = classify_links(links,rules)
+    return links, nodes
+
+def _reconcile(settings:dict,link_types:list,default_speed_unit:str):
+    '''
+    Step 2 (osm only like the Step 2 notebook)
+    '''
+    output_fp = settings['output_fp']
+    links = gpd.read_file(output_fp / 'filtered.gpkg',layer='osm_links')
+    links = links[links['link_type'].isin(link_types)]
+    nodes = gpd.read_file(output_fp / 'filtered.gpkg',layer='osm_nodes')
+    nodes = filter_nodes(links,nodes,'osm')
+
+    links = add_osm_attr(links,output_fp / 'osm_attr.parquet',default_speed_unit)
+
+    write_layers({'links':links,'nodes':nodes},output_fp / 'reconciled_network.gpkg')
+
+def _prepare(settings:dict,spd_mph:float,simplify:bool):
+    '''
+    Step 3
+    '''
+    output_fp = settings['output_fp']
+    links = gpd.read_file(output_fp / 'reconciled_network.gpkg',layer='links')
+    nodes = gpd.read_file(output_fp / 'reconciled_network.gpkg',layer='nodes')
+
+    if simplify:
+        links, nodes, link_map = prepare_network(links,nodes,spd_mph=spd_mph,simplify=True)
+        write_table(link_map,output_fp / 'link_map.parquet')
+    else:
+        links, nodes = prepare_network(links,nodes,spd_mph=spd_mph)
+
+    write_layers({'nodes':nodes,'links':links},output_fp / 'final_network.gpkg')
+    write_crosswalks(links,nodes,output_fp)
+
+def _costs(settings:dict,costs:dict):
+    '''
+    Makes an impedance column (and {impedance name}_ba if the links have mins_ba) for each
+    cost dictionary ({impedance name: costs}) and writes them with the linkid to their own
+    table. final_network.gpkg isn't changed, so impedances from old cost dictionaries
+    don't stick around.
+    '''
+    output_fp = settings['output_fp']
+    links = gpd.read_file(output_fp / 'final_network.gpkg',layer='links',ignore_geometry=True)
+    imp_cols = []
+    for imp_name, cost_dict in costs.items():
+        links = link_costs(links,cost_dict,imp_name)
+        imp_cols += [x for x in [imp_name,f'{imp_name}_ba'] if x in links.columns]
+    write_table(links[['linkid'] + imp_cols],output_fp / 'link_costs.parquet')
+
+def run_pipeline(settings:dict,network_dicts:list,spd_mph:float,costs:dict=None,rules:dict=None,
+                 link_types:list=['road','bike'],simplify:bool=False,force:bool=False,workers:int=None,
+                 default_speed_unit:str='km/h'):
+    '''
+    Runs the network build. settings and network_dicts are the same dictionaries used
+    in the Step 1 notebook (the study area is imported if settings doesn't have it yet).
+    rules is a dictionary of classify_links rules for each network name (default is
+    OSM_LINK_TYPES for osm); networks without rules are not classified. costs is a
+    dictionary of {impedance name: cost dictionary} for link_costs (written to
+    link_costs.parquet). default_speed_unit is the unit of osm maxspeed tags without one
+    (OSM says km/h, use 'mph' for US networks). Set force to True to rerun every stage.
+
+    Returns a DataFrame with the status, wall time, and peak memory of each stage.
+    '''
+    output_fp = Path(settings['output_fp'])
+    cache = load_cache(output_fp)
+    if rules is None:
+        rules = {'osm':OSM_LINK_TYPES}
+    stats = []
+
+    if 'studyarea' not in settings:
+        settings['studyarea'] = import_study_area(settings)
+
+    def record(stage,stage_fp,status,wall=None,peak=None):
+        if status == 'ran':
+            cache[stage] = {'fingerprint':stage_fp,'wall_time_s':round(wall,2),'peak_mb':round(peak,1),
+                            'finished':datetime.now().isoformat(timespec='seconds')}
+            save_cache(cache,output_fp)
+        stats.append({'stage':stage,'status':status,'wall_time_s':wall,'peak_mb':peak})
+        print(f'{stage}: {status}' + (f' in {round(wall/60,2)} minutes ({round(peak,1)} MB peak)' if status == 'ran' else ''))
+
+    #step 1 (networks are filtered in parallel but exported one at a time)
+    filter_fps = {}
+    todo = []
+    for network_dict in network_dicts:
+        network_name = network_dict['network_name']
+        stage = f'filter_{network_name}'
+        network_rules = rules.get(network_name)
+        filter_fps[network_name] = fingerprint(settings,network_dict,network_rules)
+        outputs = [output_fp / 'filtered.gpkg',output_fp / f'{network_name}_attr.parquet']
+        if not force and is_current(cache,stage,filter_fps[network_name],outputs):
+            record(stage,filter_fps[network_name],'skipped')
+        else:
+            todo.append((stage,network_dict,network_rules))
+
+    #tiled networks stream into filtered.gpkg themselves (and read their tiles in parallel),
+    #so they run one at a time here
+    if settings.get('tile_size') is not None:
+        for stage, network_dict, network_rules in todo:
+            _, wall, peak = measure(filter_networks_tiled,settings,network_dict,network_rules)
+            record(stage,filter_fps[network_dict['network_name']],'ran',wall,peak)
+        todo = []
+
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(measure,_filter_network,settings,network_dict,network_rules):(stage,network_dict)
+                       for stage, network_dict, network_rules in todo}
+            for future in as_completed(futures):
+                stage, network_dict = futures[future]
+                (links, nodes), wall, peak = future.result()
+                export(links,nodes,network_dict['network_name'],settings)
+                record(stage,filter_fps[network_dict['network_name']],'ran',wall,peak)
+
+    #step 2
+    if 'osm' in filter_fps:
+        reconcile_fp = fingerprint(filter_fps['osm'],link_types,default_speed_unit)
+        if not force and is_current(cache,'reconcile',reconcile_fp,[output_fp / 'reconciled_network.gpkg']):
+            record('reconcile',reconcile_fp,'skipped')
+        else:
+            _, wall, peak = measure(_reconcile,settings,link_types,default_speed_unit)
+            record('reconcile',reconcile_fp,'ran',wall,peak)
+    else:
+        reconcile_fp = fingerprint(output_fp / 'reconciled_network.gpkg')
+
+    #step 3
+    prepare_fp = fingerprint(reconcile_fp,spd_mph,simplify)
+    if not force and is_current(cache,'prepare',prepare_fp,[output_fp / 'final_network.gpkg',output_fp / 'node_crosswalk.parquet']):
+        record('prepare',prepare_fp,'skipped')
+    else:
+        _, wall, peak = measure(_prepare,settings,spd_mph,simplify)
+        record('prepare',prepare_fp,'ran',wall,peak)
+
+    #link costs
+    if costs is not None:
+        costs_fp = fingerprint(prepare_fp,costs)
+        if not force and is_current(cache,'costs',costs_fp,[output_fp / 'link_costs.parquet']):
+            record('costs',costs_fp,'skipped')
+        else:
+            _, wall, peak = measure(_costs,settings,costs)
+            record('costs',costs_fp,'ran',wall,peak)
+
+    stats = pd.DataFrame(stats)
+    stats.to_csv(output_fp / 'pipeline_stats.csv',index=False)
+
+    return stats
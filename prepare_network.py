@@ -6,10 +6,19 @@ Created on Tue Jul 26 05:41:07 2022
 """
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import networkx as nx
-import time
+import shapely
+from pathlib import Path
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
-def prepare_network(links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame,spd_mph:float,prevent_wrongway:bool=True):
+from network_reconcile import calculate_bearing
+from network_io import write_table
+from instrument import instrumented
+
+@instrumented(outputs=('links','nodes','link_map'))
+def prepare_network(links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame,spd_mph:float,prevent_wrongway:bool=True,simplify:bool=False,order:str='hilbert'):
     '''
     This function takes in a links and nodes geodataframe and formats it into
     a routable network graph for use in BikewaySim. The nodes geodataframe must
@@ -17,16 +26,26 @@ def prepare_network(links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame,spd_mph:float,
     columns specifying the starting node and ending node with the suffixes 
     "_A" and "_B" specifying start and end node ID respectively.
 
-    The links file is then reduced to the largest connected network and reverse
-    links are created. The length of the links is calculated and added to a "dist"
+    The links file is then reduced to the largest connected network and the
+    allowed direction of travel is stored in the "oneway_dir" column (0 = both,
+    1 = A to B, -1 = B to A) instead of adding reverse links, which are made when
+    the network graph is created (see create_reverse_links). If prevent_wrongway
+    is False, all links are treated as two way. The length of the links is calculated and added to a "dist"
     column. Then the link costs are calculated based on the attributes specificed in
     the costs dictionary. The keys of that dictionary must correspond to the columns of
     the links geodataframe.
 
+    If simplify is True, links connected by interstitial (degree 2) nodes that have
+    the same attributes are merged and a link map back to the original link ids
+    is returned as a third output (see contract_degree2).
+
+    Finally the node and link ids are replaced with dense int32 ids numbered in the
+    given order ('hilbert', 'rcm', or None, see dense_ids and node_order).
     '''
     
-    #find code to remove interstitial nodes to reduce network size
-    
+    #name of the source network (e.g. 'osm' for osm_N)
+    source = next((x[:-2] for x in nodes.columns if x.endswith('_N')),'source')
+
     #prepare nodes
     nodes = create_bws_nodes(nodes)
 
@@ -34,21 +53,150 @@ def prepare_network(links:gpd.GeoDataFrame,nodes:gpd.GeoDataFrame,spd_mph:float,
     links = create_bws_links(links)
 
     #drop unconnected links and remove interstitial nodes
-    links,nodes = largest_comp_and_simplify(links,nodes)
+    if simplify:
+        linkid = f'{source}_linkid' if f'{source}_linkid' in links.columns else 'linkid'
+        links,nodes,link_map = largest_comp_and_simplify(links,nodes,simplify=True,linkid=linkid)
+    else:
+        links,nodes = largest_comp_and_simplify(links,nodes)
 
-    #create reverse streets
-    links = create_reverse_links(links)
+    #mark the direction of travel (reverse links are made when the graph is created)
+    if prevent_wrongway:
+        links['oneway_dir'] = oneway_direction(links)
+    else:
+        links['oneway_dir'] = np.int8(0)
 
     #calculate distance for distance/travel time based impedance
+    links = add_dist_mins(links,spd_mph)
+
+    #dense int32 node and link ids (the source ids are kept for the crosswalks)
+    links, nodes = dense_ids(links,nodes,source,order)
+    
+    if simplify:
+        return links, nodes, link_map
+    return links, nodes
+
+def add_dist_mins(links,spd_mph):
+    '''
+    Adds link length in CRS units (dist) and travel time in minutes (mins) at
+    a constant speed. Assumes the CRS units are feet.
+    '''
     links['dist'] = links.length
     links['mins'] = links['dist'] / 5280 / spd_mph * 60
 
     #round
     links['dist'] = links['dist'].round(2)
     links['mins'] = links['mins'].round(2)
-    
+    return links
+
+def hilbert_index(x:np.ndarray,y:np.ndarray,bits:int=16):
+    '''
+    Position of each point along a Hilbert curve covering the extent of the points
+    (points that are close together get close positions)
+    '''
+    n = 2 ** bits
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    span = max(np.ptp(x),np.ptp(y),1e-9)
+    xi = ((x - x.min()) / span * (n - 1)).astype(np.int64)
+    yi = ((y - y.min()) / span * (n - 1)).astype(np.int64)
+
+    d = np.zeros(len(xi),dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        #rotate the quadrant
+        flip = ~ry & rx
+        xi = np.where(flip,n - 1 - xi,xi)
+        yi = np.where(flip,n - 1 - yi,yi)
+        xi, yi = np.where(~ry,yi,xi), np.where(~ry,xi,yi)
+        s //= 2
+    return d
+
+def node_order(nodes,a_pos:np.ndarray,b_pos:np.ndarray,order:str='hilbert'):
+    '''
+    Supporting function for dense_ids. Returns the new order of the nodes:
+        hilbert: along a Hilbert curve over the node coordinates (X/Y)
+        rcm: reverse Cuthill-McKee ordering of the network graph (reduces the
+            bandwidth of the graph matrix so the nodes at the ends of each link
+            have close ids)
+        None: keep the order
+    '''
+    if order is None:
+        return np.arange(len(nodes))
+    if order == 'hilbert':
+        if ('X' in nodes.columns) and ('Y' in nodes.columns):
+            x, y = nodes['X'].to_numpy(), nodes['Y'].to_numpy()
+        else:
+            x, y = nodes.geometry.x.to_numpy(), nodes.geometry.y.to_numpy()
+        return np.argsort(hilbert_index(x,y),kind='stable')
+    if order == 'rcm':
+        from scipy.sparse.csgraph import reverse_cuthill_mckee
+        graph = coo_matrix((np.ones(len(a_pos) * 2),(np.r_[a_pos,b_pos],np.r_[b_pos,a_pos])),shape=(len(nodes),len(nodes))).tocsr()
+        return np.asarray(reverse_cuthill_mckee(graph,symmetric_mode=True))
+    raise ValueError(f'Unknown node order {order}')
+
+def dense_ids(links,nodes,source:str='source',order:str='hilbert'):
+    '''
+    Replaces the node ids with dense int32 ids (N is the row position of the node,
+    0 to number of nodes - 1) and adds a dense int32 linkid (the row position of the
+    link), so the routing code can use them as array positions. The original ids
+    are kept in the {source}_N, {source}_A, and {source}_B columns (an existing
+    linkid column is moved to {source}_linkid). Run it again after adding or
+    removing links and nodes.
+
+    Nodes are numbered in the given order (see node_order) and links are sorted by
+    their new A and B, so nodes that are close in the network are also close in the
+    graph arrays and shortest path searches touch less memory.
+    '''
+    nodes = nodes.sort_values('N').reset_index(drop=True)
+    links = links.reset_index(drop=True)
+    source_n = nodes['N'].to_numpy()
+    a_pos = np.searchsorted(source_n,links['A'].to_numpy())
+    b_pos = np.searchsorted(source_n,links['B'].to_numpy())
+    #searchsorted gives a neighbouring node for ids that aren't in the nodes
+    for col, pos in [('A',a_pos),('B',b_pos)]:
+        found = (pos < len(source_n)) & (source_n[np.minimum(pos,len(source_n)-1)] == links[col].to_numpy())
+        if not found.all():
+            raise ValueError(f'{(~found).sum()} links have {col} ids that are not in the nodes')
+
+    #new id of each node
+    perm = node_order(nodes,a_pos,b_pos,order)
+    new_id = np.empty(len(nodes),dtype=np.int32)
+    new_id[perm] = np.arange(len(nodes),dtype=np.int32)
+    nodes = nodes.iloc[perm].reset_index(drop=True)
+
+    links[f'{source}_A'] = links['A'].to_numpy()
+    links[f'{source}_B'] = links['B'].to_numpy()
+    links['A'] = new_id[a_pos]
+    links['B'] = new_id[b_pos]
+    links = links.iloc[np.lexsort((links['B'].to_numpy(),links['A'].to_numpy()))].reset_index(drop=True)
+    if ('linkid' in links.columns) and (f'{source}_linkid' not in links.columns):
+        links = links.rename(columns={'linkid':f'{source}_linkid'})
+    links['linkid'] = np.arange(len(links),dtype=np.int32)
+
+    nodes.insert(1,f'{source}_N',source_n[perm])
+    nodes['N'] = np.arange(len(nodes),dtype=np.int32)
+
     return links, nodes
 
+def crosswalks(links,nodes):
+    '''
+    Tables from the dense ids (N and linkid) back to the source ids
+    '''
+    node_cols = ['N'] + [x for x in nodes.columns if x.endswith('_N')]
+    link_cols = ['linkid'] + [x for x in links.columns if x.endswith('_linkid')]
+    return pd.DataFrame(nodes[node_cols]), pd.DataFrame(links[link_cols])
+
+def write_crosswalks(links,nodes,output_fp):
+    '''
+    Writes node_crosswalk.parquet and link_crosswalk.parquet to the output folder
+    '''
+    node_crosswalk, link_crosswalk = crosswalks(links,nodes)
+    write_table(node_crosswalk,Path(output_fp) / 'node_crosswalk.parquet')
+    write_table(link_crosswalk,Path(output_fp) / 'link_crosswalk.parquet')
+
 def create_bws_links(links):
     #rename ID column
     cols = links.columns.tolist()
@@ -100,60 +248,278 @@ def create_bws_nodes(nodes):
     
     return nodes
 
-def create_reverse_links(links):
+#osm tag values for the direction of travel
+ONEWAY_FORWARD = ['yes','true','1']
+ONEWAY_BACKWARD = ['-1','reverse']
+ONEWAY_NO = ['no','false','0']
+#cycleway tags that allow bikes to go against a oneway
+CONTRAFLOW = ['opposite','opposite_lane','opposite_track','opposite_share_busway']
+
+def oneway_direction(links):
     '''
-    This code creates a column that indicates the direction of links.
+    Returns the allowed direction of bike travel for each link as an int8 array:
+    0 = both ways, 1 = only from A to B (along the geometry), -1 = only from B to A.
+
+    Uses the oneway tag (yes/true/1 and -1/reverse), then the oneway:bicycle tag
+    if present, then contraflow cycleway tags (e.g. cycleway=opposite_lane) which
+    make a oneway street two way for bikes. Missing tags are treated as two way.
+    '''
+    direction = np.zeros(len(links),dtype=np.int8)
+
+    for col in ['oneway','oneway:bicycle']:
+        if col in links.columns:
+            tag = links[col].astype(str).str.lower()
+            if col == 'oneway:bicycle':
+                direction[tag.isin(ONEWAY_NO).to_numpy()] = 0
+            direction[tag.isin(ONEWAY_FORWARD).to_numpy()] = 1
+            direction[tag.isin(ONEWAY_BACKWARD).to_numpy()] = -1
+
+    for col in ['cycleway','cycleway:left','cycleway:right','cycleway:both']:
+        if col in links.columns:
+            direction[links[col].isin(CONTRAFLOW).to_numpy()] = 0
+    
+    return direction
 
-    Only works for OSM right now
+def create_reverse_links(links,cols:list=[]):
+    '''
+    Expands links into directed edges without copying the links. Every link gets
+    a forward edge (dir = 0, from A to B) and a reverse edge (dir = 1, from B to A).
+    The link_idx column is the row position of the link in links so that geometry
+    and other attributes can be looked up when needed. The columns in cols (e.g.
+    impedance columns) are copied onto the edges. If links has a {col}_ba column,
+    it's used for the reverse edges instead.
 
-    When a network graph is made, this column can be used to filter out
-    wrongway travel if desired.
+    Edges going against a oneway are marked in the wrongway column, so they can
+    be dropped or given a different impedance when the network graph is made.
+    Uses the oneway_dir column if present, otherwise oneway_direction.
     '''
+    if 'oneway_dir' in links.columns:
+        direction = links['oneway_dir'].to_numpy()
+    else:
+        direction = oneway_direction(links)
 
-    links['wrongway'] = False
+    num_links = len(links)
+    link_idx = np.arange(num_links)
+    a = links['A'].to_numpy()
+    b = links['B'].to_numpy()
 
-    oneway = links['oneway'] == 'yes'
-    links_rev = links.rename(columns={'A':'B','B':'A'})
-    links_rev.loc[oneway,'wrongway'] = True
+    edges = pd.DataFrame({
+        'link_idx': np.concatenate([link_idx,link_idx]),
+        'dir': np.repeat(np.array([0,1],dtype=np.int8),num_links),
+        'A': np.concatenate([a,b]),
+        'B': np.concatenate([b,a]),
+        'wrongway': np.concatenate([direction == -1,direction == 1])
+        })
+    
+    for col in cols:
+        values = links[col].to_numpy()
+        #direction specific values (e.g., from elevation.add_grade_mins) are in {col}_ba
+        reverse = links[f'{col}_ba'].to_numpy() if f'{col}_ba' in links.columns else values
+        edges[col] = np.concatenate([values,reverse])
 
-    #add to other links
-    links = pd.concat([links,links_rev],ignore_index=True)
+    return edges
 
+def node_components(a,b):
+    '''
+    Finds the connected components of an undirected graph given as arrays of
+    start (a) and end (b) node ids. Returns the unique node ids, the component
+    label of each node, and the positions of a and b in the unique node ids.
+    Missing ids aren't allowed (see drop_missing_ids).
+    '''
+    codes, node_ids = pd.factorize(np.concatenate([np.asarray(a),np.asarray(b)]))
+    if (codes < 0).any():
+        raise ValueError('node ids are missing, drop those links first (see drop_missing_ids)')
+    a_idx, b_idx = codes[:len(a)], codes[len(a):]
+    graph = coo_matrix((np.ones(len(a_idx)),(a_idx,b_idx)),shape=(len(node_ids),len(node_ids)))
+    n_comp, labels = connected_components(graph,directed=False)
+    return node_ids, labels, a_idx, b_idx
+
+def drop_missing_ids(links,A='A',B='B'):
+    '''
+    Drops links without an A or B node id
+    '''
+    missing = links[A].isna().to_numpy() | links[B].isna().to_numpy()
+    if missing.any():
+        print(f'{missing.sum()} links without node ids dropped')
+        links = links[~missing]
     return links
 
-def largest_comp_and_simplify(links,nodes,net_name=None): 
-    
+@instrumented(outputs=('links','nodes','link_map'))
+def largest_comp_and_simplify(links,nodes,net_name=None,simplify=False,attr_cols=None,linkid=None): 
+    '''
+    Only keeps the links and nodes in the largest connected component. If simplify
+    is True, chains of links connected by degree 2 nodes are also merged (see
+    contract_degree2) and a third output mapping the merged links back to the
+    original link ids is returned. linkid is the link id column for the link map
+    (default is {net_name}_linkid or linkid). Links without node ids are dropped.
+    '''
     #optional arguement
     if net_name is not None:
         A = net_name + '_A'
         B = net_name + '_B'
         N = net_name + '_N'
+        linkid = linkid or net_name + '_linkid'
     else:
         A = 'A'
         B = 'B'
         N = 'N'
+        linkid = linkid or 'linkid'
     
-    #create undirected graph
-    G = nx.Graph()  # create directed graph
-    for row in links[[A,B]].itertuples(index=False):
-        # forward graph, time stored as minutes
-        G.add_edges_from([(row[0],row[1])])
+    links = drop_missing_ids(links,A,B)
 
-    #only keep largest component
-    largest_cc = max(nx.connected_components(G), key=len)
+    #label the components of the undirected graph
+    node_ids, labels, a_idx, b_idx = node_components(links[A],links[B])
 
-    #TODO future project simplify graph connect links connect with nodes of degree 2
-    #S = G.subgraph(largest_cc).copy()
-    #simple_graph = ox.simplification.simplify_graph(S)
-    #there is a contract function too
+    #only keep largest component
+    largest = np.bincount(labels).argmax()
+    largest_cc = node_ids[labels == largest]
     
     #get nodes
     nodes = nodes[nodes[N].isin(largest_cc)]
-    #get links
-    links = links[links[A].isin(largest_cc) & links[B].isin(largest_cc)]
+    #get links (both ends are always in the same component)
+    links = links[labels[a_idx] == largest]
+
+    if simplify:
+        return contract_degree2(links,nodes,A,B,N,attr_cols,linkid)
     
     return links,nodes
+
+@instrumented(outputs=('links','nodes','link_map'))
+def contract_degree2(links,nodes,A='A',B='B',N='N',attr_cols=None,linkid='linkid'):
+    '''
+    Merges chains of links connected by interstitial nodes (nodes with exactly two
+    links) into single links. Two links are only merged if their attributes in attr_cols
+    are identical and, for oneway links, if they point the same way through the node.
+    By default attr_cols is every column except the node/link ids, geometry, and
+    bearing, dist, and mins. Chains that form a loop are left alone.
+
+    Merged links keep the attributes and link id of their first link, get the merged
+    geometry, the sum of dist and mins (if present), and a new bearing (if present).
+
+    Returns the links, the nodes without the interstitial nodes, and a link map
+    with the merged link id (linkid column), the original link ids, and their order
+    in the chain. Links without node ids are dropped.
+    '''
+    if linkid not in links.columns:
+        raise ValueError(f'link id column {linkid} is not in the links')
+    links = drop_missing_ids(links,A,B).reset_index(drop=True)
+    geo_col = links.geometry.name
+    geoms = np.asarray(links.geometry.values)
+    
+    if attr_cols is None:
+        attr_cols = [x for x in links.columns if x not in [A,B,linkid,geo_col,'bearing','dist','mins']]
+    
+    num_links = len(links)
+    link_pos = np.arange(num_links)
+
+    #node codes for both link ends
+    codes, node_ids = pd.factorize(np.concatenate([links[A].to_numpy(),links[B].to_numpy()]))
+    a_code, b_code = codes[:num_links], codes[num_links:]
+    degree = np.bincount(codes,minlength=len(node_ids))
+
+    #find the two links at each degree 2 node
+    order = np.argsort(codes,kind='stable')
+    sorted_codes = codes[order]
+    first = np.flatnonzero(np.r_[True,sorted_codes[1:] != sorted_codes[:-1]])
+    first = first[degree[sorted_codes[first]] == 2]
+    v = sorted_codes[first]
+    e1 = np.concatenate([link_pos,link_pos])[order[first]]
+    e2 = np.concatenate([link_pos,link_pos])[order[first+1]]
+
+    #only merge if attributes match (oneway gets checked here too if it is an attribute)
+    if len(attr_cols) > 0:
+        attr_code = links.groupby(attr_cols,dropna=False,sort=False).ngroup().to_numpy()
+    else:
+        attr_code = np.zeros(num_links,dtype=int)
+    ok = (e1 != e2) & (attr_code[e1] == attr_code[e2])
+
+    #oneway links need to flow through the node
+    if 'oneway' in links.columns:
+        directed = links['oneway'].notna().to_numpy() & ~links['oneway'].isin(['no','false','0']).to_numpy()
+        through = ((b_code[e1] == v) & (a_code[e2] == v)) | ((b_code[e2] == v) & (a_code[e1] == v))
+        ok &= (directed[e1] == directed[e2]) & (~directed[e1] | through)
+    v, e1, e2 = v[ok], e1[ok], e2[ok]
+
+    #chains are the connected components of links joined at mergeable nodes
+    graph = coo_matrix((np.ones(len(e1)),(e1,e2)),shape=(num_links,num_links))
+    n_chains, chain = connected_components(graph,directed=False)
+    multi = np.bincount(chain)[chain] > 1
+
+    #the end nodes of a chain only show up once
+    ends = pd.DataFrame({'chain':np.concatenate([chain,chain]),'node':codes,
+                         'is_a':np.r_[np.ones(num_links,dtype=bool),np.zeros(num_links,dtype=bool)]})
+    ends = ends[np.concatenate([multi,multi])]
+    ends = ends[ends.groupby(['chain','node'])['node'].transform('size') == 1]
+    ends = ends[ends.groupby('chain')['node'].transform('size') == 2]
+    
+    #start node is the one at the start of a link
+    ends = ends.sort_values(['chain','is_a'],ascending=[True,False])
+    start = ends.groupby('chain')['node'].first()
+    end = ends.groupby('chain')['node'].last()
+
+    #merge geometry
+    members = link_pos[np.isin(chain,start.index)]
+    members = members[np.argsort(chain[members],kind='stable')]
+    member_chain = chain[members]
+    chain_ids, member_idx = np.unique(member_chain,return_inverse=True)
+    merged = shapely.line_merge(shapely.multilinestrings(geoms[members],indices=member_idx))
+    
+    #chains that don't merge into one line are left alone
+    valid = shapely.get_type_id(merged) == 1
+    chain_ids, merged = chain_ids[valid], merged[valid]
+    keep = valid[member_idx]
+    members, member_chain = members[keep], member_chain[keep]
+    member_idx = np.searchsorted(chain_ids,member_chain)
+    start, end = start.loc[chain_ids].to_numpy(), end.loc[chain_ids].to_numpy()
+
+    if len(members) == 0:
+        print('no links merged')
+        return links, nodes, pd.DataFrame({linkid:links[linkid].to_numpy(),f'orig_{linkid}':links[linkid].to_numpy(),'seq':0})
+
+    #orient merged geometry from start node to end node
+    node_geo = nodes.set_index(N).geometry
+    start_geo = np.asarray(node_geo.loc[node_ids[start]].values)
+    flip = shapely.distance(shapely.get_point(merged,0),start_geo) > shapely.distance(shapely.get_point(merged,-1),start_geo)
+    merged[flip] = shapely.reverse(merged[flip])
+
+    #order of links in each chain
+    midpoints = shapely.line_interpolate_point(geoms[members],0.5,normalized=True)
+    position = shapely.line_locate_point(merged[member_idx],midpoints)
+    seq_order = np.lexsort((position,member_idx))
+    members, member_idx = members[seq_order], member_idx[seq_order]
+    first_member = members[np.r_[True,member_idx[1:] != member_idx[:-1]]]
+
+    #make the merged links
+    new_links = links.iloc[first_member].copy()
+    new_links[A] = node_ids[start]
+    new_links[B] = node_ids[end]
+    new_links[geo_col] = merged
+    for col in ['dist','mins']:
+        if col in links.columns:
+            new_links[col] = np.bincount(member_idx,weights=links[col].to_numpy()[members])
+    if 'bearing' in links.columns:
+        pts = gpd.GeoSeries(np.r_[shapely.get_point(merged,0),shapely.get_point(merged,-1)],crs=links.crs).to_crs('epsg:4326')
+        new_links['bearing'] = calculate_bearing(pts.y.values[:len(merged)],pts.x.values[:len(merged)],
+                                                 pts.y.values[len(merged):],pts.x.values[len(merged):]).round(1)
+
+    #link map
+    link_map = pd.DataFrame({linkid:links[linkid].to_numpy(),f'orig_{linkid}':links[linkid].to_numpy(),'seq':0})
+    link_map.loc[members,linkid] = links[linkid].to_numpy()[first_member][member_idx]
+    link_map.loc[members,'seq'] = np.arange(len(members)) - np.searchsorted(member_idx,member_idx)
+
+    #drop the interstitial nodes
+    removed_nodes = node_ids[v[np.isin(chain[e1],chain_ids)]]
+    nodes = nodes[~nodes[N].isin(removed_nodes)]
+    
+    merged_mask = np.zeros(num_links,dtype=bool)
+    merged_mask[members] = True
+    links = pd.concat([links[~merged_mask],new_links],ignore_index=True)
+    
+    print(f'{merged_mask.sum()} links merged into {len(new_links)} links and {len(removed_nodes)} nodes removed')
+    
+    return links, nodes, link_map
     
+@instrumented()
 def link_costs(links:pd.DataFrame(),costs:dict,imp_name:str):
     
     #get list of columns names to use
@@ -163,18 +529,24 @@ def link_costs(links:pd.DataFrame(),costs:dict,imp_name:str):
     links['imp_factor'] = 1
 
     # if row is a mup then set all other column values to zero
-    cols.remove('mu')
-    links.loc[links['mu']==1,cols] = 0
-    cols.append('mu')
+    if 'mu' in cols:
+        cols.remove('mu')
+        links.loc[links['mu']==1,cols] = 0
+        cols.append('mu')
 
     for col in cols:
         # calculate impedance
         links['imp_factor'] = links['imp_factor'] + (links[col] * costs[col])
     
     links[imp_name] = links['mins'] * links['imp_factor']
+    #direction specific travel time (e.g., from elevation.add_grade_mins) for the reverse edges
+    imp_cols = [imp_name]
+    if 'mins_ba' in links.columns:
+        links[f'{imp_name}_ba'] = links['mins_ba'] * links['imp_factor']
+        imp_cols.append(f'{imp_name}_ba')
     
     #check for negative impedances
-    if (links[imp_name] < 0).any():
+    if (links[imp_cols] < 0).any().any():
         print('Warning: negative link impedance present!')
 
     return links
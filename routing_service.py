@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP routing service.
+
+Loads the prepared network (final_network.gpkg) once, builds the graph, and
+answers routing requests over HTTP/JSON on localhost so that dashboards, QGIS,
+and notebooks don't have to rebuild the graph every time. Only the standard
+library is used for the server (asyncio), so it runs fully offline.
+
+Run it with:
+    python routing_service.py Data/networks/final_network.gpkg --impedance dist --port 8765
+
+Endpoints (POST a JSON body, responses are JSON):
+    /route    {"origin":..., "destination":..., "geometry":false}
+              impedance, length, node ids, link ids (and a lon/lat GeoJSON
+              geometry if geometry is true)
+    /matrix   {"origins":[...], "destinations":[...]}
+              impedance from every origin to every destination (null if unreachable)
+    /bikeshed {"origin":..., "budget":...}
+              node ids and link ids reachable within the impedance budget
+    /snap     {"points":[[lon,lat],...]}
+              nearest node id and snapping distance (CRS units) for each point
+    /info     (GET) network size, impedance column, and a sample of node ids
+
+Origins and destinations can be node ids or [lon,lat] points (snapped to the
+nearest node).
+
+Searches run in a process pool where each worker keeps its own copy of the
+graph. Route requests that arrive within batch_wait seconds of each other are
+sent to the workers together, so requests from the same origin share one
+search. Responses are kept in an LRU cache so repeated queries aren't routed
+again. load_test.py measures requests per second.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from bikewaysim_lite import edge_graph, path_edges
+
+_GRAPH = None
+_CSR = None
+
+def _init_worker(graph:dict):
+    '''
+    Runs once in each worker process
+    '''
+    global _GRAPH, _CSR
+    _GRAPH = graph
+    n = len(graph['node_ids'])
+    _CSR = csr_matrix((graph['weights'],graph['indices'],graph['indptr']),shape=(n,n))
+
+def _route_batch(pairs:list):
+    '''
+    Routes a batch of (source, target) node positions with one search per unique source.
+    Returns (impedance, node positions, link positions) for each pair (None if unreachable).
+    '''
+    sources = np.unique([s for s, t in pairs])
+    dist, pred = dijkstra(_CSR,directed=True,indices=sources,return_predecessors=True)
+    row = {s:i for i, s in enumerate(sources)}
+
+    results = []
+    for source, target in pairs:
+        i = row[source]
+        if not np.isfinite(dist[i,target]):
+            results.append(None)
+            continue
+        nodes, edges = path_edges(_GRAPH,pred[i],source,target)
+        results.append((float(dist[i,target]),nodes,_GRAPH['link_idx'][edges]))
+    return results
+
+def _matrix(sources:np.ndarray,targets:np.ndarray):
+    dist = dijkstra(_CSR,directed=True,indices=sources)
+    return dist[:,targets]
+
+def _bikeshed(source:int,budget:float):
+    '''
+    Node positions reachable within the budget and the link positions of the edges
+    between them
+    '''
+    dist = dijkstra(_CSR,directed=True,indices=source,limit=budget)
+    reached = np.isfinite(dist)
+    a_idx = np.repeat(np.arange(len(reached)),np.diff(_GRAPH['indptr']))
+    edges = reached[a_idx] & reached[_GRAPH['indices']]
+    return np.flatnonzero(reached), np.unique(_GRAPH['link_idx'][edges])
+
+class RequestError(Exception):
+    pass
+
+class RoutingService:
+    '''
+    Holds the network, the worker pool, the route batcher, and the response cache
+    '''
+
+    def __init__(self,links,nodes,impedance_col:str,wrongway_factor:float=None,linkid_col:str='linkid',
+                 workers:int=None,batch_wait:float=0.002,max_batch:int=256,cache_size:int=10000):
+        self.impedance_col = impedance_col
+        self.graph = edge_graph(links,impedance_col,wrongway_factor)
+        self.node_ids = self.graph['node_ids']
+        self.link_ids = links[linkid_col].to_numpy() if linkid_col in links.columns else np.arange(len(links))
+        self.length = links.length.to_numpy()
+        #lon/lat geometry for route responses
+        self.geoms = links.geometry.to_crs('epsg:4326').to_numpy() if links.crs is not None else links.geometry.to_numpy()
+
+        #only nodes in the graph can be snapped to
+        nodes = nodes[nodes['N'].isin(self.node_ids)]
+        self.snap_ids = nodes['N'].to_numpy()
+        self.tree = cKDTree(shapely.get_coordinates(nodes.geometry.to_numpy()))
+        self.crs = nodes.crs
+
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.workers,initializer=_init_worker,initargs=(self.graph,))
+        self.batch_wait = batch_wait
+        self.max_batch = max_batch
+        self.queue = None
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.stats = {'requests':0,'cache_hits':0,'batches':0,'batched_routes':0,'errors':0}
+
+    #snapping and id handling
+    def snap(self,points:list):
+        points = np.asarray(points,dtype=float).reshape(-1,2)
+        if (self.crs is not None) and not self.crs.equals('epsg:4326'):
+            from pyproj import Transformer
+            x, y = Transformer.from_crs('epsg:4326',self.crs,always_xy=True).transform(points[:,0],points[:,1])
+            points = np.column_stack([x,y])
+        dist, idx = self.tree.query(points,k=1)
+        return self.snap_ids[idx], dist
+
+    def position(self,value):
+        '''
+        Graph position of a node id or [lon,lat] point
+        '''
+        if isinstance(value,(list,tuple)):
+            value = self.snap([value])[0][0]
+        pos = np.searchsorted(self.node_ids,value)
+        if (pos >= len(self.node_ids)) or (self.node_ids[pos] != value):
+            raise RequestError(f'Node {value} is not in the network')
+        return int(pos)
+
+    #batched routing
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.stats['batches'] += 1
+            self.stats['batched_routes'] += len(batch)
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self,batch:list):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.pool,_route_batch,[(s,t) for s, t, future in batch])
+        except Exception as e:
+            for s, t, future in batch:
+                future.set_exception(e)
+            return
+        for (s, t, future), result in zip(batch,results):
+            future.set_result(result)
+
+    async def route(self,body:dict):
+        source, target = self.position(body['origin']), self.position(body['destination'])
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((source,target,future))
+        result = await future
+        if result is None:
+            return {'impedance':None,'length':None,'nodes':[],'links':[]}
+
+        impedance, nodes, links = result
+        response = {
+            'impedance':impedance,
+            'length':float(self.length[links].sum()),
+            'nodes':self.node_ids[nodes].tolist(),
+            'links':self.link_ids[links].tolist()
+            }
+        if body.get('geometry',False):
+            response['geometry'] = shapely.geometry.mapping(shapely.multilinestrings(self.geoms[links]))
+        return response
+
+    async def matrix(self,body:dict):
+        sources = np.array([self.position(x) for x in body['origins']],dtype=int)
+        targets = np.array([self.position(x) for x in body['destinations']],dtype=int)
+        unique, inverse = np.unique(sources,return_inverse=True)
+        dist = await asyncio.get_running_loop().run_in_executor(self.pool,_matrix,unique,targets)
+        dist = dist[inverse.ravel()]
+        return {'impedance':np.where(np.isfinite(dist),dist,None).tolist()}
+
+    async def bikeshed(self,body:dict):
+        source = self.position(body['origin'])
+        nodes, links = await asyncio.get_running_loop().run_in_executor(self.pool,_bikeshed,source,float(body['budget']))
+        return {
+            'nodes':self.node_ids[nodes].tolist(),
+            'links':self.link_ids[links].tolist(),
+            'length':float(self.length[links].sum())
+            }
+
+    async def snap_points(self,body:dict):
+        ids, dist = self.snap(body['points'])
+        return {'nodes':ids.tolist(),'distance':dist.round(2).tolist()}
+
+    async def info(self,body:dict):
+        rng = np.random.default_rng(0)
+        return {
+            'impedance':self.impedance_col,
+            'num_nodes':len(self.node_ids),
+            'num_edges':len(self.graph['weights']),
+            'sample_nodes':rng.choice(self.node_ids,min(1000,len(self.node_ids)),replace=False).tolist(),
+            'stats':self.stats
+            }
+
+    async def handle(self,path:str,raw:bytes):
+        '''
+        Returns the status code and response for a request
+        '''
+        handlers = {'/route':self.route,'/matrix':self.matrix,'/bikeshed':self.bikeshed,'/snap':self.snap_points,'/info':self.info}
+        if path not in handlers:
+            return 404, {'error':f'Unknown endpoint {path}'}
+        self.stats['requests'] += 1
+
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            return 400, {'error':'Request body must be JSON'}
+
+        key = (path,json.dumps(body,sort_keys=True))
+        if (path != '/info') and (key in self.cache):
+            self.stats['cache_hits'] += 1
+            self.cache.move_to_end(key)
+            return 200, self.cache[key]
+
+        try:
+            response = await handlers[path](body)
+        except KeyError as e:
+            return 400, {'error':f'Missing {e}'}
+        except (RequestError, ValueError, TypeError) as e:
+            return 400, {'error':str(e)}
+        #anything else (e.g., from a worker) still gets a response
+        except Exception as e:
+            self.stats['errors'] += 1
+            return 500, {'error':f'{type(e).__name__}: {e}'}
+
+        if path != '/info':
+            self.cache[key] = response
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return 200, response
+
+    async def connection(self,reader,writer):
+        '''
+        Minimal HTTP/1.1 handling with keep alive
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split(' ',2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n',b'\n',b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                raw = await reader.readexactly(int(headers.get('content-length',0)))
+
+                status, response = await self.handle(path.split('?')[0],raw)
+                payload = json.dumps(response).encode()
+                close = headers.get('connection','').lower() == 'close' or version.strip() == 'HTTP/1.0'
+                writer.write((f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                              f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+                              f'Connection: {"close" if close else "keep-alive"}\r\n\r\n').encode() + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self,host:str='127.0.0.1',port:int=8765):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self._batcher())
+        #start the workers (and load the graph in them) before taking requests
+        await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(self.pool,_matrix,[0],[0]) for _ in range(self.workers)])
+        server = await asyncio.start_server(self.connection,host,port)
+        print(f'Routing {len(self.node_ids)} nodes on http://{host}:{port} ({self.impedance_col})')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown()
+
+def load_network(network_fp,links_layer:str='links',nodes_layer:str='nodes'):
+    '''
+    Reads the links and nodes from a GeoPackage (or Parquet files written by network_io
+    when network_fp is a folder with links.parquet and nodes.parquet)
+    '''
+    network_fp = Path(network_fp)
+    if network_fp.is_dir():
+        from network_io import read_table
+        return read_table(network_fp/f'{links_layer}.parquet'), read_table(network_fp/f'{nodes_layer}.parquet')
+    return gpd.read_file(network_fp,layer=links_layer), gpd.read_file(network_fp,layer=nodes_layer)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local routing service')
+    parser.add_argument('network',help='final_network.gpkg (or a folder of Parquet tables)')
+    parser.add_argument('--impedance',default='dist')
+    parser.add_argument('--wrongway-factor',type=float,default=None)
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8765)
+    parser.add_argument('--workers',type=int,default=None)
+    parser.add_argument('--batch-wait',type=float,default=0.002,help='seconds to wait for more route requests')
+    parser.add_argument('--cache-size',type=int,default=10000)
+    args = parser.parse_args()
+
+    links, nodes = load_network(args.network)
+    service = RoutingService(links,nodes,args.impedance,args.wrongway_factor,workers=args.workers,
+                             batch_wait=args.batch_wait,cache_size=args.cache_size)
+    asyncio.run(service.serve(args.host,args.port))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures for the tests. The modules are flat files in the repository root,
+so the root is put on the path. The tests use the synthetic grids from benchmarks.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0,str(Path(__file__).resolve().parents[1]))
+
+import pytest
+import instrument
+
+@pytest.fixture(autouse=True)
+def no_instrument_output():
+    #keep the stage events out of the test output
+    sinks = list(instrument.SINKS)
+    instrument.configure(sinks=[])
+    yield
+    instrument.configure(sinks=sinks)
+
+@pytest.fixture
+def grid():
+    from benchmarks import synthetic_grid
+    return synthetic_grid(200)
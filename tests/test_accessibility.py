@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Accessibility metrics on the synthetic grid
+"""
+
+import numpy as np
+import pandas as pd
+
+from accessibility import accessibility
+from bikewaysim_lite import create_csr_graph
+from scipy.sparse.csgraph import dijkstra
+
+def test_kth_nearest_counts_destinations_on_the_same_node(grid):
+    links, nodes = grid
+    #two destinations on one node and one far away
+    destinations = pd.DataFrame({'N':[0,0,nodes['N'].max()]})
+    origins = pd.DataFrame({'N':nodes['N']})
+    access = accessibility(links,origins,destinations,'dist',k=2)
+
+    graph, node_ids = create_csr_graph(links,'dist')
+    to_zero = dijkstra(graph.T.tocsr(),indices=np.searchsorted(node_ids,0))
+    expected = to_zero[np.searchsorted(node_ids,origins['N'].to_numpy())]
+    expected[np.isinf(expected)] = np.nan
+    assert np.allclose(access['nearest_2_dist'],expected,equal_nan=True)
+    assert (access.loc[access['N'] == 0,'nearest_2_dist'] == 0).all()
+    assert (access.loc[access['N'] == 0,'count_within'] == 3).all()
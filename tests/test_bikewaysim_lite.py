@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Shortest paths on the array graph against networkx
+"""
+
+import numpy as np
+import networkx as nx
+import shapely
+import pytest
+
+from benchmarks import random_ods
+from bikewaysim_lite import find_shortest, create_graph, edge_graph, node_path_links
+
+def test_find_shortest_matches_networkx(grid):
+    links, nodes = grid
+    ods = random_ods(nodes,40,10)
+    ods = ods[ods['o_node'] != ods['d_node']]
+    routes, _, _ = find_shortest(links.copy(),nodes.copy(),ods,'dist')
+
+    G = create_graph(links,'dist')
+    graph = edge_graph(links,'dist')
+    geoms = links.geometry.to_numpy()
+    for od, route in zip(ods.itertuples(),routes.itertuples()):
+        impedance, path = nx.single_source_dijkstra(G,od.o_node,od.d_node,weight='dist')
+        assert route.dist == pytest.approx(impedance)
+        expected = shapely.multilinestrings(geoms[node_path_links(graph,path)])
+        assert shapely.equals(route.geometry,expected)
+
+def test_edge_graph_matches_networkx_wrongway(grid):
+    links, nodes = grid
+    G = create_graph(links,'dist',wrongway_factor=2)
+    graph = edge_graph(links,'dist',wrongway_factor=2)
+    assert G.number_of_edges() == len(graph['link_idx'])
+
+    weights = {(u,v):w for u, v, w in G.edges(data='dist')}
+    a = np.repeat(graph['node_ids'],np.diff(graph['indptr']))
+    b = graph['node_ids'][graph['indices']]
+    assert np.allclose([weights[(u,v)] for u, v in zip(a,b)],graph['weights'])
+
+def test_find_shortest_oneway(grid):
+    links, nodes = grid
+    link = links[links['oneway_dir'] == 1].iloc[0]
+    ods = random_ods(nodes,1).assign(o_node=link['B'],d_node=link['A'])
+    routes, _, _ = find_shortest(links.copy(),nodes.copy(),ods,'dist')
+    #has to go around the block instead of the wrong way
+    assert routes['dist'].iloc[0] > link['dist'] * 2
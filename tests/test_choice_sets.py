@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Choice sets on the synthetic grid with a parallel link
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from bikewaysim_lite import edge_graph
+from choice_sets import choice_sets
+
+def with_sidepath(links,row:int=0):
+    '''
+    Adds a slightly longer link next to links.iloc[row] between the same two nodes
+    '''
+    link = links.iloc[[row]].copy()
+    coords = shapely.get_coordinates(link.geometry.iloc[0])
+    mid = coords.mean(axis=0) + 20
+    link['geometry'] = [shapely.LineString([coords[0],mid,coords[-1]])]
+    link['linkid'] = links['linkid'].max() + 1
+    link['highway'] = 'cycleway'
+    link['dist'] = link.length
+    return pd.concat([links,link],ignore_index=True)
+
+def test_parallel_links_are_kept(grid):
+    links, nodes = grid
+    links = with_sidepath(links)
+    graph = edge_graph(links,'dist',parallel=True)
+    assert set(graph['link_idx'][~graph['connector']]) == set(range(len(links)))
+    assert set(edge_graph(links,'dist')['link_idx']) == set(range(len(links) - 1))
+
+def test_link_elimination_falls_back_to_the_parallel_link(grid):
+    links, nodes = grid
+    links = with_sidepath(links)
+    road, sidepath = links.iloc[0], links.iloc[-1]
+    ods = pd.DataFrame({'trip_id':[0],'o_node':[road['A']],'d_node':[road['B']]})
+    routes = choice_sets(links,ods,'dist',method='link_elimination',workers=1)
+    assert routes['linkid'].iloc[0].tolist() == [road['linkid']]
+    assert routes['linkid'].iloc[1].tolist() == [sidepath['linkid']]
+    assert np.isclose(routes['dist'].iloc[1],sidepath['dist'])
+    assert np.isclose(routes['length'].iloc[1],sidepath['dist'])
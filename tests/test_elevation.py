@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the DEM sampling and grades against a synthetic DEM with a known slope.
+"""
+
+import numpy as np
+import shapely
+import pytest
+
+from benchmarks import synthetic_grid, synthetic_dem
+from elevation import add_elevation, add_grade_mins, grade_stats
+from prepare_network import link_costs
+
+GRADE = 0.05
+
+@pytest.fixture(scope='module')
+def elevation_links(tmp_path_factory):
+    links, nodes = synthetic_grid(200)
+    #the DEM is a file since the sampling workers open it by path
+    dem_fp = tmp_path_factory.mktemp('dem') / 'dem.tif'
+    synthetic_dem(links,dem_fp,grade=GRADE)
+    return links, add_elevation(links,dem_fp,interval=100,workers=2)
+
+def eastward_grade(links):
+    '''
+    Expected grade (percent) of straight links on a DEM that rises to the east
+    '''
+    coords = shapely.get_coordinates(links.geometry.to_numpy()).reshape(-1,2,2)
+    dx = coords[:,1,0] - coords[:,0,0]
+    return GRADE * 100 * dx / links.length.to_numpy()
+
+def test_up_grades(elevation_links):
+    links, checked = elevation_links
+    expected = eastward_grade(links)
+    assert np.allclose(checked['up_grade'],np.maximum(expected,0),atol=0.5)
+    assert np.allclose(checked['up_grade_ba'],np.maximum(-expected,0),atol=0.5)
+
+def test_elevation_at_ends(elevation_links):
+    links, checked = elevation_links
+    coords = shapely.get_coordinates(links.geometry.to_numpy()).reshape(-1,2,2)
+    #elevation is sampled at the cell the point falls in (10 ft cells)
+    assert np.allclose(checked['elev_A'],GRADE * coords[:,0,0],atol=GRADE * 10)
+    assert np.allclose(checked['elev_B'],GRADE * coords[:,1,0],atol=GRADE * 10)
+
+def test_direction_specific_costs(elevation_links):
+    links, checked = elevation_links
+    east = eastward_grade(links) > 1
+    checked = add_grade_mins(checked.copy(),spd_mph=8)
+    checked = link_costs(checked.assign(bl=0),{'bl':-0.1},'imp')
+    assert (checked.loc[east,'mins'] > checked.loc[east,'mins_ba']).all()
+    assert (checked.loc[east,'imp'] > checked.loc[east,'imp_ba']).all()
+
+def test_missing_elevations_left_out():
+    #one link with four points, the last two off the DEM
+    link_pos = np.array([0,0,0,0])
+    distance = np.array([0,100,200,300],dtype=float)
+    elev = np.array([0,5,np.nan,np.nan])
+    stats = grade_stats(link_pos,distance,elev,1)
+    assert stats.loc[0,'up_grade'] == 5
+    assert stats.loc[0,'ascent_ft'] == 5
+    assert stats.loc[0,'max_grade'] == 5
+    assert stats.loc[0,'up_grade_ba'] == 0
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Link classification and planarizing
+"""
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from network_filter import classify_links, planarize
+
+def test_classify_links():
+    links = pd.DataFrame({
+        'highway':['motorway','footway','footway','residential','service','service','cycleway','construction'],
+        'footway':[None,'sidewalk','sidewalk',None,None,None,None,None],
+        'bicycle':[None,None,'yes',None,None,None,None,None],
+        'name':[None,None,None,'Main St','Alley Rd',None,None,None]
+        })
+    links = classify_links(links)
+    assert links['link_type'].tolist()[:7] == ['remove','remove','bike','road','road','service','bike']
+    assert links['link_type_rule'].tolist()[:7] == ['restricted_access','sidewalk','bike','road','named_service','service','bike']
+    #no rule matched
+    assert pd.isna(links['link_type'].iloc[7])
+
+def test_classify_links_missing_tag():
+    #without a name column every service road is unnamed
+    links = classify_links(pd.DataFrame({'highway':['service','residential']}))
+    assert links['link_type'].tolist() == ['service','road']
+
+def make_links(geoms,**cols):
+    return gpd.GeoDataFrame({'test_linkid':np.arange(len(geoms)) + 100,**cols},geometry=geoms,crs='epsg:2226')
+
+def test_planarize_splits_crossings():
+    #a plus sign and a line that ends on the horizontal line (T intersection)
+    links = make_links([shapely.LineString([(0,0),(100,0)]),shapely.LineString([(50,-50),(50,50)]),
+                        shapely.LineString([(80,0),(80,60)])])
+    links, nodes = planarize(links,'test')
+
+    assert len(links) == 6
+    assert len(nodes) == 7
+    assert links['test_source_linkid'].tolist() == [100,100,100,101,101,102]
+    assert links['test_linkid'].tolist() == list(range(6))
+    assert np.allclose(links.groupby('test_source_linkid').apply(lambda x: x.length.sum()),[100,100,60])
+    #pieces of a link share the node at the split
+    assert links['test_B'].iloc[0] == links['test_A'].iloc[1]
+
+def test_planarize_levels_and_multilines():
+    #a bridge over the road isn't split and the multilinestring parts become links
+    links = make_links([shapely.LineString([(0,0),(100,0)]),shapely.LineString([(50,-50),(50,50)]),
+                        shapely.MultiLineString([[(200,0),(300,0)],[(300,10),(400,10)]])],
+                       bridge=[None,'yes',None])
+    links, nodes = planarize(links,'test')
+    assert len(links) == 4
+    assert links['test_source_linkid'].tolist() == [100,101,102,102]
+    assert (shapely.get_type_id(links.geometry.to_numpy()) == 1).all()
+    assert len(nodes) == 8
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Topology checks on the synthetic grid
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from network_qa import check_network
+
+def test_clean_grid(grid):
+    links, nodes = grid
+    issues = check_network(links,nodes)
+    assert set(issues['issue']) <= {'dangling_node'}
+
+def test_duplicate_and_parallel_links(grid):
+    links, nodes = grid
+    links = links.assign(osm_linkid=links['linkid'] + 1000,osm_A=links['A'] + 10**6,osm_B=links['B'] + 10**6)
+    #a copy of link 0 drawn the other way (new ids, same attributes) and a different link next to link 1
+    duplicate = links.iloc[[0]].assign(linkid=9000,osm_linkid=9001,A=links['B'].iloc[0],B=links['A'].iloc[0],
+                                       geometry=shapely.reverse(links.geometry.iloc[[0]].to_numpy()))
+    parallel = links.iloc[[1]].assign(linkid=9002,osm_linkid=9003,highway='cycleway' if links['highway'].iloc[1] != 'cycleway' else 'residential')
+    links = pd.concat([links,duplicate,parallel],ignore_index=True)
+    links['dist'] = links.length + np.arange(len(links)) * 0.001
+
+    issues = check_network(links,nodes)
+    assert set(issues.loc[issues['issue'] == 'duplicate_link','linkid']) == {0,9000}
+    assert set(issues.loc[issues['issue'] == 'parallel_link','linkid']) == {1,9002}
+
+def test_self_loop_and_missing_node(grid):
+    links, nodes = grid
+    links = links.copy()
+    links.loc[0,'B'] = links.loc[0,'A']
+    links.loc[1,'A'] = -1
+    issues = check_network(links,nodes)
+    assert 0 in issues.loc[issues['issue'] == 'self_loop','linkid'].tolist()
+    assert 1 in issues.loc[issues['issue'] == 'missing_node','linkid'].tolist()
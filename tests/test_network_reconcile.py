@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of the osm tag columns
+"""
+
+import numpy as np
+import pandas as pd
+
+from network_reconcile import parse_speed, parse_lanes
+
+def test_parse_speed_units():
+    speeds = parse_speed(pd.Series(['35 mph','50 km/h','30;40','20 knots','none',None]))
+    assert np.allclose(speeds,[35,31,19,23,np.nan,np.nan],equal_nan=True)
+
+def test_parse_speed_unitless_default_is_kmh():
+    assert parse_speed(pd.Series(['50']))[0] == 31
+    assert parse_speed(pd.Series(['50']),'mph')[0] == 50
+
+def test_parse_lanes():
+    assert np.allclose(parse_lanes(pd.Series(['2','2;3',None])),[2,2,np.nan],equal_nan=True)
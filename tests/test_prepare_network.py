@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Travel direction, degree 2 contraction, and dense ids on the synthetic grid
+"""
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pytest
+
+from prepare_network import oneway_direction, create_reverse_links, contract_degree2, dense_ids, crosswalks
+from bikewaysim_lite import directed_edges
+
+def test_oneway_direction_tags():
+    links = pd.DataFrame({
+        'oneway':['yes','-1',None,'yes','yes'],
+        'oneway:bicycle':[None,None,None,'no',None],
+        'cycleway':[None,None,None,None,'opposite_lane']
+        })
+    assert oneway_direction(links).tolist() == [1,-1,0,0,0]
+
+def test_reverse_links_and_wrongway(grid):
+    links, nodes = grid
+    links = links.iloc[:3].copy()
+    links['oneway_dir'] = np.array([1,-1,0],dtype=np.int8)
+    links['mins_ba'] = links['mins'] + 1
+
+    edges = create_reverse_links(links,['mins'])
+    assert edges['link_idx'].tolist() == [0,1,2,0,1,2]
+    assert edges['A'].tolist() == links['A'].tolist() + links['B'].tolist()
+    assert edges['wrongway'].tolist() == [False,True,False,True,False,False]
+    #reverse edges use the _ba column
+    assert np.allclose(edges['mins'],np.r_[links['mins'],links['mins_ba']])
+
+    #wrongway edges are dropped or get the wrongway factor
+    dropped = directed_edges(links,'mins')
+    assert len(dropped) == 4
+    assert not dropped['wrongway'].any()
+    penalized = directed_edges(links,'mins',wrongway_factor=10)
+    assert np.allclose(penalized.loc[penalized['wrongway'],'mins'],[links['mins'].iloc[1] * 10,links['mins_ba'].iloc[0] * 10])
+
+def chain(oneway:list,highway:list=None):
+    '''
+    Links along a line (node i to node i+1) and their nodes
+    '''
+    num = len(oneway)
+    x = np.arange(num + 1) * 100.0
+    nodes = gpd.GeoDataFrame({'N':np.arange(num + 1)},geometry=shapely.points(x,0),crs='epsg:2226')
+    links = gpd.GeoDataFrame({
+        'A':np.arange(num),
+        'B':np.arange(1,num + 1),
+        'linkid':np.arange(num) + 10,
+        'highway':highway or ['residential'] * num,
+        'oneway':oneway
+        },geometry=[shapely.LineString([(x[i],0),(x[i+1],0)]) for i in range(num)],crs='epsg:2226')
+    links['dist'] = links.length
+    return links, nodes
+
+def test_contract_degree2_merges_chain():
+    links, nodes = chain([None] * 4,['residential'] * 3 + ['secondary'])
+    merged, merged_nodes, link_map = contract_degree2(links,nodes)
+
+    #the first three links become one and the secondary link is left alone
+    assert len(merged) == 2
+    first = merged[merged['highway'] == 'residential'].iloc[0]
+    assert (first['A'], first['B'], first['linkid']) == (0,3,10)
+    assert first['dist'] == pytest.approx(300)
+    assert first.geometry.length == pytest.approx(300)
+    assert sorted(merged_nodes['N']) == [0,3,4]
+    assert link_map.loc[link_map['linkid'] == 10,'orig_linkid'].tolist() == [10,11,12]
+    assert link_map.loc[link_map['linkid'] == 10,'seq'].tolist() == [0,1,2]
+
+def test_contract_degree2_oneway_direction():
+    #the second link points back at the shared node so the oneways don't flow through it
+    links, nodes = chain(['yes','yes'])
+    links.loc[1,['A','B']] = [2,1]
+    links.loc[1,'geometry'] = shapely.reverse(links.geometry.iloc[1])
+    merged, _, _ = contract_degree2(links,nodes)
+    assert len(merged) == 2
+
+    links, nodes = chain(['yes','yes'])
+    merged, _, _ = contract_degree2(links,nodes)
+    assert len(merged) == 1
+
+@pytest.mark.parametrize('order',['hilbert','rcm',None])
+def test_dense_ids_round_trip(grid,order):
+    links, nodes = grid
+    #sparse source ids
+    links = links.assign(A=links['A'] * 7 + 100,B=links['B'] * 7 + 100)
+    nodes = nodes.assign(N=nodes['N'] * 7 + 100).sample(frac=1,random_state=0)
+
+    new_links, new_nodes = dense_ids(links,nodes,'osm',order)
+    assert new_nodes['N'].tolist() == list(range(len(nodes)))
+    assert new_links['linkid'].tolist() == list(range(len(links)))
+    assert new_links['A'].dtype == np.int32
+
+    #the dense ids map back to the source ids and geometry
+    source_n = new_nodes.set_index('N')['osm_N']
+    assert (source_n.loc[new_links['A']].to_numpy() == new_links['osm_A'].to_numpy()).all()
+    assert (source_n.loc[new_links['B']].to_numpy() == new_links['osm_B'].to_numpy()).all()
+    original = links.set_index('linkid').loc[new_links['osm_linkid']]
+    assert (original['A'].to_numpy() == new_links['osm_A'].to_numpy()).all()
+    assert shapely.equals(original.geometry.to_numpy(),new_links.geometry.to_numpy()).all()
+    node_geo = nodes.set_index('N').geometry.loc[new_nodes['osm_N']]
+    assert shapely.equals(node_geo.to_numpy(),new_nodes.geometry.to_numpy()).all()
+
+    node_crosswalk, link_crosswalk = crosswalks(new_links,new_nodes)
+    assert node_crosswalk.columns.tolist() == ['N','osm_N']
+    assert link_crosswalk.columns.tolist() == ['linkid','osm_linkid']
+
+def test_dense_ids_missing_node(grid):
+    links, nodes = grid
+    links = links.copy()
+    links.loc[0,'B'] = nodes['N'].max() + 1
+    with pytest.raises(ValueError):
+        dense_ids(links,nodes,'osm')
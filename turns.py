@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Edge based (line graph) routing with turn penalties.
+
+In the turn graph every directed edge (see create_reverse_links) is a vertex
+and every allowed movement from one edge onto the next at a node is an arc.
+The cost of an arc is the impedance of the next edge plus the penalty for
+the turn, so left turns, U-turns, and crossing major roads can cost more than
+going straight. The turn graph is built from arrays (no Python loops over the
+network) and is about three times the size of the link table for street grids.
+
+Turn angles come from the first and last segments of the link geometry (the
+osm bearing column is for the whole link, which is off for curved links).
+Angles are -180 to 180 degrees with right turns positive.
+
+OSM turn restrictions are given as a DataFrame with the columns:
+    from_linkid, via_N, to_linkid, restriction (e.g. 'no_left_turn', 'only_straight_on')
+The link ids are matched to linkid_col (osm_linkid by default). Prepared networks
+use dense node ids, so the via_N osm node ids are translated with the node
+crosswalk (node_crosswalk.parquet) when it's given.
+"""
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from bikewaysim_lite import directed_edges
+from instrument import instrumented
+
+#penalties are in the units of the impedance column (None means the turn isn't allowed)
+TURN_PENALTIES = {
+    'straight':0,
+    'right':0.1,
+    'left':0.5,
+    'u_turn':None,
+    'cross_major':0.5
+    }
+
+#absolute turn angles (degrees) that count as going straight and as a u-turn
+STRAIGHT_ANGLE = 30
+U_TURN_ANGLE = 150
+
+MAJOR_ROADS = ['trunk','trunk_link','primary','primary_link','secondary','secondary_link']
+
+def _bearing(x1,y1,x2,y2):
+    '''
+    Compass bearing (degrees clockwise from north) in projected coordinates
+    '''
+    return np.degrees(np.arctan2(x2 - x1,y2 - y1)) % 360
+
+def end_bearings(links):
+    '''
+    Returns the bearing leaving A, the bearing arriving at B, the bearing leaving B
+    (going towards A), and the bearing arriving at A of each link
+    '''
+    geoms = links.geometry.to_numpy()
+    first = shapely.get_coordinates(shapely.get_point(geoms,0))
+    second = shapely.get_coordinates(shapely.get_point(geoms,1))
+    second_last = shapely.get_coordinates(shapely.get_point(geoms,-2))
+    last = shapely.get_coordinates(shapely.get_point(geoms,-1))
+
+    leave_a = _bearing(first[:,0],first[:,1],second[:,0],second[:,1])
+    arrive_b = _bearing(second_last[:,0],second_last[:,1],last[:,0],last[:,1])
+    return leave_a, arrive_b, (arrive_b + 180) % 360, (leave_a + 180) % 360
+
+def turn_type(angle:np.ndarray,u_turn:np.ndarray):
+    '''
+    Classifies turn angles as straight, right, left, or u_turn
+    '''
+    types = np.where(np.abs(angle) <= STRAIGHT_ANGLE,'straight',np.where(angle > 0,'right','left')).astype(object)
+    types[(np.abs(angle) >= U_TURN_ANGLE) | u_turn] = 'u_turn'
+    return types
+
+def restricted_turns(turns:pd.DataFrame,edges:pd.DataFrame,restrictions:pd.DataFrame):
+    '''
+    Returns a mask of the turns that aren't allowed because of turn restrictions.
+    'no_' restrictions remove that turn and 'only_' restrictions remove every other
+    turn from the from link at the via node.
+    '''
+    from_link = edges['linkid'].to_numpy()[turns['from_edge'].to_numpy()]
+    to_link = edges['linkid'].to_numpy()[turns['to_edge'].to_numpy()]
+    via = turns['via_N'].to_numpy()
+
+    turn_keys = pd.MultiIndex.from_arrays([from_link,via,to_link])
+    only = restrictions['restriction'].astype(str).str.startswith('only_')
+
+    no = restrictions[~only]
+    blocked = turn_keys.isin(pd.MultiIndex.from_frame(no[['from_linkid','via_N','to_linkid']]))
+
+    if only.any():
+        only = restrictions[only]
+        #turns starting from a link and node with an only restriction
+        from_keys = pd.MultiIndex.from_arrays([from_link,via])
+        has_only = from_keys.isin(pd.MultiIndex.from_frame(only[['from_linkid','via_N']]))
+        allowed = turn_keys.isin(pd.MultiIndex.from_frame(only[['from_linkid','via_N','to_linkid']]))
+        blocked |= has_only & ~allowed
+
+    return blocked
+
+def translate_via_nodes(restrictions:pd.DataFrame,node_ids:np.ndarray,node_crosswalk:pd.DataFrame=None,source_col:str='osm_N'):
+    '''
+    Converts the via_N of the turn restrictions to the network node ids with the node
+    crosswalk (N and source_col columns) and checks that every via node is in the
+    network (ids that don't match would silently restrict nothing)
+    '''
+    restrictions = restrictions.copy()
+    if node_crosswalk is not None:
+        restrictions['via_N'] = restrictions['via_N'].map(node_crosswalk.set_index(source_col)['N'])
+    via = restrictions['via_N'].to_numpy(dtype=float)
+    missing = np.isnan(via)
+    missing[~missing] = node_position(node_ids,via[~missing].astype(np.int64)) < 0
+    if missing.any():
+        raise ValueError(f'{missing.sum()} turn restrictions have via_N ids that are not in the network'
+                         + (' (pass node_crosswalk to translate source node ids)' if node_crosswalk is None else ''))
+    restrictions['via_N'] = via.astype(np.int64)
+    return restrictions
+
+@instrumented()
+def create_turn_graph(links,impedance_col:str,penalties:dict=TURN_PENALTIES,restrictions:pd.DataFrame=None,
+                      linkid_col:str='osm_linkid',major_col:str='highway',major_values:list=MAJOR_ROADS,wrongway_factor:float=None,
+                      node_crosswalk:pd.DataFrame=None):
+    '''
+    Builds the turn graph. node_crosswalk (from prepare_network.crosswalks) is used to
+    translate the via_N of the restrictions from the source node ids in the column
+    matching linkid_col (e.g. osm_N for osm_linkid) to the network node ids.
+
+    Returns a dictionary with:
+        graph: scipy CSR matrix of the edges followed by one start vertex per node
+        edges: the directed edges (link_idx, dir, A, B, linkid, impedance)
+        node_ids: sorted node ids (start vertex for node_ids[i] is len(edges) + i)
+        turns: from_edge, to_edge, via_N, angle, turn, penalty for every allowed turn
+    '''
+    edges = directed_edges(links,impedance_col,wrongway_factor).reset_index(drop=True)
+    if 'link_idx' not in edges.columns:
+        edges['link_idx'] = np.arange(len(edges))
+        edges['dir'] = np.int8(0)
+    link_idx = edges['link_idx'].to_numpy()
+    forward = edges['dir'].to_numpy() == 0
+    edges['linkid'] = links[linkid_col].to_numpy()[link_idx] if linkid_col in links.columns else link_idx
+
+    #bearing leaving the start and arriving at the end of each directed edge
+    leave_a, arrive_b, leave_b, arrive_a = end_bearings(links)
+    start_bearing = np.where(forward,leave_a[link_idx],leave_b[link_idx])
+    end_bearing = np.where(forward,arrive_b[link_idx],arrive_a[link_idx])
+
+    #pair every edge with every edge leaving its end node
+    a = edges['A'].to_numpy()
+    b = edges['B'].to_numpy()
+    by_start = np.argsort(a,kind='stable')
+    lo = np.searchsorted(a[by_start],b,side='left')
+    hi = np.searchsorted(a[by_start],b,side='right')
+    num_next = hi - lo
+    from_edge = np.repeat(np.arange(len(edges)),num_next)
+    offset = np.arange(len(from_edge)) - np.repeat(np.cumsum(num_next) - num_next,num_next)
+    to_edge = by_start[np.repeat(lo,num_next) + offset]
+
+    angle = (start_bearing[to_edge] - end_bearing[from_edge] + 540) % 360 - 180
+    angle = np.nan_to_num(angle)
+    turns = pd.DataFrame({
+        'from_edge':from_edge,
+        'to_edge':to_edge,
+        'via_N':b[from_edge],
+        'angle':angle.round(1),
+        'turn':turn_type(angle,link_idx[from_edge] == link_idx[to_edge])
+        })
+
+    #crossing a major road (going straight or left through a node on a major road without being on it)
+    major = links[major_col].isin(major_values).to_numpy()[link_idx] if major_col in links.columns else np.zeros(len(edges),dtype=bool)
+    node_major = pd.Series(np.concatenate([major,major])).groupby(np.concatenate([a,b])).any()
+    at_major = node_major.reindex(turns['via_N']).to_numpy()
+    turns['cross_major'] = at_major & turns['turn'].isin(['straight','left']).to_numpy() & ~(major[from_edge] & major[to_edge])
+
+    #penalties (None removes the turn)
+    penalty = turns['turn'].map(penalties).to_numpy(dtype=float)
+    if penalties.get('cross_major') is not None:
+        penalty = penalty + turns['cross_major'].to_numpy() * penalties['cross_major']
+    allowed = ~np.isnan(penalty)
+    node_ids = np.unique(np.concatenate([a,b]))
+    if restrictions is not None and len(restrictions) > 0:
+        restrictions = translate_via_nodes(restrictions,node_ids,node_crosswalk,linkid_col.replace('linkid','N'))
+        allowed &= ~restricted_turns(turns,edges,restrictions)
+    turns['penalty'] = penalty
+    turns = turns[allowed].reset_index(drop=True)
+    print(f"{len(turns)} turns ({(~allowed).sum()} not allowed) for {len(edges)} directed edges")
+
+    #start vertices: one per node connected to the edges leaving that node
+    a_idx = np.searchsorted(node_ids,a)
+
+    imp = np.maximum(edges[impedance_col].to_numpy(dtype=float),1e-9)
+    rows = np.concatenate([turns['from_edge'].to_numpy(),len(edges) + a_idx])
+    cols = np.concatenate([turns['to_edge'].to_numpy(),np.arange(len(edges))])
+    weights = np.concatenate([imp[turns['to_edge'].to_numpy()] + turns['penalty'].to_numpy(),imp])
+    size = len(edges) + len(node_ids)
+    graph = csr_matrix((np.maximum(weights,1e-9),(rows,cols)),shape=(size,size))
+
+    return {'graph':graph,'edges':edges,'node_ids':node_ids,'turns':turns}
+
+def node_position(node_ids:np.ndarray,nodes:np.ndarray):
+    '''
+    Position of each node in the sorted node_ids (-1 if it isn't there)
+    '''
+    idx = np.minimum(np.searchsorted(node_ids,nodes),len(node_ids) - 1)
+    return np.where(node_ids[idx] == nodes,idx,-1)
+
+def _edge_path(predecessors:np.ndarray,last_edge:int,num_edges:int):
+    '''
+    Supporting function for find_shortest_turns. Follows the predecessors back to
+    the start vertex and returns the list of edges.
+    '''
+    path = []
+    vertex = last_edge
+    while (vertex >= 0) and (vertex < num_edges):
+        path.append(vertex)
+        vertex = predecessors[vertex]
+    return path[::-1]
+
+def arrival_edges(dist:np.ndarray,by_end:np.ndarray,end_lo:np.ndarray,end_hi:np.ndarray,dests:np.ndarray):
+    '''
+    Supporting function for find_shortest_turns. Returns the edge with the lowest
+    impedance arriving at each destination (graph position), or -1 if no edges arrive
+    there. by_end is the edges sorted by end node and by_end[end_lo[i]:end_hi[i]] are
+    the edges arriving at node i, so only the edges arriving at dests are looked at.
+    '''
+    last = np.full(len(dests),-1,dtype=np.int64)
+    counts = end_hi[dests] - end_lo[dests]
+    has_edges = counts > 0
+    if not has_edges.any():
+        return last
+    counts = counts[has_edges]
+    seg_start = np.cumsum(counts) - counts
+    offset = np.arange(counts.sum()) - np.repeat(seg_start,counts)
+    arriving = by_end[np.repeat(end_lo[dests][has_edges],counts) + offset]
+
+    #first edge of each destination with the lowest impedance
+    values = dist[arriving]
+    seg = np.repeat(np.arange(len(counts)),counts)
+    is_best = np.flatnonzero(values == np.minimum.reduceat(values,seg_start)[seg])
+    first = is_best[np.r_[True,seg[is_best][1:] != seg[is_best][:-1]]]
+    last[has_edges] = arriving[first]
+    return last
+
+@instrumented()
+def find_shortest_turns(links,ods:pd.DataFrame,impedance_col:str,turn_graph:dict=None,chunk_size:int=16,**kwargs):
+    '''
+    Shortest routes with turn penalties for the ods (snap_ods_to_network format). A turn
+    graph from create_turn_graph can be passed in to reuse it, otherwise one is made
+    (kwargs go to create_turn_graph). Returns the ods with the impedance (including
+    turn penalties), the number of left turns, the list of link positions (row
+    positions in links), and the route geometry.
+    '''
+    if turn_graph is None:
+        turn_graph = create_turn_graph(links,impedance_col,**kwargs)
+    graph, edges, node_ids = turn_graph['graph'], turn_graph['edges'], turn_graph['node_ids']
+    num_edges = len(edges)
+    edge_end = np.searchsorted(node_ids,edges['B'].to_numpy())
+    #edges sorted by end node (by_end[end_lo[i]:end_hi[i]] arrive at node i)
+    by_end = np.argsort(edge_end,kind='stable')
+    end_lo = np.searchsorted(edge_end[by_end],np.arange(len(node_ids)),side='left')
+    end_hi = np.searchsorted(edge_end[by_end],np.arange(len(node_ids)),side='right')
+    left = dict(zip(zip(turn_graph['turns']['from_edge'],turn_graph['turns']['to_edge']),turn_graph['turns']['turn'] == 'left'))
+
+    #graph positions of the origin and destination nodes (-1 if not in the network)
+    o_idx = node_position(node_ids,ods['o_node'].to_numpy())
+    d_idx = node_position(node_ids,ods['d_node'].to_numpy())
+    routable = (o_idx >= 0) & (d_idx >= 0)
+
+    impedance = np.full(len(ods),np.nan)
+    left_turns = np.full(len(ods),np.nan)
+    paths = [None] * len(ods)
+
+    origins = np.unique(o_idx[routable])
+    #group the ods by origin once (od_order[starts[j]:ends[j]] are the ods from origins[j])
+    od_order = np.flatnonzero(routable)
+    od_order = od_order[np.argsort(o_idx[od_order],kind='stable')]
+    starts = np.searchsorted(o_idx[od_order],origins,side='left')
+    ends = np.searchsorted(o_idx[od_order],origins,side='right')
+    for start in range(0,len(origins),chunk_size):
+        chunk = origins[start:start+chunk_size]
+        dist, pred = dijkstra(graph,directed=True,indices=num_edges + chunk,return_predecessors=True)
+
+        for row, origin in enumerate(chunk):
+            od_idx = od_order[starts[start+row]:ends[start+row]]
+            #best edge arriving at each destination of this origin
+            last_edges = arrival_edges(dist[row,:num_edges],by_end,end_lo,end_hi,d_idx[od_idx])
+            for i, last in zip(od_idx,last_edges):
+                if d_idx[i] == origin:
+                    impedance[i], left_turns[i], paths[i] = 0, 0, []
+                    continue
+                if (last < 0) or np.isinf(dist[row,last]):
+                    continue
+                path = _edge_path(pred[row],last,num_edges)
+                impedance[i] = dist[row,last]
+                left_turns[i] = sum(left.get(turn,False) for turn in zip(path[:-1],path[1:]))
+                paths[i] = edges['link_idx'].to_numpy()[path].tolist()
+
+    ods = ods.copy()
+    ods[impedance_col] = impedance
+    ods['left_turns'] = left_turns
+    ods['link_idx'] = paths
+    geoms = links.geometry.to_numpy()
+    ods['geometry'] = [shapely.multilinestrings(geoms[x]) if isinstance(x,list) and len(x) > 0 else None for x in ods['link_idx']]
+    ods = gpd.GeoDataFrame(ods,geometry='geometry',crs=links.crs)
+    ods['length'] = ods.length
+
+    print(f"{ods[impedance_col].isna().sum()} trips couldnt be routed")
+
+    return ods